@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+    analyzer.py
+    ~~~~~~~~~~~
+
+    Single-pass evaluation of record-level checks: every record is walked
+    once and its header and Dublin Core fields are handed to all checks.
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+OAI = '{http://www.openarchives.org/OAI/%s/}'
+
+DC_NAMESPACE = "http://purl.org/dc/elements/1.1/"
+DC = '{%s}' % DC_NAMESPACE
+
+
+class RecordInfo(object):
+
+    """The fields of an OAI-PMH record (or ListIdentifiers header) that
+    the record-level checks look at.
+
+       :param identifier: The OAI identifier from the header.
+       :param datestamp: The datestamp from the header.
+       :param deleted: True if the header has status "deleted".
+       :param set_specs: List of setSpecs from the header.
+       :param dc: Dictionary mapping DC element names (without namespace)
+                  to the list of their texts in document order; empty
+                  elements contribute None.
+    """
+
+    __slots__ = ('identifier', 'datestamp', 'deleted', 'set_specs', 'dc')
+
+    def __init__(self, identifier=None, datestamp=None, deleted=False,
+                 set_specs=None, dc=None):
+        self.identifier = identifier
+        self.datestamp = datestamp
+        self.deleted = deleted
+        self.set_specs = set_specs or []
+        self.dc = dc or {}
+
+    def texts(self, name):
+        """Return the non-empty texts of DC element name."""
+        return [text for text in self.dc.get(name, ()) if text is not None]
+
+
+class RecordExtractor(object):
+
+    """Turn record elements into RecordInfo objects in one traversal,
+    dispatching on tag names precomputed for the OAI namespace.
+
+       :param protocol_version: The OAI-PMH version of the repository.
+    """
+
+    def __init__(self, protocol_version='2.0'):
+        oai = OAI % protocol_version
+        self.header_tag = oai + 'header'
+        self.header_fields = {
+            oai + 'identifier': 'identifier',
+            oai + 'datestamp': 'datestamp',
+            oai + 'setSpec': 'setSpec',
+        }
+        self.dc_offset = len(DC)
+
+    def extract(self, record):
+        """Return the RecordInfo for a record or header element."""
+        info = RecordInfo()
+        dc = info.dc
+        header_fields = self.header_fields
+        in_header = record.tag == self.header_tag
+        if in_header:
+            info.deleted = record.get('status') == 'deleted'
+        for element in record.iterdescendants():
+            tag = element.tag
+            if not isinstance(tag, basestring):
+                # Comments and processing instructions
+                continue
+            if tag.startswith(DC):
+                dc.setdefault(tag[self.dc_offset:], []).append(element.text)
+            elif tag == self.header_tag:
+                info.deleted = element.get('status') == 'deleted'
+            elif tag in header_fields:
+                field = header_fields[tag]
+                if field == 'setSpec':
+                    info.set_specs.append(element.text)
+                elif getattr(info, field) is None:
+                    setattr(info, field, element.text)
+        return info
+
+
+class RecordCheck(object):
+
+    """Base class for checks evaluated by a RecordAnalyzer. Subclasses
+    inspect one RecordInfo at a time, set done once their result cannot
+    change any more and finally report it via result().
+    """
+
+    #: Key of the check in Validator.results
+    key = None
+    #: Message template for records that could not be fetched (None: no
+    #: result is reported)
+    unverified_message = None
+    #: Reason reported if there are no records at all
+    no_records = 'No records.'
+
+    def __init__(self):
+        self.done = False
+        self.count = 0
+
+    def inspect(self, record):
+        """Look at a RecordInfo."""
+        raise NotImplementedError
+
+    def result(self):
+        """Return the final (level, message) tuple or None."""
+        raise NotImplementedError
+
+    def unverified(self, reason):
+        """Return the result if the records could not be inspected."""
+        if self.unverified_message is None:
+            return None
+        return ('unverified', self.unverified_message % reason)
+
+
+class RecordAnalyzer(object):
+
+    """Feed records through a set of RecordChecks, extracting every record
+    only once. Checks that are done are skipped; the analysis stops as soon
+    as all checks are done.
+
+       :param checks: List of RecordCheck instances.
+       :param protocol_version: The OAI-PMH version of the repository.
+    """
+
+    def __init__(self, checks, protocol_version='2.0'):
+        self.checks = checks
+        self.extractor = RecordExtractor(protocol_version)
+        self.count = 0
+
+    @property
+    def done(self):
+        return all(check.done for check in self.checks)
+
+    def feed(self, record):
+        """Hand a record to the active checks. Record elements are
+        extracted first; RecordInfo objects are taken as they are. Return
+        the RecordInfo.
+        """
+        if isinstance(record, RecordInfo):
+            info = record
+        else:
+            info = self.extractor.extract(record)
+        self.count += 1
+        for check in self.checks:
+            if not check.done:
+                check.count += 1
+                check.inspect(info)
+        return info
+
+    def run(self, records):
+        """Analyze records until they are exhausted or all checks are done.
+        Return the number of records analyzed.
+        """
+        for record in records:
+            if self.done:
+                break
+            self.feed(record)
+        return self.count
+
+    def results(self):
+        """Return a dictionary of the checks' results by key."""
+        results = {}
+        for check in self.checks:
+            result = check.result()
+            if result is not None:
+                results[check.key] = result
+        return results
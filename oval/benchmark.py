@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark.py
+    ~~~~~~~~~~~~
+
+    Benchmarks against mock repositories (see mockserver.py): end-to-end
+    latency, requests sent and peak memory of validate_repository, and the
+    throughput of RecordIterator in records per second. Every measurement
+    runs in a fresh process, so caches start cold and the peak resident
+    set size belongs to that measurement alone. Results are written as
+    JSON; a previous result file can be given to compare against::
+
+        python benchmark.py -o before.json
+        ...
+        python benchmark.py -o after.json --compare before.json
+
+    The per-host rate limit is disabled unless --rate-limit is given, so
+    the figures show the validator rather than the limiter.
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+import sys
+import json
+import time
+import resource
+import platform
+import argparse
+import multiprocessing
+from datetime import datetime
+
+from ordereddict import OrderedDict
+
+import harvester
+from mockserver import MockRepository, MockServer, DAY_GRANULARITY
+
+
+#: Named repository configurations (keyword arguments of MockRepository)
+SCENARIOS = OrderedDict([
+    ('small', dict(records=250, page_size=100)),
+    ('large', dict(records=5000, page_size=500, payload_size=2048)),
+    ('slow', dict(records=250, page_size=50, latency=0.05)),
+    ('flaky', dict(records=250, page_size=100, error_rate=0.25,
+                   retry_after=0)),
+    ('day-granularity', dict(records=1000, page_size=100,
+                             granularity=DAY_GRANULARITY)),
+])
+
+
+def _peak_rss():
+    # ru_maxrss is in kilobytes on Linux (bytes on Mac OS X)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def _measure_validation(base_url, timeout):
+    from bulk import validate_repository
+    result = validate_repository(base_url, timeout=timeout)
+    return OrderedDict([('seconds', result['elapsed']),
+                        ('error', result['error']),
+                        ('metrics', result['metrics'])])
+
+
+def _measure_harvest(base_url, timeout, stream):
+    start = time.time()
+    RecordIterator = harvester.configure_record_iterator(
+        base_url, '2.0', 'POST', timeout)
+    records = sum(1 for record in RecordIterator('ListRecords', 'oai_dc',
+                                                 deleted=True, stream=stream))
+    seconds = time.time() - start
+    return OrderedDict([('seconds', round(seconds, 4)),
+                        ('records', records),
+                        ('records_per_second', round(records / seconds, 1))])
+
+
+def _run_child(queue, function, args, rate_limit):
+    baseline = _peak_rss()
+    if not rate_limit:
+        harvester.LIMITER = None
+    try:
+        result = function(*args)
+    except Exception as exc:
+        result = OrderedDict([('error', '%s: %s' % (exc.__class__.__name__,
+                                                     exc))])
+    result['baseline_rss_kb'] = baseline
+    result['peak_rss_kb'] = _peak_rss()
+    queue.put(result)
+
+
+def measure(repository, function, args=(), rate_limit=False):
+    """Run function(*args) in a new process and return its result (a
+    dictionary) together with the peak resident set size of the process
+    and the requests the repository received.
+
+    :param repository: The MockRepository served to function.
+    :param function: The measurement; returns an OrderedDict.
+    :param args: Arguments for function.
+    :param rate_limit: Keep the per-host rate limit.
+    """
+    repository.reset_counts()
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_run_child, args=(queue, function, args, rate_limit))
+    process.start()
+    result = queue.get()
+    process.join()
+    result['requests'] = repository.total_requests
+    result['requests_by_verb'] = OrderedDict(sorted(
+        (verb or 'none', count)
+        for verb, count in repository.requests.items()))
+    return result
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def _summarize(runs, key):
+    values = [run[key] for run in runs if key in run]
+    if not values:
+        return None
+    return OrderedDict([('min', min(values)), ('median', _median(values)),
+                        ('max', max(values))])
+
+
+def run_scenario(config, repeat=3, timeout=40, rate_limit=False):
+    """Benchmark validation and harvesting of a mock repository.
+
+    :param config: Keyword arguments for MockRepository.
+    :param repeat: Number of validations and harvests measured.
+    :param timeout: Timeout in seconds for each request.
+    :param rate_limit: Keep the per-host rate limit.
+    """
+    repository = MockRepository(**config)
+    with MockServer(repository) as server:
+        validations = [measure(repository, _measure_validation,
+                               (server.url, timeout), rate_limit)
+                       for i in range(repeat)]
+        harvests = OrderedDict()
+        for mode, stream in (('pages', False), ('stream', True)):
+            harvests[mode] = [measure(repository, _measure_harvest,
+                                      (server.url, timeout, stream),
+                                      rate_limit)
+                              for i in range(repeat)]
+    result = OrderedDict([('config', config)])
+    result['validate'] = OrderedDict([
+        ('seconds', _summarize(validations, 'seconds')),
+        ('requests', _summarize(validations, 'requests')),
+        ('peak_rss_kb', _summarize(validations, 'peak_rss_kb')),
+        ('runs', validations)])
+    for mode, runs in harvests.items():
+        result['harvest_' + mode] = OrderedDict([
+            ('records_per_second', _summarize(runs, 'records_per_second')),
+            ('requests', _summarize(runs, 'requests')),
+            ('peak_rss_kb', _summarize(runs, 'peak_rss_kb')),
+            ('runs', runs)])
+    return result
+
+
+def run(names=None, repeat=3, timeout=40, rate_limit=False):
+    """Run the scenarios with names (default: all) and return the results
+    as a dictionary ready for JSON.
+    """
+    results = OrderedDict([
+        ('date', datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('repeat', repeat),
+        ('rate_limit', rate_limit),
+        ('scenarios', OrderedDict())])
+    for name in names or SCENARIOS.keys():
+        results['scenarios'][name] = run_scenario(
+            SCENARIOS[name], repeat, timeout, rate_limit)
+    return results
+
+
+#: Figures compared by compare() and whether higher is better
+COMPARED = (
+    ('validate', 'seconds', False),
+    ('validate', 'requests', False),
+    ('validate', 'peak_rss_kb', False),
+    ('harvest_pages', 'records_per_second', True),
+    ('harvest_stream', 'records_per_second', True),
+    ('harvest_stream', 'peak_rss_kb', False),
+)
+
+
+def compare(results, baseline):
+    """Return lines comparing the medians of results with those of
+    baseline. Changes for the worse are marked with an exclamation mark.
+    """
+    lines = []
+    for name, scenario in results['scenarios'].items():
+        previous = baseline['scenarios'].get(name)
+        if previous is None:
+            continue
+        for part, figure, higher_is_better in COMPARED:
+            try:
+                old = previous[part][figure]['median']
+                new = scenario[part][figure]['median']
+            except (KeyError, TypeError):
+                continue
+            change = (new - old) / float(old) if old else 0.0
+            worse = change < 0 if higher_is_better else change > 0
+            lines.append('%-16s %-15s %-18s %12.5g %12.5g %+7.1f%% %s' % (
+                name, part, figure, old, new, change * 100,
+                '!' if worse and abs(change) > 0.1 else ''))
+    return lines
+
+
+def main():
+    """Command line interface for the benchmarks."""
+    parser = argparse.ArgumentParser(
+        description='OVAL -- benchmarks against mock repositories')
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help='scenarios to run (default: all of %s)'
+                        % ', '.join(SCENARIOS.keys()))
+    parser.add_argument('-o', '--output',
+                        help='file for the JSON results (default: stdout)')
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='measurements per figure')
+    parser.add_argument('--timeout', type=int, default=40,
+                        help='timeout in seconds for each request')
+    parser.add_argument('--rate-limit', action='store_true',
+                        help='keep the per-host rate limit')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='JSON results of a previous run to compare with')
+
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario: %s' % name)
+
+    results = run(args.scenarios, args.repeat, args.timeout, args.rate_limit)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        for line in compare(results, baseline):
+            print >> sys.stderr, line
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+    bulk.py
+    ~~~~~~~
+
+    Validation of many repositories from the command line: base URLs are
+    read from a file or stdin and validated in a pool of processes, at
+    most per_host at a time per host. One JSON line of results is written
+    per repository as soon as its validation has finished::
+
+        python bulk.py endpoints.txt --processes 16 --output results.jsonl
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+import sys
+import json
+import time
+import argparse
+import threading
+from Queue import Queue, Empty
+from collections import deque
+from multiprocessing import Pool
+from urlparse import urlparse
+
+from ordereddict import OrderedDict
+
+from harvester import enable_disk_cache, enable_rate_limit
+from validator import Validator, run_checks, SAMPLING_METHODS
+from checkpoint import CheckpointStore
+
+
+def _text(value):
+    """Make value safe for JSON output."""
+    if isinstance(value, str):
+        return value.decode('utf8', 'replace')
+    return value
+
+
+def host_of(base_url):
+    """Return the host name of base_url (in lower case)."""
+    return (urlparse(base_url).hostname or base_url).lower()
+
+
+def read_base_urls(lines):
+    """Yield the base URLs in lines, skipping blank lines and comments
+    starting with #.
+    """
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+
+def validate_repository(base_url, time_limit=None, timeout=40, max_workers=4,
+                        full_scan=False, checkpoints=None, harvest_workers=1,
+                        sampling='first'):
+    """Run the standard checks (see schedule_checks) on a repository and
+    return a dictionary with the keys base_url, repository_name, results,
+    error, elapsed and metrics (see ValidationMetrics.summary). If the
+    validation takes longer than time_limit seconds, the results found so
+    far are returned and error says so.
+
+    :param base_url: The OAI-PMH endpoint of the repository.
+    :param time_limit: Maximum time in seconds for the whole validation.
+    :param timeout: Timeout in seconds for each request to the server.
+    :param max_workers: Maximum number of checks running at the same time.
+    :param full_scan: Check all records instead of a sample.
+    :param checkpoints: Optional path to an SQLite database in which the
+                        progress of full scans is saved (see checkpoint.py).
+    :param harvest_workers: Concurrent harvests of a full scan.
+    :param sampling: How the record sample is drawn ('first' or
+                     'stratified', see Validator).
+    """
+    start = time.time()
+    if time_limit is not None:
+        timeout = min(timeout, time_limit)
+    state = {}
+
+    def validate():
+        try:
+            state['validator'] = Validator(base_url, timeout=timeout,
+                                           sampling=sampling)
+            store = None
+            if checkpoints is not None:
+                store = CheckpointStore(checkpoints)
+            run_checks(state['validator'], max_workers=max_workers,
+                       full_scan=full_scan, checkpoints=store,
+                       harvest_workers=harvest_workers)
+        except Exception as exc:
+            state['error'] = _text(unicode(exc)) or exc.__class__.__name__
+
+    # The validation runs in a daemon thread so that the time limit holds
+    # even if a server stops responding in the middle of a check.
+    thread = threading.Thread(target=validate)
+    thread.daemon = True
+    thread.start()
+    thread.join(time_limit)
+
+    validator = state.get('validator')
+    if thread.is_alive():
+        error = 'Time limit of %s seconds exceeded.' % time_limit
+    else:
+        error = state.get('error')
+    results = OrderedDict()
+    repository_name = metrics = None
+    if validator is not None:
+        repository_name = _text(validator.repository_name)
+        metrics = validator.metrics.summary()
+        snapshot = validator.results.snapshot()
+        for key, (level, message) in sorted(snapshot.items()):
+            results[key] = (level, _text(message))
+    return OrderedDict([('base_url', base_url),
+                        ('repository_name', repository_name),
+                        ('results', results),
+                        ('error', error),
+                        ('elapsed', round(time.time() - start, 3)),
+                        ('metrics', metrics)])
+
+
+def _validate_safely(args):
+    # Never let an exception escape into the pool: the result would be lost
+    try:
+        return validate_repository(*args)
+    except Exception as exc:
+        return OrderedDict([('base_url', args[0]),
+                            ('repository_name', None),
+                            ('results', {}),
+                            ('error', _text(unicode(exc))),
+                            ('elapsed', None),
+                            ('metrics', None)])
+
+
+class BulkValidator(object):
+
+    """Validate many repositories in a pool of processes::
+
+        bulk = BulkValidator(processes=16, per_host=2, time_limit=600)
+        for result in bulk.run(base_urls):
+            print json.dumps(result)
+
+    Every process handles a single repository and is replaced afterwards,
+    so that checks still running after the time limit are discarded with
+    it.
+
+    :param processes: Number of validations running at the same time.
+    :param per_host: Maximum number of concurrent validations per host.
+    :param time_limit: Maximum time in seconds for each validation.
+    :param timeout: Timeout in seconds for each request to a server.
+    :param max_workers: Maximum number of concurrent checks per validation.
+    :param full_scan: Check all records of every repository instead of a
+                      sample.
+    :param checkpoints: Optional path to an SQLite database for resuming
+                        interrupted full scans.
+    :param harvest_workers: Concurrent harvests of each full scan.
+    :param sampling: How record samples are drawn ('first' or
+                     'stratified', see Validator).
+    """
+
+    def __init__(self, processes=8, per_host=1, time_limit=600, timeout=40,
+                 max_workers=4, full_scan=False, checkpoints=None,
+                 harvest_workers=1, sampling='first'):
+        if processes < 1 or per_host < 1:
+            raise ValueError('processes and per_host must be positive.')
+        self.processes = processes
+        self.per_host = per_host
+        self.time_limit = time_limit
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.full_scan = full_scan
+        self.checkpoints = checkpoints
+        self.harvest_workers = harvest_workers
+        self.sampling = sampling
+
+    def run(self, base_urls):
+        """Validate the repositories in base_urls. Yield the result of each
+        validation (see validate_repository) as soon as it is finished.
+
+        :param base_urls: Iterable of OAI-PMH endpoints.
+        """
+        # Queued base URLs by host, in input order
+        queues = OrderedDict()
+        for base_url in base_urls:
+            queues.setdefault(host_of(base_url), deque()).append(base_url)
+        running = dict.fromkeys(queues, 0)
+        done = Queue()
+        pool = Pool(self.processes, maxtasksperchild=1)
+        in_flight = 0
+        try:
+            while queues or in_flight:
+                for host in queues.keys():
+                    while (queues[host] and in_flight < self.processes and
+                           running[host] < self.per_host):
+                        base_url = queues[host].popleft()
+                        running[host] += 1
+                        in_flight += 1
+                        args = (base_url, self.time_limit, self.timeout,
+                                self.max_workers, self.full_scan,
+                                self.checkpoints, self.harvest_workers,
+                                self.sampling)
+                        pool.apply_async(_validate_safely, (args,),
+                                         callback=done.put)
+                    if not queues[host]:
+                        del queues[host]
+                while True:
+                    # Waiting with a timeout keeps KeyboardInterrupt working
+                    try:
+                        result = done.get(timeout=1)
+                        break
+                    except Empty:
+                        continue
+                running[host_of(result['base_url'])] -= 1
+                in_flight -= 1
+                yield result
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+
+def main():
+    """Command line interface for bulk validation."""
+    parser = argparse.ArgumentParser(
+        description='OVAL -- validate many OAI-PMH interfaces')
+    parser.add_argument('input', nargs='?', default='-',
+                        help='file with one base URL per line '
+                        '(default: stdin)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='file for the JSON lines (default: stdout)')
+    parser.add_argument('-p', '--processes', type=int, default=8,
+                        help='number of concurrent validations (default: 8)')
+    parser.add_argument('--per-host', type=int, default=1,
+                        help='concurrent validations per host (default: 1)')
+    parser.add_argument('--time-limit', type=float, default=600,
+                        help='seconds allowed per repository (default: 600)')
+    parser.add_argument('--timeout', type=float, default=40,
+                        help='seconds allowed per request (default: 40)')
+    parser.add_argument('--check-workers', type=int, default=4,
+                        help='concurrent checks per repository (default: 4)')
+    parser.add_argument('--disk-cache', metavar='PATH',
+                        help='keep responses in an SQLite database at PATH')
+    parser.add_argument('--host-rate', type=float, default=10,
+                        help='requests per second and host (default: 10)')
+    parser.add_argument('--rate-limit-db', metavar='PATH',
+                        help='share the per-host rate limits of all '
+                        'processes in an SQLite database at PATH')
+    parser.add_argument('--full-scan', action='store_true',
+                        help='check all records instead of a sample (set '
+                        'a --time-limit that fits the largest repository)')
+    parser.add_argument('--checkpoints', metavar='PATH',
+                        help='save the progress of full scans in an SQLite '
+                        'database at PATH; interrupted scans resume from it')
+    parser.add_argument('--harvest-workers', type=int, default=1,
+                        help='harvest each full scan in this many date '
+                        'windows at once (not with --checkpoints)')
+    parser.add_argument('--sampling', choices=SAMPLING_METHODS,
+                        default='first',
+                        help='draw record samples from the start of the '
+                        'list or from date windows over the whole history '
+                        '(default: first)')
+
+    args = parser.parse_args()
+
+    if args.disk_cache:
+        enable_disk_cache(args.disk_cache)
+    enable_rate_limit(args.rate_limit_db, rate=args.host_rate,
+                      burst=max(1, int(2 * args.host_rate)))
+
+    if args.input == '-':
+        base_urls = list(read_base_urls(sys.stdin))
+    else:
+        with open(args.input) as input_file:
+            base_urls = list(read_base_urls(input_file))
+
+    output = sys.stdout if args.output == '-' else open(args.output, 'a')
+    bulk = BulkValidator(processes=args.processes, per_host=args.per_host,
+                         time_limit=args.time_limit, timeout=args.timeout,
+                         max_workers=args.check_workers,
+                         full_scan=args.full_scan,
+                         checkpoints=args.checkpoints,
+                         harvest_workers=args.harvest_workers,
+                         sampling=args.sampling)
+    try:
+        for result in bulk.run(base_urls):
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+    cache.py
+    ~~~~~~~~
+
+    Caching of OAI-PMH responses: a thread-safe in-memory cache and an
+    optional on-disk cache shared by all processes on the host.
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+import sys
+import time
+import json
+import zlib
+import sqlite3
+import threading
+from functools import wraps
+
+from ordereddict import OrderedDict
+
+
+def make_key(name, args, kw):
+    """Build a hashable cache key from a function name and its arguments.
+    Dictionaries (e.g. HTTP parameters) are turned into sorted tuples.
+
+    :param name: The name of the cached function.
+    :param args: The positional arguments.
+    :param kw: The keyword arguments.
+    """
+    def freeze(value):
+        if isinstance(value, dict):
+            return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+        elif isinstance(value, (list, tuple)):
+            return tuple(freeze(v) for v in value)
+        return value
+    return (name, freeze(args), freeze(kw))
+
+
+def size_of(value):
+    """Return the approximate size of a cached value in bytes."""
+    if isinstance(value, basestring):
+        return len(value)
+    return sys.getsizeof(value)
+
+
+class _Flight(object):
+
+    """A load in progress that concurrent callers wait for."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class LRUCache(object):
+
+    """Least-recently-used cache bounded by the total size of its values in
+    bytes. Entries expire after a time to live. All operations are
+    protected by a lock, and concurrent misses on the same key are
+    coalesced into a single load (see get_or_load).
+
+       :param max_bytes: Upper bound for the total size of all values.
+       :param ttl: Default time to live of an entry in seconds.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=30):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry['size']
+
+    def _lookup(self, key):
+        """Return the live entry for key and mark it as recently used.
+        The caller must hold the lock.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry['expires'] <= time.time():
+            self._remove(key)
+            self.expirations += 1
+            return None
+        # Move to the most recently used end
+        del self._entries[key]
+        self._entries[key] = entry
+        return entry
+
+    def get(self, key, default=None):
+        """Return the cached value for key or default."""
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry['value']
+
+    def set(self, key, value, ttl=None, size=None):
+        """Store value under key. Values larger than max_bytes are not
+        stored at all.
+
+        :param size: The size of value in bytes, for values whose size
+                     size_of cannot tell (e.g. objects holding containers).
+        """
+        if ttl is None:
+            ttl = self.ttl
+        if size is None:
+            size = size_of(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = {
+                'value': value,
+                'size': size,
+                'expires': time.time() + ttl
+            }
+            self.size += size
+            while self.size > self.max_bytes:
+                # Pop the least recently used item from the cache
+                _, oldest = self._entries.popitem(last=False)
+                self.size -= oldest['size']
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def get_or_load(self, key, loader, ttl=None):
+        """Return the cached value for key. On a miss, call loader() and
+        cache its result unless it is None. Concurrent misses on the same
+        key wait for the first caller's load instead of loading again.
+
+        :param key: The cache key.
+        :param loader: Function without arguments producing the value.
+        :param ttl: Optional time to live for the new entry.
+        """
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                self.hits += 1
+                return entry['value']
+            flight = self._loading.get(key)
+            if flight is None:
+                self.misses += 1
+                flight = self._loading[key] = _Flight()
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            value = loader()
+            flight.value = value
+            if value is not None:
+                self.set(key, value, ttl)
+            return value
+        except Exception as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._loading[key]
+            flight.event.set()
+
+    def stats(self):
+        """Return a snapshot of the cache counters."""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'coalesced': self.coalesced,
+            }
+
+
+class DiskCache(object):
+
+    """Persistent response cache in an SQLite database. The database can be
+    shared by any number of processes (e.g. mod_wsgi workers) and survives
+    restarts. Bodies are stored zlib-compressed together with their ETag
+    and Last-Modified headers, so that stale entries can be revalidated with
+    a conditional request instead of being downloaded again.
+
+       :param path: The path to the SQLite database file.
+       :param fresh_for: Seconds an entry is served without revalidation.
+       :param max_age: Seconds after which an entry is purged.
+    """
+
+    def __init__(self, path, fresh_for=300, max_age=24 * 60 * 60):
+        self.path = path
+        self.fresh_for = fresh_for
+        self.max_age = max_age
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS responses ('
+                    'key TEXT PRIMARY KEY, body BLOB, etag TEXT, '
+                    'last_modified TEXT, stored REAL)')
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS responses_stored '
+                    'ON responses (stored)')
+        finally:
+            connection.close()
+
+    def _connect(self):
+        # One short-lived connection per operation: safe across threads and
+        # forked processes
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        return connection
+
+    def make_key(self, base_url, method, params):
+        return json.dumps([base_url, method, sorted(params.items())])
+
+    def get(self, base_url, method, params):
+        """Return the cached entry for a request as dictionary with the keys
+        body, etag, last_modified and stored, or None.
+        """
+        key = self.make_key(base_url, method, params)
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                'SELECT body, etag, last_modified, stored FROM responses '
+                'WHERE key = ?', (key,)).fetchone()
+        finally:
+            connection.close()
+        if row is None or time.time() - row[3] > self.max_age:
+            return None
+        return {
+            'body': zlib.decompress(str(row[0])),
+            'etag': row[1],
+            'last_modified': row[2],
+            'stored': row[3]
+        }
+
+    def is_fresh(self, entry):
+        return time.time() - entry['stored'] <= self.fresh_for
+
+    def set(self, base_url, method, params, body, etag=None,
+            last_modified=None):
+        """Store the body of a response and purge outdated entries."""
+        key = self.make_key(base_url, method, params)
+        now = time.time()
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                    (key, sqlite3.Binary(zlib.compress(body)), etag,
+                     last_modified, now))
+                connection.execute('DELETE FROM responses WHERE stored < ?',
+                                   (now - self.max_age,))
+        finally:
+            connection.close()
+
+    def touch(self, base_url, method, params):
+        """Mark an entry as fresh again after a successful revalidation."""
+        key = self.make_key(base_url, method, params)
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'UPDATE responses SET stored = ? WHERE key = ?',
+                    (time.time(), key))
+        finally:
+            connection.close()
+
+
+def memoize(cache, ttl=None, ignore=()):
+    """Donald Michie's memo function for caching, backed by an LRUCache.
+
+    :param cache: The LRUCache instance to store results in.
+    :param ttl: Optional time to live overriding the cache's default.
+    :param ignore: Names of keyword arguments that do not affect the
+                   result and are left out of the cache key.
+    """
+    def _memoize(function):
+        @wraps(function)
+        def __memoize(*args, **kw):
+            key_kw = dict((k, v) for k, v in kw.items() if k not in ignore)
+            key = make_key(function.__name__, args, key_kw)
+            return cache.get_or_load(key, lambda: function(*args, **kw), ttl)
+        return __memoize
+    return _memoize
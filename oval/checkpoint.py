@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+    checkpoint.py
+    ~~~~~~~~~~~~~
+
+    Resumable harvests: after every page, the resumptionToken, the date
+    window, counters and the caller's state (e.g. the aggregates of the
+    record-level checks) are saved to an SQLite database. A harvest that
+    is started again after a crash or restart continues with the last
+    saved token instead of the first page. If the server no longer accepts
+    that token, the harvest continues with a from/until window instead.
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+import json
+import time
+import sqlite3
+import cPickle as pickle
+
+from harvester import OAI, BadResumptionToken
+
+
+class Checkpoint(object):
+
+    """The progress of a harvest after its last complete page.
+
+       :param _from: The start of the date window.
+       :param state: The caller's state (any picklable object).
+    """
+
+    #: Maximum number of identifiers remembered for the last datestamp
+    max_boundary = 10000
+
+    def __init__(self, _from=None, state=None):
+        self._from = _from
+        self.token = None
+        self.state = state
+        self.initial_state = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+        self.count = 0
+        self.deleted = 0
+        self.pages = 0
+        self.fallbacks = 0
+        # Largest datestamp so far and the identifiers carrying it, to skip
+        # records already seen when continuing from that datestamp
+        self.last_datestamp = None
+        self.boundary = set()
+        # Whether the datestamps have come in increasing order so far
+        self.ordered = True
+        self.started = time.time()
+        self.updated = self.started
+
+    def seen(self, identifier, datestamp):
+        """Return True if a record was harvested before a fallback, else
+        remember it.
+        """
+        if datestamp is None:
+            return False
+        if self.last_datestamp is None or datestamp > self.last_datestamp:
+            self.last_datestamp = datestamp
+            self.boundary = set([identifier])
+            return False
+        if datestamp < self.last_datestamp:
+            self.ordered = False
+            return False
+        if identifier in self.boundary:
+            return True
+        if len(self.boundary) < self.max_boundary:
+            self.boundary.add(identifier)
+        return False
+
+    def fall_back(self, _from):
+        """Prepare to continue without a resumptionToken. If the datestamps
+        have been increasing, continue from the last one; otherwise start
+        over from _from with the initial state.
+        """
+        self.fallbacks += 1
+        self.token = None
+        if self.ordered and self.last_datestamp is not None:
+            self._from = self.last_datestamp
+            return
+        self._from = _from
+        self.state = pickle.loads(self.initial_state)
+        self.count = self.deleted = self.pages = 0
+        self.last_datestamp = None
+        self.boundary = set()
+        self.ordered = True
+
+
+class CheckpointStore(object):
+
+    """Checkpoints in an SQLite database, shared by all processes using the
+    same file (see cache.DiskCache).
+
+       :param path: The path to the SQLite database file.
+       :param max_age: Seconds after which an untouched checkpoint is
+                       purged.
+    """
+
+    def __init__(self, path, max_age=7 * 24 * 60 * 60):
+        self.path = path
+        self.max_age = max_age
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS checkpoints ('
+                    'key TEXT PRIMARY KEY, data BLOB, updated REAL)')
+        finally:
+            connection.close()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        return connection
+
+    def load(self, key):
+        """Return the Checkpoint stored for key or None. Checkpoints that
+        cannot be unpickled (e.g. after an upgrade) are ignored.
+        """
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                'SELECT data, updated FROM checkpoints WHERE key = ?',
+                (key,)).fetchone()
+        finally:
+            connection.close()
+        if row is None or time.time() - row[1] > self.max_age:
+            return None
+        try:
+            return pickle.loads(str(row[0]))
+        except Exception:
+            return None
+
+    def save(self, key, checkpoint):
+        now = checkpoint.updated = time.time()
+        data = pickle.dumps(checkpoint, pickle.HIGHEST_PROTOCOL)
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)',
+                    (key, sqlite3.Binary(data), now))
+                connection.execute(
+                    'DELETE FROM checkpoints WHERE updated < ?',
+                    (now - self.max_age,))
+        finally:
+            connection.close()
+
+    def delete(self, key):
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute('DELETE FROM checkpoints WHERE key = ?',
+                                   (key,))
+        finally:
+            connection.close()
+
+
+class ResumableHarvest(object):
+
+    """A harvest through a RecordIterator that saves a Checkpoint after
+    every page and continues from it when run again::
+
+        harvest = ResumableHarvest(base_url, RecordIterator, store)
+        checkpoint = harvest.run(feed, state)
+
+    feed(state, record) is called for every (non-deleted) record element
+    and may return True to end the harvest early. The checkpoint returned
+    (also available as the attribute checkpoint, even if the harvest
+    fails) holds the final state, which is the one restored from the store
+    if an earlier run was interrupted. The stored checkpoint is removed
+    once the harvest is complete.
+
+    After a fallback from a rejected resumptionToken to a date window,
+    records with the last datestamp seen are skipped if they were
+    harvested before; records changed in the meantime may be seen twice.
+
+       :param base_url: The endpoint of the OAI-PMH interface.
+       :param RecordIterator: A RecordIterator class for base_url (see
+                              configure_record_iterator).
+       :param store: The CheckpointStore.
+       :param verb: The OAI-PMH verb.
+       :param metadataPrefix: The OAI-PMH metadataPrefix.
+       :param _from: Optional date offset.
+       :param until: Optional date limit.
+       :param stream: Parse pages while they are downloaded.
+       :param protocol_version: The OAI-PMH version of the repository.
+       :param max_fallbacks: Maximum number of rejected resumptionTokens
+                             before giving up.
+    """
+
+    def __init__(self, base_url, RecordIterator, store, verb='ListRecords',
+                 metadataPrefix='oai_dc', _from=None, until=None,
+                 stream=False, protocol_version='2.0', max_fallbacks=3):
+        self.RecordIterator = RecordIterator
+        self.store = store
+        self.verb = verb
+        self.metadataPrefix = metadataPrefix
+        self._from = _from
+        self.until = until
+        self.stream = stream
+        self.max_fallbacks = max_fallbacks
+        self.checkpoint = None
+        self.key = json.dumps([base_url, verb, metadataPrefix, _from, until])
+        oai = OAI % protocol_version
+        self.header_tag = oai + 'header'
+        self.identifier_tag = oai + 'identifier'
+        self.datestamp_tag = oai + 'datestamp'
+
+    def run(self, feed, state=None):
+        """Harvest all records, continuing an interrupted run if there is a
+        checkpoint. Return the final Checkpoint.
+
+        :param feed: Callable taking the state and a record element.
+        :param state: The initial state, saved with every checkpoint.
+        """
+        checkpoint = self.store.load(self.key)
+        if checkpoint is None:
+            checkpoint = Checkpoint(self._from, state)
+        self.checkpoint = checkpoint
+        while True:
+            try:
+                self._harvest(checkpoint, feed)
+                break
+            except BadResumptionToken:
+                if checkpoint.fallbacks >= self.max_fallbacks:
+                    raise
+                checkpoint.fall_back(self._from)
+                self.store.save(self.key, checkpoint)
+        self.store.delete(self.key)
+        return checkpoint
+
+    def _header(self, record):
+        if record.tag == self.header_tag:
+            return record
+        return record.find(self.header_tag)
+
+    def _harvest(self, checkpoint, feed):
+        riter = self.RecordIterator(self.verb, self.metadataPrefix,
+                                    _from=checkpoint._from, until=self.until,
+                                    deleted=True, stream=self.stream,
+                                    resumptionToken=checkpoint.token)
+        for records in riter.pages():
+            for record in records:
+                header = self._header(record)
+                if header is None:
+                    continue
+                if checkpoint.seen(header.findtext(self.identifier_tag),
+                                   header.findtext(self.datestamp_tag)):
+                    continue
+                if header.get('status') == 'deleted':
+                    checkpoint.deleted += 1
+                    continue
+                checkpoint.count += 1
+                if feed(checkpoint.state, record):
+                    return
+            checkpoint.pages += 1
+            checkpoint.token = riter.token
+            if riter.token is None:
+                return
+            self.store.save(self.key, checkpoint)
@@ -9,6 +9,7 @@
 """
 
 import os
+import threading
 
 this_dir, this_filename = os.path.split(__file__)
 
@@ -17,16 +18,47 @@ __version__ = '0.2.0'
 OAI_PMH_VERSION = '2.0'
 
 
-def compress(_list):
-    _list.remove(_list[0])
-    return [item for item in _list if item != '']
+ISO_639_FILE = os.path.join(DATA_PATH, 'iso-639-3.tab')
 
-iso_639_file = open(os.path.join(DATA_PATH, 'iso-639-3.tab'), 'r')
-ISO_639_3_CODES = compress([line.split('\t')[0] for line in iso_639_file])
-iso_639_file.seek(0)
-ISO_639_2B_CODES = compress([line.split('\t')[1] for line in iso_639_file])
-iso_639_file.seek(0)
-ISO_639_2T_CODES = compress([line.split('\t')[2] for line in iso_639_file])
-iso_639_file.seek(0)
-ISO_639_1_CODES = compress([line.split('\t')[3] for line in iso_639_file])
+# Columns of the code table and the ISO 639 variants they contain
+ISO_639_VARIANTS = ('639-3', '639-2B', '639-2T', '639-1')
 
+_iso_639_index = None
+_iso_639_lock = threading.Lock()
+
+
+def load_iso_639_index(path=ISO_639_FILE):
+    """Read the ISO 639-3 code table in one pass. Return a dictionary
+    mapping every code to the tuple of ISO 639 variants (see
+    ISO_639_VARIANTS, in that order) it belongs to.
+
+    :param path: The path to the tab-separated code table.
+    """
+    index = {}
+    with open(path, 'r') as iso_639_file:
+        iso_639_file.readline()  # Column names
+        for line in iso_639_file:
+            columns = line.split('\t', len(ISO_639_VARIANTS))
+            for variant, code in zip(ISO_639_VARIANTS, columns):
+                if code != '':
+                    index[code] = index.get(code, ()) + (variant,)
+    return index
+
+
+def iso_639_index():
+    """Return the index of ISO 639 codes, loading it on first use."""
+    global _iso_639_index
+    if _iso_639_index is None:
+        with _iso_639_lock:
+            if _iso_639_index is None:
+                _iso_639_index = load_iso_639_index()
+    return _iso_639_index
+
+
+def iso_639_variants(code):
+    """Return the tuple of ISO 639 variants code belongs to (empty if it is
+    no ISO 639 code).
+
+    :param code: A language code, e.g. the content of dc:language.
+    """
+    return iso_639_index().get(code, ())
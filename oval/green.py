@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+    green.py
+    ~~~~~~~~
+
+    Cooperative validation engine: many validations run concurrently on a
+    single gevent event loop instead of one thread each.
+
+    Importing this module monkey-patches the standard library (sockets,
+    threads, locks, sleep) with gevent's cooperative versions, so it has to
+    be imported before anything else in the process::
+
+        from green import validate_many
+
+        for base_url, results, error in validate_many(urls, concurrency=200):
+            ...
+
+    The request layer (fetch_data, configure_request, RecordIterator) and
+    the checks are the ones of the harvester and validator modules; under
+    gevent every network wait yields to the other validations.
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+try:
+    import gevent
+    from gevent import monkey
+    from gevent.pool import Pool
+except ImportError:
+    gevent = None
+else:
+    monkey.patch_all()
+
+from validator import Validator, run_checks
+
+
+def _require_gevent():
+    if gevent is None:
+        raise RuntimeError('The green validation engine requires gevent.')
+
+
+class AsyncValidator(object):
+
+    """Validator running the standard checks (see schedule_checks) in a
+    greenlet. The validation starts immediately; results has the same
+    format as Validator.results and fills up while the checks run::
+
+        validators = [AsyncValidator(url) for url in urls]
+        gevent.joinall([v.greenlet for v in validators])
+
+    :param base_url: The OAI-PMH endpoint of the validated repository.
+    :param timeout: Optional timeout in seconds for all requests to the server.
+    :param max_workers: Maximum number of checks running at the same time.
+    """
+
+    def __init__(self, base_url, timeout=10, max_workers=4):
+        _require_gevent()
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.validator = None
+        self.greenlet = gevent.spawn(self._run)
+
+    def _run(self):
+        self.validator = Validator(self.base_url, timeout=self.timeout)
+        run_checks(self.validator, max_workers=self.max_workers)
+        return self.validator
+
+    @property
+    def results(self):
+        if self.validator is None:
+            return {}
+        return self.validator.results
+
+    def ready(self):
+        return self.greenlet.ready()
+
+    def join(self, timeout=None):
+        """Wait until the validation is finished. Return the Validator or
+        raise the exception that ended the validation.
+        """
+        return self.greenlet.get(timeout=timeout)
+
+
+def validate_many(base_urls, concurrency=100, timeout=40, max_workers=4):
+    """Validate repositories concurrently on the event loop. Yield a tuple
+    (base_url, results, error) for every repository as soon as its
+    validation is finished; error is None or the message of the exception
+    that ended the validation.
+
+    :param base_urls: Iterable of OAI-PMH endpoints.
+    :param concurrency: Maximum number of validations running at once.
+    :param timeout: Timeout in seconds for all requests to the servers.
+    :param max_workers: Maximum number of concurrent checks per validation.
+    """
+    _require_gevent()
+
+    def validate(base_url):
+        validator = AsyncValidator(base_url, timeout, max_workers)
+        try:
+            validator.join()
+        except Exception as exc:
+            return base_url, validator.results, unicode(exc)
+        return base_url, validator.results, None
+
+    pool = Pool(concurrency)
+    for result in pool.imap_unordered(validate, base_urls):
+        yield result
@@ -14,59 +14,102 @@ OAI = '{http://www.openarchives.org/OAI/%s/}'
 DC_NAMESPACE = "http://purl.org/dc/elements/1.1/"
 DC = '{%s}' % DC_NAMESPACE
 
+# Identify fields extracted by parse_identify
+IDENTIFY_FIELDS = ('protocolVersion', 'granularity', 'repositoryName',
+                   'adminEmail', 'earliestDatestamp', 'deletedRecord')
 
+
+import re
 import time
-from time import sleep
 import hashlib
-import pickle
-import re
+import threading
 
-import urllib2
-from urllib2 import URLError, Request
+from urllib2 import URLError
 from urllib import urlencode
 
-from functools import wraps
-
-from ordereddict import OrderedDict
 from lxml import etree
 
+from cache import LRUCache, DiskCache, memoize
+from retry import DEFAULT_POLICY, wait, parse_retry_after
+from ratelimit import HostLimiter, SharedHostLimiter
+from transport import urlopen, ResponseTooLarge
+
+
+# Response cache shared by all threads of the process: bounded by the total
+# size of the cached bodies, entries expire after CACHE.ttl seconds.
+# Counters are available via CACHE.stats().
+CACHE = LRUCache(max_bytes=64 * 1024 * 1024, ttl=30)
+
+# Upper bound for the size of a single response body in bytes
+MAX_BODY_SIZE = 256 * 1024 * 1024
+
+# Optional on-disk cache (a cache.DiskCache) shared by all processes; set
+# with enable_disk_cache.
+DISK_CACHE = None
+
+# Per-host rate limiter (a ratelimit.HostLimiter) for all requests of
+# fetch_data and RecordStream; None disables it (see enable_rate_limit)
+LIMITER = HostLimiter()
+
+IDENTIFY_PATTERNS = dict(
+    (name, re.compile(r'<%s>(.*?)</%s>' % (name, name)))
+    for name in IDENTIFY_FIELDS)
+
+
+class BadResumptionToken(Exception):
 
-CACHE = OrderedDict()
+    """Raised by RecordIterator if the server rejects a resumptionToken,
+    typically because it has expired.
 
-# Caching
+    :param token: The rejected resumptionToken.
+    """
+
+    def __init__(self, token):
+        Exception.__init__(self, 'Server rejected resumptionToken: %s' % token)
+        self.token = token
+
+
+def enable_disk_cache(path, **kw):
+    """Let fetch_data keep responses in an SQLite database at path, shared
+    by all processes using the same file. Keyword arguments are passed on
+    to DiskCache.
+
+    :param path: The path to the SQLite database file.
+    """
+    global DISK_CACHE
+    DISK_CACHE = DiskCache(path, **kw)
+    return DISK_CACHE
 
 
-def is_obsolete(entry, duration):
-    return time.time() - entry['time'] > duration
+def enable_rate_limit(path=None, **kw):
+    """Replace the per-host rate limiter of fetch_data. With a path, the
+    limits are kept in an SQLite database and shared by all processes using
+    the same file. Keyword arguments are passed on to HostLimiter.
 
+    :param path: Optional path to the SQLite database file.
+    """
+    global LIMITER
+    if path is None:
+        LIMITER = HostLimiter(**kw)
+    else:
+        LIMITER = SharedHostLimiter(path, **kw)
+    return LIMITER
 
-def compute_key(function, args, kw):
-    key = pickle.dumps((function.func_name, args, kw))
-    return hashlib.sha1(key).hexdigest()
 
+def report_response(limiter, url, error=None):
+    """Tell limiter (if any) how the server of url answered a request.
 
-def memoize(duration=30, max_length=10):
-    """Donald Michie's memo function for caching."""
-    def _memoize(function):
-        @wraps(function)
-        def __memoize(*args, **kw):
-            key = compute_key(function, args, kw)
-            if len(CACHE) > max_length:
-                # Pop the oldest item from the cache
-                CACHE.popitem(last=False)
-            # do we have a response for the request?
-            if (key in CACHE and
-                    not is_obsolete(CACHE[key], duration)):
-                return CACHE[key]['value']
-            # new request
-            result = function(*args, **kw)
-            CACHE[key] = {
-                'value': result,
-                'time': time.time()
-            }
-            return result
-        return __memoize
-    return _memoize
+    :param limiter: The HostLimiter or None.
+    :param url: The URL of the request.
+    :param error: The HTTPError raised by the request or None.
+    """
+    if limiter is None:
+        return
+    code = getattr(error, 'code', 200)
+    retry_after = None
+    if error is not None and getattr(error, 'hdrs', None) is not None:
+        retry_after = parse_retry_after(error.hdrs.get('Retry-After'))
+    limiter.feedback(url, code, retry_after)
 
 
 def normalize_params(params):
@@ -91,6 +134,10 @@ def normalize_params(params):
             del params['until']
         except KeyError:
             pass
+        try:
+            del params['set']
+        except KeyError:
+            pass
     # from is a reserved word in Python; use _from instead
     if params.get("_from") is not None:
         params['from'] = params['_from']
@@ -102,108 +149,450 @@ def normalize_params(params):
     return nparams
 
 
-@memoize()
-def fetch_data(base_url, method, params, retries=5, timeout=None):
+@memoize(CACHE, ignore=('budget', 'timer'))
+def fetch_data(base_url, method, params, policy=None, timeout=None,
+               budget=None, timer=None):
     """Perform actual request to the OAI interface and return the data
-    as XML string.
+    as XML string. Responses with status code 503 are retried according
+    to the retry policy.
 
        :param base_url: The endpoint of the OAI-PMH interface.
        :param method: The HTTP method to be used for the requests.
        :param params: The GET/POST variables.
-       :param retries: How many retries should be performed on responses
-                       with status code 503.
+       :param policy: The RetryPolicy (defaults to retry.DEFAULT_POLICY).
        :param timeout: The timeout in seconds for the requests.
+       :param budget: Optional RetryBudget of the validation limiting the
+                      total time spent waiting for retries.
+       :param timer: Optional metrics.RequestTimer told where the response
+                     came from and how often the request was retried.
     """
+    if policy is None:
+        policy = DEFAULT_POLICY
     data = urlencode(params)
     if method == 'POST':
-        request = Request(base_url)
-        request.add_data(data)
+        url = base_url
     elif method == 'GET':
-        request = Request(base_url + data)
-    request.add_header('User-Agent', 'oval')
-    for _ in range(retries):
+        url = base_url + data
+        data = None
+    headers = {'User-Agent': 'oval'}
+    disk_cache = DISK_CACHE
+    cached = None
+    if disk_cache is not None:
+        cached = disk_cache.get(base_url, method, params)
+        if cached is not None:
+            if disk_cache.is_fresh(cached):
+                if timer is not None:
+                    timer.source = 'disk'
+                return cached['body']
+            # Revalidate if the repository supports conditional requests
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+    limiter = LIMITER
+    attempt = 0
+    if timer is not None:
+        timer.source = 'network'
+    while True:
+        if timer is not None:
+            timer.retries = attempt
+        if limiter is not None:
+            limiter.wait(base_url)
         try:
-            response = urllib2.urlopen(request, None, timeout=timeout)
-            return response.read()
+            response = urlopen(url, data, headers, timeout=timeout,
+                               max_bytes=MAX_BODY_SIZE)
+            report_response(limiter, base_url)
+            body = response.read()
+            if disk_cache is not None:
+                response_headers = response.info()
+                disk_cache.set(base_url, method, params, body,
+                               response_headers.get('ETag'),
+                               response_headers.get('Last-Modified'))
+            return body
         except URLError as e:
-            if hasattr(e, 'reason'):
+            if hasattr(e, 'code'):
+                report_response(limiter, base_url, e)
+            if getattr(e, 'code', None) == 304 and cached is not None:
+                disk_cache.touch(base_url, method, params)
+                if timer is not None:
+                    timer.source = 'revalidated'
+                return cached['body']
+            delay = policy.should_retry(e, attempt, budget)
+            if delay is None:
                 raise
-            elif hasattr(e, 'code'):
-                if e.code == 503:
-                    try:
-                        wait_time = int(e.hdrs.get('Retry-After'))
-                    except TypeError:
-                        wait_time = None
-                    if wait_time is None:
-                        sleep(100)
-                    else:
-                        sleep(wait_time)
-                else:
-                    raise
-        except Exception:
-            raise
+            wait(delay)
+            attempt += 1
+
+
+def request_data(base_url, method, params, timeout=None, budget=None,
+                 metrics=None):
+    """Call fetch_data and record the request in metrics.
+
+       :param base_url: The endpoint of the OAI-PMH interface.
+       :param method: The HTTP method to be used for the requests.
+       :param params: The normalized GET/POST variables.
+       :param timeout: The timeout in seconds for the requests.
+       :param budget: Optional RetryBudget (see fetch_data).
+       :param metrics: Optional metrics.ValidationMetrics.
+    """
+    if metrics is None:
+        return fetch_data(base_url, method, params, timeout=timeout,
+                          budget=budget)
+    timer = metrics.request(params.get('verb'))
+    response = ''
+    try:
+        response = fetch_data(base_url, method, params, timeout=timeout,
+                              budget=budget, timer=timer)
+    finally:
+        timer.finish(response)
+    return response
+
 
+def parse_response(response, verb=None, metrics=None):
+    """Parse an OAI-PMH response and record the time taken in metrics.
 
-def configure_request(base_url, method='POST', timeout=None):
+       :param response: The response as XML string.
+       :param verb: The OAI-PMH verb of the request.
+       :param metrics: Optional metrics.ValidationMetrics.
+    """
+    if metrics is None:
+        return etree.XML(response)
+    start = time.time()
+    try:
+        return etree.XML(response)
+    finally:
+        metrics.record_parse(verb, time.time() - start)
+
+
+class RecordStream(object):
+
+    """Iterate over the record (or header) elements of a single
+    ListRecords (or ListIdentifiers) response while it is being downloaded.
+    The body is fed to lxml's incremental parser chunk by chunk; every
+    element is detached from the page tree before it is yielded, so it is
+    freed as soon as the caller drops it. The resumptionToken is available
+    in the attribute token once the iteration is complete. The request is
+    sent on instantiation.
+
+       :param base_url: The endpoint of the OAI-PMH interface.
+       :param method: The HTTP method to be used for the request.
+       :param params: The normalized OAI-PMH parameters.
+       :param oai_namespace: The OAI namespace in Clark notation.
+       :param timeout: The timeout in seconds for the request.
+       :param max_bytes: Maximum size of the response body (defaults to
+                         MAX_BODY_SIZE).
+       :param chunk_size: The number of bytes read from the socket at once.
+       :param policy: The RetryPolicy for 503 responses (defaults to
+                      retry.DEFAULT_POLICY).
+       :param budget: Optional RetryBudget (see fetch_data).
+       :param metrics: Optional metrics.ValidationMetrics. The request,
+                       the bytes read, the time spent parsing and the page
+                       are recorded once the stream is closed; the time
+                       the caller spends between records is left out.
+    """
+
+    def __init__(self, base_url, method, params, oai_namespace, timeout=None,
+                 max_bytes=None, chunk_size=64 * 1024, policy=None,
+                 budget=None, metrics=None):
+        if params.get('verb') == 'ListIdentifiers':
+            self.tag = oai_namespace + 'header'
+        else:
+            self.tag = oai_namespace + 'record'
+        self.token_tag = oai_namespace + 'resumptionToken'
+        self.error_tag = oai_namespace + 'error'
+        self.token = None
+        # The code of an OAI-PMH error in the response, if any
+        self.error = None
+        self.chunk_size = chunk_size
+        self.verb = params.get('verb')
+        self.metrics = metrics
+        self.parse_time = 0.0
+        # Time spent opening, reading and parsing the page
+        self.busy_time = 0.0
+        started = time.time()
+        self.timer = None
+        if metrics is not None:
+            self.timer = metrics.request(self.verb)
+            # Streamed pages bypass the caches
+            self.timer.source = 'network'
+        self.response = None
+        data = urlencode(params)
+        if method == 'POST':
+            url = base_url
+        elif method == 'GET':
+            url = base_url + data
+            data = None
+        if max_bytes is None:
+            max_bytes = MAX_BODY_SIZE
+        if policy is None:
+            policy = DEFAULT_POLICY
+        limiter = LIMITER
+        attempt = 0
+        while True:
+            if self.timer is not None:
+                self.timer.retries = attempt
+            if limiter is not None:
+                limiter.wait(base_url)
+            try:
+                self.response = urlopen(url, data, {'User-Agent': 'oval'},
+                                        timeout=timeout, max_bytes=max_bytes,
+                                        stream=True)
+                break
+            except URLError as e:
+                if hasattr(e, 'code'):
+                    report_response(limiter, base_url, e)
+                delay = policy.should_retry(e, attempt, budget)
+                if delay is None:
+                    self.busy_time += time.time() - started
+                    self._record()
+                    raise
+                wait(delay)
+                attempt += 1
+        report_response(limiter, base_url)
+        self.busy_time += time.time() - started
+
+    def _record(self):
+        """Record the request and the page in metrics (once)."""
+        timer, self.timer = self.timer, None
+        if timer is None:
+            return
+        size = 0
+        if self.response is not None:
+            size = self.response.bytes_read
+        timer.finish(None, size, self.busy_time)
+        if self.response is not None:
+            self.metrics.record_parse(self.verb, self.parse_time)
+            self.metrics.record_page(self.verb, self.busy_time)
+
+    def __iter__(self):
+        parser = etree.XMLPullParser(events=('end',))
+        try:
+            while True:
+                start = time.time()
+                chunk = self.response.read(self.chunk_size)
+                if not chunk:
+                    self.busy_time += time.time() - start
+                    break
+                parsing = time.time()
+                parser.feed(chunk)
+                self.parse_time += time.time() - parsing
+                self.busy_time += time.time() - start
+                for element in self._read_events(parser):
+                    yield element
+            start = time.time()
+            parser.close()
+            self.parse_time += time.time() - start
+            self.busy_time += time.time() - start
+            for element in self._read_events(parser):
+                yield element
+        finally:
+            self.response.close()
+            self._record()
+
+    def _read_events(self, parser):
+        for _, element in parser.read_events():
+            if element.tag == self.tag:
+                element.getparent().remove(element)
+                yield element
+            elif element.tag == self.token_tag:
+                self.token = element.text
+            elif element.tag == self.error_tag:
+                self.error = element.get('code')
+
+
+def configure_request(base_url, method='POST', timeout=None, budget=None,
+                      metrics=None):
     """Closure to preconfigure the static request params. Return
     custom request_oai function.
 
     :param base_url: The endpoint of the OAI-PMH interface.
     :param method: The HTTP method to be used for the requests.
     :param timeout: The timeout in seconds for the requests.
+    :param budget: Optional RetryBudget for the requests (see fetch_data).
+    :param metrics: Optional metrics.ValidationMetrics for the requests.
     """
     def request_oai(**kw):
         """Perform OAI request to base_url. Return parsed response."""
         params = kw
         params = normalize_params(params)
-        response = fetch_data(base_url, method, params, timeout=timeout)
-        return etree.XML(response)
+        response = request_data(base_url, method, params, timeout=timeout,
+                                budget=budget, metrics=metrics)
+        return parse_response(response, params.get('verb'), metrics)
     return request_oai
 
 
-def get_protocol_version(base_url, method):
-    """Determine the version of the OAI-PMH spoken by the server.
+def parse_identify(response):
+    """Extract the fields OVAL needs from a raw Identify response. Return a
+    dictionary mapping each name in IDENTIFY_FIELDS to its (first) value or
+    None.
 
-    :param base_url: The URL of the OAI-PMH endpoint.
-    :param method: The HTTP method for requests to the endpoint.
+    :param response: The Identify response as XML string.
+    """
+    fields = {}
+    for name, pattern in IDENTIFY_PATTERNS.items():
+        m = pattern.search(response)
+        if m is None:
+            fields[name] = None
+        else:
+            fields[name] = m.group(1).decode('utf8', 'replace')
+    return fields
+
+
+def identify_fingerprint(response):
+    """Return a fingerprint (SHA-1 hex digest) of the Identify element of
+    a raw Identify response, or None if there is none. Unlike the response
+    itself, the fingerprint does not change with every responseDate.
+
+    :param response: The Identify response as XML string.
     """
-    pversion_re = re.compile(r'<protocolVersion>(.*?)</protocolVersion>')
     try:
-        response = fetch_data(base_url, method, {'verb': 'Identify'})
-    except Exception:
+        tree = etree.XML(response)
+    except etree.XMLSyntaxError:
         return None
-    m = pversion_re.search(response)
-    if m is not None:
-        version = m.group(1)
-        return version
+    identify = tree.find('{*}Identify')
+    if identify is None:
+        return None
+    return hashlib.sha1(etree.tostring(identify, method='c14n')).hexdigest()
 
 
-def get_granularity(base_url, method):
-    granularity_re = re.compile(r'<granularity>(.*?)</granularity>')
-    try:
-        response = fetch_data(base_url, method, {'verb': 'Identify'})
-    except Exception:
-        return None
-    m = granularity_re.search(response)
-    if m is not None:
-        granularity = m.group(1)
+class ResponseStore(object):
+
+    """Per-validation store of OAI-PMH responses. Every response is fetched
+    and parsed at most once; all checks of a validation run share the raw
+    string, the parsed tree and the extracted Identify fields. Failures are
+    stored as well and raised again on every access. The store may be used
+    from several threads; each request is still performed only once.
+
+       :param base_url: The endpoint of the OAI-PMH interface.
+       :param method: The default HTTP method for requests.
+       :param timeout: The timeout in seconds for the requests.
+       :param budget: Optional RetryBudget for the requests (see fetch_data).
+       :param metrics: Optional metrics.ValidationMetrics for the requests.
+    """
+
+    def __init__(self, base_url, method='POST', timeout=None, budget=None,
+                 metrics=None):
+        self.base_url = base_url
+        self.method = method
+        self.timeout = timeout
+        self.budget = budget
+        self.metrics = metrics
+        self._raw = {}
+        self._trees = {}
+        self._identify = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _key(self, method, params):
+        return (method or self.method, tuple(sorted(params.items())))
+
+    def _key_lock(self, key):
+        with self._lock:
+            if key not in self._locks:
+                self._locks[key] = threading.RLock()
+            return self._locks[key]
+
+    def raw(self, method=None, **kw):
+        """Return the raw response for the OAI-PMH request given by the
+        keyword arguments.
+        """
+        params = normalize_params(kw)
+        key = self._key(method, params)
+        with self._key_lock(key):
+            if key not in self._raw:
+                try:
+                    self._raw[key] = request_data(self.base_url, key[0],
+                                                  params, self.timeout,
+                                                  self.budget, self.metrics)
+                except Exception as exc:
+                    self._raw[key] = exc
+        response = self._raw[key]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def tree(self, method=None, **kw):
+        """Return the parsed response for the OAI-PMH request given by the
+        keyword arguments.
+        """
+        params = normalize_params(kw)
+        key = self._key(method, params)
+        with self._key_lock(key):
+            if key not in self._trees:
+                response = self.raw(method, **params)
+                try:
+                    self._trees[key] = parse_response(
+                        response, params.get('verb'), self.metrics)
+                except etree.XMLSyntaxError as exc:
+                    self._trees[key] = exc
+                else:
+                    # Only the raw Identify is needed besides its tree
+                    if params.get('verb') != 'Identify':
+                        del self._raw[key]
+        tree = self._trees[key]
+        if isinstance(tree, Exception):
+            raise tree
+        return tree
+
+    # Drop-in replacement for the request_oai function of configure_request
+    __call__ = tree
+
+    def identify(self, method=None):
+        """Return the fields of the Identify response (see parse_identify) or
+        None if it could not be fetched.
+        """
+        method = method or self.method
+        with self._key_lock(('Identify', method)):
+            if method not in self._identify:
+                try:
+                    response = self.raw(method, verb='Identify')
+                except Exception:
+                    self._identify[method] = None
+                else:
+                    self._identify[method] = parse_identify(response)
+        return self._identify[method]
+
+
+def get_protocol_version(base_url, method, responses=None):
+    """Determine the version of the OAI-PMH spoken by the server.
+
+    :param base_url: The URL of the OAI-PMH endpoint.
+    :param method: The HTTP method for requests to the endpoint.
+    :param responses: Optional ResponseStore to take the Identify from.
+    """
+    if responses is None:
+        responses = ResponseStore(base_url, method)
+    fields = responses.identify(method)
+    if fields is not None:
+        return fields['protocolVersion']
+
+
+def get_granularity(base_url, method, responses=None):
+    if responses is None:
+        responses = ResponseStore(base_url, method)
+    fields = responses.identify(method)
+    if fields is not None:
+        granularity = fields['granularity']
         if granularity == 'YYYY-MM-DDThh:mm:ssZ':
             return 'full'
         elif granularity == 'YYYY-MM-DD':
             return 'day'
 
 
-def check_HTTP_methods(base_url):
+def check_HTTP_methods(base_url, responses=None):
     """Determine the HTTP methods supported by the server. Return supported
     methods in list or [].
 
     :param base_url: The endpoint of the OAI-PMH interface.
+    :param responses: Optional ResponseStore to take the Identify from.
     """
+    if responses is None:
+        responses = ResponseStore(base_url)
     methods = []
     for method in ['GET', 'POST']:
         response = None
         try:
-            response = fetch_data(base_url, method, {'verb': 'Identify'})
+            response = responses.raw(method, verb='Identify')
         except Exception:
             pass
         if response and not "badVerb" in response:
@@ -211,34 +600,35 @@ def check_HTTP_methods(base_url):
     return methods
 
 
-def get_repository_information(base_url, method):
-    name_re = re.compile(r'<repositoryName>(.*?)</repositoryName>')
-    email_re = re.compile(r'<adminEmail>(.*?)</adminEmail>')
-    try:
-        response = fetch_data(base_url, method, {'verb': 'Identify'})
-    except Exception:
+def get_repository_information(base_url, method, responses=None):
+    if responses is None:
+        responses = ResponseStore(base_url, method)
+    fields = responses.identify(method)
+    if fields is None:
         return ('[ERROR: Could not fetch Identify response]',
                 '[ERROR: Could not fetch Identify response]')
-    name_match = name_re.search(response)
-    if name_match is None:
+    name = fields['repositoryName']
+    if name is None:
         name = '[Could not find name in Identify.]'
-    else:
-        name = name_match.group(1).decode('utf8')
-    email_match = email_re.search(response)
-    if email_match is None:
+    email = fields['adminEmail']
+    if email is None:
         email = '[Could not find email in Identify.]'
-    else:
-        email = email_match.group(1).decode('utf8')
     return name, email
 
 
-def configure_record_iterator(base_url, protocol_version, HTTPmethod, timeout=None):
+def configure_record_iterator(base_url, protocol_version, HTTPmethod, timeout=None,
+                              responses=None, budget=None, metrics=None):
     """Class factory for record iterators.
 
        :param base_url: The endpoint of the OAI-PMH interface.
        :param protocol_version: The version of the OAI-PMH interface.
        :param HTTPmethod: The HTTP method supported by the server.
        :param timeout: Optional timeout for the HTTP requests sent to the server.
+       :param responses: Optional ResponseStore that serves the initial
+                         request of every iterator.
+       :param budget: Optional RetryBudget for the requests (see fetch_data).
+       :param metrics: Optional metrics.ValidationMetrics for the requests
+                       and harvested pages.
     """
     class RecordIterator(object):
 
@@ -251,37 +641,60 @@ def configure_record_iterator(base_url, protocol_version, HTTPmethod, timeout=No
            :param until: Optional date limit.
            :param deleted: Flag specifiying whether deleted records should be
                            included
+           :param stream: Parse every page incrementally while it is
+                          downloaded (see RecordStream) instead of parsing
+                          complete pages. Records are then returned in
+                          document order, record_list stays empty and token
+                          refers to the page being read.
+           :param resumptionToken: Optional token to continue an earlier
+                                   harvest with; BadResumptionToken is
+                                   raised if the server rejects it.
+           :param setSpec: Optional set to harvest selectively.
         """
         def __init__(self, verb, metadataPrefix, _from=None, until=None,
-                     deleted=False):
+                     deleted=False, stream=False, resumptionToken=None,
+                     setSpec=None):
             self.base_url = base_url
             self.verb = verb
             self.metadataPrefix = metadataPrefix
             self._from = _from
             self.until = until
+            self.setSpec = setSpec
             self.deleted = deleted  # include deleted records?
             self.protocol_version = protocol_version
             self.HTTPmethod = HTTPmethod
             self.timeout = timeout
+            self.stream = stream
 
             # OAI namespace
             self.oai_namespace = OAI % self.protocol_version
             # record list
             self.record_list = []
             # resumptionToken
-            self.token = None
+            self.token = resumptionToken
             if self.verb == 'ListRecords':
                 self.element = 'record'
             elif self.verb == 'ListIdentifiers':
                 self.element = 'header'
             # Configure request method
             self.request_oai = configure_request(
-                self.base_url, self.HTTPmethod, self.timeout)
+                self.base_url, self.HTTPmethod, self.timeout, budget, metrics)
+            if self.stream:
+                # Open the initial portion
+                self.page = self._open_page()
+                self._page_records = iter(self.page)
+                return
             # Fetch the initial portion
-            response = self.request_oai(verb=self.verb,
-                                        metadataPrefix=self.metadataPrefix,
-                                        _from=self._from, until=self.until,
-                                        resumptionToken=self.token)
+            if responses is not None and self.token is None:
+                initial_request = responses
+            else:
+                initial_request = self.request_oai
+            response = initial_request(verb=self.verb,
+                                       metadataPrefix=self.metadataPrefix,
+                                       _from=self._from, until=self.until,
+                                       set=self.setSpec,
+                                       resumptionToken=self.token)
+            self._check_error(response)
             self.record_list = self._get_records(response)
             self.token = self._get_resumption_token(response)
 
@@ -290,7 +703,7 @@ def configure_record_iterator(base_url, protocol_version, HTTPmethod, timeout=No
 
         def _is_not_deleted(self, record):
             if self.element == 'record':
-                header = record.find('.//' + self.oai_namespace + 'header')
+                header = record.find(self.oai_namespace + 'header')
             elif self.element == 'header':
                 header = record  # work on header element directly in case of ListId
             if header.attrib.get('status') == 'deleted':
@@ -298,6 +711,12 @@ def configure_record_iterator(base_url, protocol_version, HTTPmethod, timeout=No
             else:
                 return True
 
+        def _check_error(self, xml_tree):
+            error = xml_tree.find(self.oai_namespace + 'error')
+            if (error is not None and
+                    error.get('code') == 'badResumptionToken'):
+                raise BadResumptionToken(self.token)
+
         def _get_resumption_token(self, xml_tree):
             token = xml_tree.find(
                 './/' + self.oai_namespace + 'resumptionToken')
@@ -313,18 +732,86 @@ def configure_record_iterator(base_url, protocol_version, HTTPmethod, timeout=No
                 records = filter(self._is_not_deleted, records)
             return records
 
+        def _open_page(self):
+            params = normalize_params(dict(verb=self.verb,
+                                           metadataPrefix=self.metadataPrefix,
+                                           _from=self._from, until=self.until,
+                                           set=self.setSpec,
+                                           resumptionToken=self.token))
+            return RecordStream(self.base_url, self.HTTPmethod, params,
+                                self.oai_namespace, timeout=self.timeout,
+                                budget=budget, metrics=metrics)
+
+        def _next_streamed(self):
+            while True:
+                if self._page_records is None:
+                    raise StopIteration
+                try:
+                    record = self._page_records.next()
+                except StopIteration:
+                    if self.page.error == 'badResumptionToken':
+                        self._page_records = None
+                        raise BadResumptionToken(self.token)
+                    self.token = self.page.token
+                    if self.token is None:
+                        self._page_records = None
+                        raise
+                    self.page = self._open_page()
+                    self._page_records = iter(self.page)
+                    continue
+                if self.deleted or self._is_not_deleted(record):
+                    return record
+
+        def _fetch_page(self):
+            start = time.time()
+            response = self.request_oai(verb=self.verb,
+                                        metadataPrefix=self.metadataPrefix,
+                                        _from=self._from, until=self.until,
+                                        set=self.setSpec,
+                                        resumptionToken=self.token)
+            self._check_error(response)
+            self.record_list = self._get_records(response)
+            self.token = self._get_resumption_token(response)
+            if metrics is not None:
+                metrics.record_page(self.verb, time.time() - start)
+
         def _next_batch(self):
             while self.record_list == []:
-                response = self.request_oai(verb=self.verb,
-                                            metadataPrefix=self.metadataPrefix,
-                                            _from=self._from, until=self.until,
-                                            resumptionToken=self.token)
-                self.record_list = self._get_records(response)
-                self.token = self._get_resumption_token(response)
+                self._fetch_page()
                 if self.record_list == [] and self.token is None:
                     raise StopIteration
 
+        def _stream_page(self, page):
+            for record in page:
+                if self.deleted or self._is_not_deleted(record):
+                    yield record
+            if page.error == 'badResumptionToken':
+                raise BadResumptionToken(self.token)
+            self.token = page.token
+
+        def pages(self):
+            """Iterate over the list page by page, yielding the records of
+            each page (in document order). Every page must be consumed
+            before the next one is requested; token is then the
+            resumptionToken of the next page (None after the last page).
+            Not to be mixed with iterating over records.
+            """
+            while True:
+                if self.stream:
+                    records = self._stream_page(self.page)
+                else:
+                    records, self.record_list = self.record_list, []
+                yield records
+                if self.token is None:
+                    return
+                if self.stream:
+                    self.page = self._open_page()
+                else:
+                    self._fetch_page()
+
         def next(self):
+            if self.stream:
+                return self._next_streamed()
             if (len(self.record_list) == 0 and self.token is None):
                 raise StopIteration
             elif len(self.record_list) == 0:
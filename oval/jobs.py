@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+    jobs.py
+    ~~~~~~~
+
+    Background jobs for the web application: validations are queued to a
+    bounded pool of worker threads and looked up by job ID while they run.
+
+    Jobs live in the memory of the process that accepted them, so the web
+    application has to run in a single process (e.g. mod_wsgi daemon mode
+    with processes=1 and several threads).
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+import math
+import time
+import uuid
+import threading
+from Queue import Queue
+
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+class QueueFull(Exception):
+
+    """Raised if a job cannot be accepted because too many jobs are
+    waiting.
+
+    :param retry_after: Estimated number of seconds until a job can be
+                        accepted again.
+    """
+
+    def __init__(self, retry_after):
+        Exception.__init__(self, 'Too many pending validations; retry in %d '
+                           'seconds.' % retry_after)
+        self.retry_after = retry_after
+
+
+class Job(object):
+
+    """A call of the runner's function with args. result holds the return
+    value once state is DONE, error the exception once it is FAILED.
+    """
+
+    def __init__(self, args):
+        self.id = uuid.uuid4().hex
+        self.args = args
+        self.state = QUEUED
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    @property
+    def done(self):
+        return self.state in (DONE, FAILED)
+
+
+class JobStore(object):
+
+    """Jobs by ID. Finished jobs are dropped ttl seconds after they have
+    finished.
+
+    :param ttl: Time in seconds finished jobs are kept.
+    """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def add(self, job):
+        with self._lock:
+            self._purge()
+            self._jobs[job.id] = job
+
+    def get(self, job_id):
+        """Return the job with job_id or None."""
+        with self._lock:
+            self._purge()
+            return self._jobs.get(job_id)
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def _purge(self):
+        expired = time.time() - self.ttl
+        for job_id, job in self._jobs.items():
+            if job.finished is not None and job.finished < expired:
+                del self._jobs[job_id]
+
+
+class JobRunner(object):
+
+    """Run function in a pool of worker threads. Jobs that cannot start
+    right away wait in a queue of at most max_queued jobs; further
+    submissions are rejected with QueueFull::
+
+        runner = JobRunner(validate_repository, workers=4, max_queued=20)
+        job = runner.submit('http://pub.uni-bielefeld.de/oai')
+        ...
+        job = runner.store.get(job.id)
+
+    :param function: The callable run by the jobs.
+    :param workers: Number of jobs running at the same time.
+    :param max_queued: Maximum number of jobs waiting for a worker.
+    :param store: The JobStore for submitted jobs (default: a new one).
+    """
+
+    #: Assumed duration of a job in seconds until one has finished
+    default_duration = 30
+
+    def __init__(self, function, workers=4, max_queued=20, store=None):
+        self.function = function
+        self.workers = workers
+        self.max_queued = max_queued
+        self.store = store if store is not None else JobStore()
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._queued = 0
+        self._duration = None
+
+    def submit(self, *args):
+        """Queue a job calling function with args and return it. Raise
+        QueueFull if max_queued jobs are already waiting.
+        """
+        with self._lock:
+            if self._queued >= self.max_queued:
+                raise QueueFull(self.retry_after())
+            self._queued += 1
+            self._start_workers()
+        job = Job(args)
+        self.store.add(job)
+        self._queue.put(job)
+        return job
+
+    def retry_after(self):
+        """Estimate the number of seconds until a queued job starts."""
+        duration = self._duration or self.default_duration
+        waiting = max(self._queued, 1)
+        return int(math.ceil(duration * waiting / float(self.workers)))
+
+    def _start_workers(self):
+        # Threads are started on first use, i.e. after a WSGI server has
+        # forked its worker processes.
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            with self._lock:
+                self._queued -= 1
+            job.started = time.time()
+            job.state = RUNNING
+            try:
+                job.result = self.function(*job.args)
+                job.state = DONE
+            except Exception as exc:
+                job.error = exc
+                job.state = FAILED
+            job.finished = time.time()
+            self._record_duration(job.finished - job.started)
+
+    def _record_duration(self, duration):
+        # Exponential moving average of the job durations
+        with self._lock:
+            if self._duration is None:
+                self._duration = duration
+            else:
+                self._duration = 0.8 * self._duration + 0.2 * duration
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+    metrics.py
+    ~~~~~~~~~~
+
+    Instrumentation of validations: timings of checks, requests, parsing
+    and harvested pages, downloaded bytes, cache use and retries. Every
+    Validator keeps a summary of its own validation (Validator.metrics);
+    all validations of the process are aggregated into histograms and
+    counters that can be exported in the Prometheus text format.
+
+    Labels are limited to check names, OAI-PMH verbs and cache sources, so
+    the number of series stays small; per-repository figures are in the
+    validation summaries.
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+import time
+import threading
+
+from ordereddict import OrderedDict
+
+
+#: Default histogram buckets for durations in seconds
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                30, 60, 120, 300)
+
+#: Default histogram buckets for sizes in bytes
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                16777216, 67108864)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, unicode(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+
+    """Monotonic counter with labels.
+
+    :param name: The metric name (ending with _total).
+    :param help: The help text.
+    :param labelnames: Names of the labels.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            for key, value in self._values.items():
+                yield self.name, zip(self.labelnames, key), value
+
+
+class Histogram(Counter):
+
+    """Histogram with cumulative buckets and labels.
+
+    :param name: The metric name.
+    :param help: The help text.
+    :param labelnames: Names of the labels.
+    :param buckets: Upper bounds of the buckets in increasing order.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=TIME_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                labels = zip(self.labelnames, key)
+                for bound, count in zip(self.buckets, counts):
+                    yield (self.name + '_bucket',
+                           labels + [('le', _format_value(bound))], count)
+                yield self.name + '_sum', labels, total
+                yield self.name + '_count', labels, counts[-1]
+
+
+class Registry(object):
+
+    """A set of metrics rendered together."""
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, _format_labels(labels),
+                                          _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+VALIDATION_TIME = REGISTRY.register(Histogram(
+    'oval_validation_duration_seconds', 'Duration of whole validations.'))
+CHECK_TIME = REGISTRY.register(Histogram(
+    'oval_check_duration_seconds', 'Duration of validation checks.',
+    ['check']))
+REQUEST_TIME = REGISTRY.register(Histogram(
+    'oval_request_duration_seconds',
+    'Duration of OAI-PMH requests including retries, by response source.',
+    ['verb', 'source']))
+RESPONSE_SIZE = REGISTRY.register(Histogram(
+    'oval_response_size_bytes', 'Size of OAI-PMH responses downloaded.',
+    ['verb'], SIZE_BUCKETS))
+PARSE_TIME = REGISTRY.register(Histogram(
+    'oval_parse_duration_seconds', 'Duration of parsing OAI-PMH responses.',
+    ['verb']))
+PAGE_TIME = REGISTRY.register(Histogram(
+    'oval_harvest_page_duration_seconds',
+    'Duration of fetching and parsing a page of a list harvest.', ['verb']))
+REQUESTS = REGISTRY.register(Counter(
+    'oval_requests_total',
+    'OAI-PMH requests by response source (memory, disk, revalidated, '
+    'network).', ['source']))
+RETRIES = REGISTRY.register(Counter(
+    'oval_retries_total', 'Retries of OAI-PMH requests.'))
+
+
+class RequestTimer(object):
+
+    """Measures one request. fetch_data sets source (how the response was
+    obtained) and retries while it runs; a request that does not reach
+    fetch_data's body was served from the in-memory cache.
+    """
+
+    def __init__(self, metrics, verb):
+        self.metrics = metrics
+        self.verb = verb or 'unknown'
+        self.source = 'memory'
+        self.retries = 0
+        self.start = time.time()
+
+    def finish(self, body, size=None, seconds=None):
+        """Record the request once its response body is there.
+
+        :param body: The response body.
+        :param size: The size of the body in bytes if it was not kept
+                     (e.g. for streamed responses).
+        :param seconds: The duration of the request if it differs from the
+                        time since the timer was started.
+        """
+        if size is None:
+            size = len(body)
+        if seconds is None:
+            seconds = time.time() - self.start
+        self.metrics.record_request(self, seconds, size)
+
+
+class ValidationMetrics(object):
+
+    """Summary of the measurements of one validation. Everything recorded
+    is also added to the process-wide metrics in REGISTRY.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.checks = OrderedDict()
+        self.requests = OrderedDict((source, 0) for source in
+                                    ('memory', 'disk', 'revalidated',
+                                     'network'))
+        self.bytes = 0
+        self.request_time = 0.0
+        self.parse_time = 0.0
+        self.pages = 0
+        self.page_time = 0.0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def request(self, verb):
+        """Return a RequestTimer for a request with verb."""
+        return RequestTimer(self, verb)
+
+    def record_request(self, timer, seconds, size):
+        REQUEST_TIME.observe(seconds, verb=timer.verb, source=timer.source)
+        REQUESTS.inc(source=timer.source)
+        if timer.retries:
+            RETRIES.inc(timer.retries)
+        downloaded = timer.source == 'network'
+        if downloaded:
+            RESPONSE_SIZE.observe(size, verb=timer.verb)
+        with self._lock:
+            self.requests[timer.source] += 1
+            self.request_time += seconds
+            self.retries += timer.retries
+            if downloaded:
+                self.bytes += size
+
+    def record_parse(self, verb, seconds):
+        PARSE_TIME.observe(seconds, verb=verb or 'unknown')
+        with self._lock:
+            self.parse_time += seconds
+
+    def record_page(self, verb, seconds):
+        PAGE_TIME.observe(seconds, verb=verb)
+        with self._lock:
+            self.pages += 1
+            self.page_time += seconds
+
+    def record_check(self, name, seconds):
+        CHECK_TIME.observe(seconds, check=name)
+        with self._lock:
+            self.checks[name] = seconds
+
+    def record_validation(self):
+        """Record the time since the validation started."""
+        VALIDATION_TIME.observe(time.time() - self.started)
+
+    def timed(self, name, function):
+        """Return function wrapped to record its duration as check name."""
+        def timed_function(*args, **kw):
+            start = time.time()
+            try:
+                return function(*args, **kw)
+            finally:
+                self.record_check(name, time.time() - start)
+        return timed_function
+
+    def summary(self):
+        """Return the measurements as a dictionary."""
+        with self._lock:
+            return OrderedDict([
+                ('checks', OrderedDict((name, round(seconds, 4)) for
+                                       name, seconds in self.checks.items())),
+                ('requests', OrderedDict(self.requests)),
+                ('bytes', self.bytes),
+                ('request_time', round(self.request_time, 4)),
+                ('parse_time', round(self.parse_time, 4)),
+                ('pages', self.pages),
+                ('page_time', round(self.page_time, 4)),
+                ('retries', self.retries)])
@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+"""
+    mockserver.py
+    ~~~~~~~~~~~~~
+
+    A configurable OAI-PMH 2.0 repository served over HTTP on localhost,
+    for benchmarks and experiments without network access. Record count,
+    page size, latency, 503 responses, resumptionToken expiry, datestamp
+    granularity and record size can be set::
+
+        repository = MockRepository(records=1000, page_size=100,
+                                    latency=0.05, error_rate=0.1)
+        with MockServer(repository) as server:
+            validator = Validator(server.url)
+
+    It can also be run on its own::
+
+        python mockserver.py --port 8765 --records 1000 --latency 0.05
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+import time
+import random
+import socket
+import argparse
+import threading
+# Imported by the first call of strptime, which is not thread-safe
+import _strptime
+from datetime import datetime, timedelta
+from urlparse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+
+DAY_GRANULARITY = 'YYYY-MM-DD'
+FULL_GRANULARITY = 'YYYY-MM-DDThh:mm:ssZ'
+
+OAI_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/" '
+              'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+              'xsi:schemaLocation="http://www.openarchives.org/OAI/2.0/ '
+              'http://www.openarchives.org/OAI/2.0/OAI-PMH.xsd">'
+              '<responseDate>%s</responseDate>')
+
+OAI_DC_HEADER = ('<oai_dc:dc '
+                 'xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" '
+                 'xmlns:dc="http://purl.org/dc/elements/1.1/" '
+                 'xsi:schemaLocation="http://www.openarchives.org/OAI/2.0/'
+                 'oai_dc/ http://www.openarchives.org/OAI/2.0/oai_dc.xsd">')
+
+LANGUAGES = ('eng', 'ger', 'fr', 'spa')
+
+SET_SPECS = ('articles', 'theses', 'reports')
+
+
+def _timestamp(moment):
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class OAIError(Exception):
+
+    """An OAI-PMH error condition answered with an error element."""
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+class MockRepository(object):
+
+    """The content and behaviour of a mock OAI-PMH repository. Records are
+    generated on the fly; every 13th record is deleted. Datestamps are
+    spread over one record per hour, starting at earliest.
+
+    :param records: Number of records.
+    :param page_size: Records (or headers) per ListRecords (or
+                      ListIdentifiers) response.
+    :param latency: Delay in seconds before every response.
+    :param error_rate: Fraction (0 to 1) of requests answered with 503.
+    :param retry_after: Value of the Retry-After header of 503 responses
+                        (None: no header).
+    :param token_expiry: Seconds after which resumptionTokens expire and
+                         are answered with badResumptionToken (None: never).
+    :param granularity: DAY_GRANULARITY or FULL_GRANULARITY.
+    :param payload_size: Additional bytes of dc:description per record.
+    :param earliest: The datestamp of the first record.
+    :param seed: Seed for the random 503 responses.
+    :param date_filter: Evaluate from and until (False: ignore them, as
+                        some servers do).
+    """
+
+    def __init__(self, records=250, page_size=100, latency=0, error_rate=0,
+                 retry_after=None, token_expiry=None,
+                 granularity=FULL_GRANULARITY, payload_size=0,
+                 earliest=datetime(2011, 1, 1), seed=0, date_filter=True):
+        if granularity not in (DAY_GRANULARITY, FULL_GRANULARITY):
+            raise ValueError('Unknown granularity: %s' % granularity)
+        self.records = records
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.token_expiry = token_expiry
+        self.granularity = granularity
+        self.payload_size = payload_size
+        self.earliest = earliest
+        self.date_filter = date_filter
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = {}
+
+    @property
+    def total_requests(self):
+        return sum(self.requests.values())
+
+    def reset_counts(self):
+        with self._lock:
+            self.requests = {}
+
+    def count(self, verb):
+        """Count a request with verb (including those answered with 503)."""
+        with self._lock:
+            self.requests[verb] = self.requests.get(verb, 0) + 1
+
+    def unavailable(self):
+        """Decide whether the next request is answered with 503."""
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def datestamp(self, index):
+        moment = self.earliest + timedelta(hours=index)
+        if self.granularity == DAY_GRANULARITY:
+            return moment.strftime('%Y-%m-%d')
+        return _timestamp(moment)
+
+    def parse_date(self, value, end=False):
+        """Parse a from/until argument. Raise OAIError for arguments that
+        do not match the granularity.
+        """
+        formats = ['%Y-%m-%d']
+        if self.granularity == FULL_GRANULARITY:
+            formats.append('%Y-%m-%dT%H:%M:%SZ')
+        for date_format in formats:
+            try:
+                moment = datetime.strptime(value, date_format)
+            except ValueError:
+                continue
+            if end and date_format == '%Y-%m-%d':
+                moment += timedelta(days=1, seconds=-1)
+            return moment
+        raise OAIError('badArgument', 'Illegal date: %s' % value)
+
+    def matching(self, _from=None, until=None, set_spec=None):
+        """Return the indices of the records within from and until (and
+        in set_spec).
+        """
+        step = 1
+        first, last = 0, self.records - 1
+        if not self.date_filter:
+            _from = until = None
+        if _from is not None:
+            delta = self.parse_date(_from) - self.earliest
+            first = max(first, int(-(-delta.total_seconds() // 3600)))
+        if until is not None:
+            delta = self.parse_date(until, end=True) - self.earliest
+            last = min(last, int(delta.total_seconds() // 3600))
+        if set_spec is not None:
+            if set_spec not in SET_SPECS:
+                return xrange(0)
+            # Record i belongs to set i % 3
+            step = len(SET_SPECS)
+            first += (SET_SPECS.index(set_spec) - first) % step
+        return xrange(first, last + 1, step)
+
+    def header(self, index):
+        status = ' status="deleted"' if index % 13 == 0 else ''
+        return ('<header%s><identifier>oai:mock:%d</identifier>'
+                '<datestamp>%s</datestamp><setSpec>%s</setSpec>'
+                '</header>' % (status, index, self.datestamp(index),
+                               SET_SPECS[index % len(SET_SPECS)]))
+
+    def record(self, index):
+        if index % 13 == 0:
+            return '<record>%s</record>' % self.header(index)
+        payload = ''
+        if self.payload_size:
+            payload = '<dc:description>%s</dc:description>' % (
+                'x' * self.payload_size)
+        return ('<record>%s<metadata>%s'
+                '<dc:title>Record %d</dc:title>'
+                '<dc:creator>Creator, A.</dc:creator>'
+                '<dc:type>Text</dc:type>'
+                '<dc:date>%s</dc:date>'
+                '<dc:language>%s</dc:language>'
+                '<dc:identifier>http://mock.example.org/%d</dc:identifier>'
+                '<dc:identifier>urn:nbn:de:mock-%d</dc:identifier>'
+                '%s</oai_dc:dc></metadata></record>') % (
+                    self.header(index), OAI_DC_HEADER, index,
+                    self.datestamp(index)[:10],
+                    LANGUAGES[index % len(LANGUAGES)], index, index, payload)
+
+    def respond(self, params, base_url):
+        """Return the body of the OAI-PMH response to params."""
+        verb = params.get('verb')
+        now = datetime.utcnow()
+        request = '<request%s>%s</request>' % (
+            ''.join(' %s="%s"' % (key, escape(value, {'"': '&quot;'}))
+                    for key, value in sorted(params.items())),
+            escape(base_url))
+        try:
+            if verb == 'Identify':
+                content = self.identify(base_url)
+            elif verb == 'ListMetadataFormats':
+                content = self.list_metadata_formats()
+            elif verb == 'ListSets':
+                content = self.list_sets()
+            elif verb in ('ListRecords', 'ListIdentifiers'):
+                content = self.list(verb, params, now)
+            else:
+                raise OAIError('badVerb', 'Illegal OAI verb')
+        except OAIError as e:
+            if e.code in ('badVerb', 'badArgument'):
+                request = '<request>%s</request>' % escape(base_url)
+            content = '<error code="%s">%s</error>' % (e.code, escape(str(e)))
+        return (OAI_HEADER % _timestamp(now)) + request + content + '</OAI-PMH>'
+
+    def identify(self, base_url):
+        return ('<Identify><repositoryName>Mock Repository</repositoryName>'
+                '<baseURL>%s</baseURL><protocolVersion>2.0</protocolVersion>'
+                '<adminEmail>admin@mock.example.org</adminEmail>'
+                '<earliestDatestamp>%s</earliestDatestamp>'
+                '<deletedRecord>persistent</deletedRecord>'
+                '<granularity>%s</granularity></Identify>' % (
+                    escape(base_url), self.datestamp(0), self.granularity))
+
+    def list_metadata_formats(self):
+        return ('<ListMetadataFormats><metadataFormat>'
+                '<metadataPrefix>oai_dc</metadataPrefix>'
+                '<schema>http://www.openarchives.org/OAI/2.0/oai_dc.xsd</schema>'
+                '<metadataNamespace>http://www.openarchives.org/OAI/2.0/oai_dc/'
+                '</metadataNamespace></metadataFormat></ListMetadataFormats>')
+
+    def list_sets(self):
+        return '<ListSets>%s</ListSets>' % ''.join(
+            '<set><setSpec>%s</setSpec><setName>Set %s</setName></set>' % (
+                set_spec, set_spec) for set_spec in SET_SPECS)
+
+    def list(self, verb, params, now):
+        token = params.get('resumptionToken')
+        if token is not None:
+            try:
+                cursor, _from, until, set_spec, issued = token.split('|')
+                cursor, issued = int(cursor), float(issued)
+            except ValueError:
+                raise OAIError('badResumptionToken', 'Invalid token')
+            if (self.token_expiry is not None and
+                    time.time() - issued > self.token_expiry):
+                raise OAIError('badResumptionToken', 'Expired token')
+            _from, until = _from or None, until or None
+            set_spec = set_spec or None
+        else:
+            prefix = params.get('metadataPrefix')
+            if prefix is None:
+                raise OAIError('badArgument', 'Missing metadataPrefix')
+            if prefix != 'oai_dc':
+                raise OAIError('cannotDisseminateFormat', prefix)
+            cursor, _from, until = 0, params.get('from'), params.get('until')
+            set_spec = params.get('set')
+        indices = self.matching(_from, until, set_spec)
+        if len(indices) == 0:
+            raise OAIError('noRecordsMatch', 'No matching records')
+        page = (indices[i] for i in xrange(
+            cursor, min(len(indices), cursor + self.page_size)))
+        item = self.header if verb == 'ListIdentifiers' else self.record
+        items = ''.join(item(index) for index in page)
+        token = ''
+        if cursor + self.page_size < len(indices):
+            expiration = ''
+            if self.token_expiry is not None:
+                expiration = ' expirationDate="%s"' % _timestamp(
+                    now + timedelta(seconds=self.token_expiry))
+            token = ('<resumptionToken%s completeListSize="%d" cursor="%d">'
+                     '%d|%s|%s|%s|%f</resumptionToken>' % (
+                         expiration, len(indices), cursor,
+                         cursor + self.page_size, _from or '', until or '',
+                         set_spec or '', time.time()))
+        elif cursor > 0:
+            token = ('<resumptionToken completeListSize="%d" cursor="%d"/>'
+                     % (len(indices), cursor))
+        return '<%s>%s%s</%s>' % (verb, items, token, verb)
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+
+    """Answer GET and POST requests with the server's MockRepository."""
+
+    protocol_version = 'HTTP/1.1'
+    # Send every response in one write (no Nagle delays)
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.answer(urlparse(self.path).query)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.answer(self.rfile.read(length))
+
+    def answer(self, query):
+        repository = self.server.repository
+        params = dict((key, values[0]) for key, values in
+                      parse_qs(query, keep_blank_values=True).items())
+        repository.count(params.get('verb'))
+        if repository.latency:
+            time.sleep(repository.latency)
+        if repository.unavailable():
+            self.send_response(503)
+            if repository.retry_after is not None:
+                self.send_header('Retry-After', str(repository.retry_after))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = repository.respond(params, self.server.url)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+
+    """HTTP server for a MockRepository, running in a background thread
+    once started. Port 0 picks a free port.
+
+    :param repository: The MockRepository to serve.
+    :param host: The address to listen on.
+    :param port: The port to listen on.
+    """
+
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, repository, host='127.0.0.1', port=0):
+        HTTPServer.__init__(self, (host, port), MockRequestHandler)
+        self.repository = repository
+        self.thread = None
+        self.stopped = False
+        # Open connections, closed on stop so that no handler is left
+        # waiting for another request on a kept-alive connection
+        self.connections = set()
+
+    @property
+    def url(self):
+        """The base URL of the OAI-PMH interface."""
+        host, port = self.server_address[:2]
+        return 'http://%s:%d/oai' % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def process_request(self, request, client_address):
+        self.connections.add(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        self.connections.discard(request)
+        HTTPServer.shutdown_request(self, request)
+
+    def handle_error(self, request, client_address):
+        # Connections kept alive by clients break once the server stops
+        if not self.stopped:
+            HTTPServer.handle_error(self, request, client_address)
+
+    def stop(self):
+        self.stopped = True
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        # Give the handlers a moment to finish
+        deadline = time.time() + 1
+        while self.connections and time.time() < deadline:
+            time.sleep(0.01)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    """Command line interface for the mock server."""
+    parser = argparse.ArgumentParser(
+        description='OVAL -- mock OAI-PMH repository')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--records', type=int, default=250)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds before every response')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of requests answered with 503')
+    parser.add_argument('--retry-after', type=int,
+                        help='Retry-After of 503 responses in seconds')
+    parser.add_argument('--token-expiry', type=float,
+                        help='lifetime of resumptionTokens in seconds')
+    parser.add_argument('--granularity', default=FULL_GRANULARITY,
+                        choices=[DAY_GRANULARITY, FULL_GRANULARITY])
+    parser.add_argument('--payload-size', type=int, default=0,
+                        help='additional bytes per record')
+    parser.add_argument('--no-date-filter', action='store_true',
+                        help='ignore from and until')
+
+    args = parser.parse_args()
+
+    repository = MockRepository(
+        records=args.records, page_size=args.page_size, latency=args.latency,
+        error_rate=args.error_rate, retry_after=args.retry_after,
+        token_expiry=args.token_expiry, granularity=args.granularity,
+        payload_size=args.payload_size,
+        date_filter=not args.no_date_filter)
+    server = MockServer(repository, args.host, args.port)
+    print "Serving %s" % server.url
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
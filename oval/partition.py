@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+"""
+    partition.py
+    ~~~~~~~~~~~~
+
+    Parallel harvesting: the list of records is split into partitions,
+    either from/until windows over the datestamp range or sets, whose
+    resumptionToken chains are followed concurrently. Every record is
+    passed on only by the partition it belongs to (the window holding its
+    datestamp, or the first of its sets), so records in several sets or
+    returned for the wrong window are passed on only once.
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+import threading
+from Queue import Queue, Empty, Full
+from multiprocessing.pool import ThreadPool
+from datetime import datetime, timedelta
+
+from dateutil import parser as dateparser
+from dateutil.tz import tzutc
+
+from harvester import OAI
+
+
+
+DATE_FORMATS = {
+    'day': '%Y-%m-%d',
+    'full': '%Y-%m-%dT%H:%M:%SZ',
+}
+
+UNITS = {
+    'day': timedelta(days=1),
+    'full': timedelta(seconds=1),
+}
+
+
+class Partition(object):
+
+    """A part of a list harvest: a date window, a set or both.
+
+       :param _from: Optional date offset.
+       :param until: Optional date limit.
+       :param setSpec: Optional set.
+    """
+
+    __slots__ = ('_from', 'until', 'setSpec')
+
+    def __init__(self, _from=None, until=None, setSpec=None):
+        self._from = _from
+        self.until = until
+        self.setSpec = setSpec
+
+    def __repr__(self):
+        return 'Partition(%r, %r, %r)' % (self._from, self.until, self.setSpec)
+
+    def contains(self, datestamp):
+        """Return True if datestamp lies within the date window. Datestamps
+        and bounds are compared at the coarser of their granularities;
+        records without a datestamp belong to every window.
+        """
+        if not datestamp:
+            return True
+        if self._from:
+            length = min(len(datestamp), len(self._from))
+            if datestamp[:length] < self._from[:length]:
+                return False
+        if self.until:
+            length = min(len(datestamp), len(self.until))
+            if datestamp[:length] > self.until[:length]:
+                return False
+        return True
+
+
+def parse_datestamp(value):
+    """Return an OAI-PMH datestamp as naive UTC datetime or None."""
+    try:
+        moment = dateparser.parse(value)
+    except (ValueError, TypeError, OverflowError):
+        return None
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(tzutc()).replace(tzinfo=None)
+    return moment
+
+
+def date_partitions(earliest, count, granularity='day', latest=None):
+    """Split the datestamps from earliest to latest into at most count
+    from/until windows of equal length. The first window is open at the
+    start and the last one at the end, so that records with datestamps
+    outside the range (e.g. before a wrong earliestDatestamp) are not lost.
+
+    :param earliest: The earliest datestamp (see Identify) as string or
+                     datetime.
+    :param count: Desired number of windows.
+    :param granularity: The granularity of the repository ('day' or
+                        'full', see get_granularity).
+    :param latest: The end of the range (default: now).
+    """
+    if isinstance(earliest, basestring):
+        earliest = parse_datestamp(earliest)
+    if earliest is None:
+        return [Partition(None, None, None)]
+    if latest is None:
+        latest = datetime.utcnow()
+    date_format = DATE_FORMATS[granularity]
+    unit = UNITS[granularity]
+    start = datetime.strptime(earliest.strftime(date_format), date_format)
+    units = int((latest - start).total_seconds() //
+                unit.total_seconds()) + 1
+    count = max(1, min(count, units))
+    starts = [start + unit * (units * i // count) for i in range(1, count)]
+    partitions = []
+    _from = None
+    for boundary in starts:
+        until = (boundary - unit).strftime(date_format)
+        partitions.append(Partition(_from, until, None))
+        _from = boundary.strftime(date_format)
+    partitions.append(Partition(_from, None, None))
+    return partitions
+
+
+def list_size(request_oai, partition, metadataPrefix='oai_dc',
+              protocol_version='2.0'):
+    """Return the number of records (including deleted ones) in a
+    partition, from the completeListSize of the first ListIdentifiers page,
+    or None if the repository does not tell.
+
+    :param request_oai: A request function (see configure_request).
+    :param partition: The Partition.
+    :param metadataPrefix: The OAI-PMH metadataPrefix.
+    :param protocol_version: The OAI-PMH version of the repository.
+    """
+    oai = OAI % protocol_version
+    tree = request_oai(verb='ListIdentifiers', metadataPrefix=metadataPrefix,
+                       _from=partition._from, until=partition.until,
+                       set=partition.setSpec)
+    error = tree.find(oai + 'error')
+    if error is not None:
+        if error.get('code') == 'noRecordsMatch':
+            return 0
+        return None
+    token = tree.find('.//' + oai + 'resumptionToken')
+    if token is None or not token.text:
+        return len(tree.findall('.//' + oai + 'header'))
+    size = token.get('completeListSize', '')
+    if size.isdigit():
+        return int(size)
+
+
+def sized_date_partitions(request_oai, earliest, count, granularity='day',
+                          metadataPrefix='oai_dc', latest=None,
+                          protocol_version='2.0', max_probes=64):
+    """Split the datestamps from earliest to latest into about count
+    from/until windows holding similar numbers of records. Records are
+    rarely spread evenly over a repository's history, so the windows with
+    the most records are halved until there are count windows, using
+    list_size to count the records of one half (the other half holds the
+    rest). Only windows counted to hold no records are dropped; if the
+    rest of a window does not add up, the other half is counted as well.
+    Falls back to date_partitions if the repository does not report list
+    sizes, and to a single unpartitioned harvest if it ignores from and
+    until (both halves of a window hold all of its records).
+
+    :param request_oai: A request function (see configure_request).
+    :param earliest: The earliest datestamp (see Identify) as string or
+                     datetime.
+    :param count: Desired number of windows.
+    :param granularity: The granularity of the repository ('day' or
+                        'full', see get_granularity).
+    :param metadataPrefix: The OAI-PMH metadataPrefix.
+    :param latest: The end of the range (default: now).
+    :param protocol_version: The OAI-PMH version of the repository.
+    :param max_probes: Maximum number of list_size requests.
+    """
+    if isinstance(earliest, basestring):
+        earliest = parse_datestamp(earliest)
+    if earliest is None:
+        return [Partition(None, None, None)]
+    if latest is None:
+        latest = datetime.utcnow()
+    date_format = DATE_FORMATS[granularity]
+    unit = UNITS[granularity]
+    first = datetime.strptime(earliest.strftime(date_format), date_format)
+    last = datetime.strptime(latest.strftime(date_format), date_format)
+
+    def partition(start, end):
+        # Windows at either end stay open (see date_partitions)
+        return Partition(
+            None if start <= first else start.strftime(date_format),
+            None if end >= last else end.strftime(date_format), None)
+
+    def size(start, end):
+        return list_size(request_oai, partition(start, end), metadataPrefix,
+                         protocol_version)
+
+    # Windows as (start, end, records, counted); the records of windows
+    # that were not counted are a guess
+    windows = [(first, last, size(first, last), True)]
+    if windows[0][2] is None:
+        return date_partitions(earliest, count, granularity, latest)
+    target = max(1, windows[0][2] // count)
+    probes = 1
+    # Whether the repository has been seen to evaluate from and until
+    filtered = False
+    pool = ThreadPool(min(count, 8))
+    try:
+        while True:
+            missing = count - sum(1 for window in windows if window[3])
+            if missing <= 0 or probes >= max_probes:
+                break
+            # Halve the largest windows, as many as are still missing; the
+            # halves are counted concurrently
+            largest = sorted((window for window in windows
+                              if window[3] and window[1] > window[0] and
+                              window[2] > target),
+                             key=lambda window: -window[2])
+            largest = largest[:min(missing, max_probes - probes)]
+            if not largest:
+                break
+            halves = []
+            for start, end, records, counted in largest:
+                units = int((end - start).total_seconds() //
+                            unit.total_seconds())
+                middle = start + unit * ((units + 1) // 2)
+                halves.append(((start, middle - unit), (middle, end)))
+            sizes = pool.map(lambda pair: size(*pair[0]), halves)
+            probes += len(halves)
+            if None in sizes:
+                break
+            # Both halves together hold the records of the window. A rest
+            # that does not add up (from and until ignored, approximate
+            # sizes) is counted until the repository has been seen to
+            # evaluate from and until
+            unsure = []
+            if not filtered:
+                unsure = [i for i, (window, left_size) in
+                          enumerate(zip(largest, sizes))
+                          if window[2] - left_size <= 0]
+            right_sizes = dict(zip(unsure, pool.map(
+                lambda i: size(*halves[i][1]), unsure)))
+            probes += len(unsure)
+            for i, (window, (left, right), left_size) in enumerate(
+                    zip(largest, halves, sizes)):
+                if left_size < window[2]:
+                    filtered = True
+                if i in right_sizes:
+                    right_size = right_sizes[i]
+                    if right_size is not None and right_size < window[2]:
+                        filtered = True
+                    elif right_size is not None and left_size >= window[2] > 0:
+                        # The windows are ignored; harvest everything at
+                        # once
+                        return [Partition(None, None, None)]
+                    right_half = right + (right_size or 0,
+                                          right_size is not None)
+                else:
+                    right_size = window[2] - left_size
+                    # Never drop a half whose size is only guessed
+                    right_half = right + (max(right_size, 0), right_size > 0)
+                kept = [left + (left_size, True)] if left_size else []
+                if not (right_half[3] and right_half[2] == 0):
+                    kept.append(right_half)
+                index = windows.index(window)
+                windows[index:index + 1] = kept
+    finally:
+        pool.close()
+    # Neighbouring windows of unknown size are harvested as one
+    merged = []
+    for window in windows:
+        if merged and not window[3] and not merged[-1][3]:
+            merged[-1] = (merged[-1][0], window[1], 0, False)
+        else:
+            merged.append(window)
+    return [partition(start, end) for start, end, records, counted in merged]
+
+
+def list_set_specs(request_oai, protocol_version='2.0'):
+    """Return the setSpecs of all sets of a repository.
+
+    :param request_oai: A request function (see configure_request).
+    :param protocol_version: The OAI-PMH version of the repository.
+    """
+    oai = OAI % protocol_version
+    set_specs = []
+    token = None
+    while True:
+        tree = request_oai(verb='ListSets', resumptionToken=token)
+        set_specs.extend(element.text for element in
+                         tree.iter(oai + 'setSpec'))
+        token = tree.findtext('.//' + oai + 'resumptionToken')
+        if not token:
+            return set_specs
+
+
+def set_partitions(set_specs):
+    """Return a partition for every top-level set. Records outside all
+    sets are not covered.
+
+    :param set_specs: The setSpecs of the repository (see list_set_specs).
+    """
+    return [Partition(None, None, set_spec) for set_spec in set_specs
+            if set_spec and ':' not in set_spec]
+
+
+class PartitionedHarvest(object):
+
+    """Iterate over the records of several partitions harvested by a pool
+    of threads. Records are returned in the order they arrive; at most
+    buffer_size of them wait for the consumer, so memory use stays bounded
+    when the consumer is slower than the harvest::
+
+        partitions = date_partitions(earliest, 16, 'day')
+        for record in PartitionedHarvest(RecordIterator, partitions):
+            ...
+
+    Duplicates are dropped without remembering the records seen, so memory
+    use does not grow with the size of the harvest: a record is only passed
+    on by the window holding its datestamp (windows are disjoint), and by
+    the alphabetically first of its top-level sets that is harvested. A
+    record changed while the harvest is running may still be passed on
+    twice, once with each datestamp. An error in any partition stops the
+    harvest and is raised by the iterator.
+
+       :param RecordIterator: A RecordIterator class (see
+                              configure_record_iterator).
+       :param partitions: List of Partition objects.
+       :param verb: The OAI-PMH verb.
+       :param metadataPrefix: The OAI-PMH metadataPrefix.
+       :param workers: Number of partitions harvested at the same time.
+       :param deleted: Include deleted records.
+       :param stream: Parse pages while they are downloaded.
+       :param protocol_version: The OAI-PMH version of the repository.
+       :param buffer_size: Maximum number of records waiting for the
+                           consumer.
+    """
+
+    def __init__(self, RecordIterator, partitions, verb='ListRecords',
+                 metadataPrefix='oai_dc', workers=4, deleted=False,
+                 stream=True, protocol_version='2.0', buffer_size=1000):
+        self.RecordIterator = RecordIterator
+        self.partitions = partitions
+        self.verb = verb
+        self.metadataPrefix = metadataPrefix
+        self.workers = workers
+        self.deleted = deleted
+        self.stream = stream
+        self.buffer_size = buffer_size
+        oai = OAI % protocol_version
+        self.header_tag = oai + 'header'
+        self.datestamp_tag = oai + 'datestamp'
+        self.set_spec_tag = oai + 'setSpec'
+        # Top-level sets harvested, which own their records (see _owns)
+        self.set_specs = frozenset(partition.setSpec for partition in
+                                   partitions if partition.setSpec)
+        self.duplicates = 0
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        todo = Queue()
+        for partition in self.partitions:
+            todo.put(partition)
+        records = Queue(self.buffer_size)
+        stop = threading.Event()
+        threads = []
+        for i in range(min(self.workers, len(self.partitions))):
+            thread = threading.Thread(target=self._work,
+                                      args=(todo, records, stop))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        running = len(threads)
+        try:
+            while running:
+                kind, item = records.get()
+                if kind == 'done':
+                    running -= 1
+                elif kind == 'error':
+                    raise item
+                else:
+                    yield item
+        finally:
+            # Release workers waiting for room in the buffer
+            stop.set()
+            while any(thread.is_alive() for thread in threads):
+                try:
+                    records.get(timeout=0.1)
+                except Empty:
+                    pass
+
+    def _put(self, records, stop, item):
+        while not stop.is_set():
+            try:
+                records.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _owns(self, partition, header):
+        """Return True if a record harvested for partition belongs to
+        it.
+        """
+        if not partition.contains(header.findtext(self.datestamp_tag)):
+            return False
+        if partition.setSpec is None:
+            return True
+        owners = [element.text.split(':', 1)[0] for element in
+                  header.findall(self.set_spec_tag) if element.text]
+        owners = [owner for owner in owners if owner in self.set_specs]
+        return not owners or min(owners) == partition.setSpec
+
+    def _work(self, todo, records, stop):
+        try:
+            while not stop.is_set():
+                try:
+                    partition = todo.get_nowait()
+                except Empty:
+                    break
+                riter = self.RecordIterator(
+                    self.verb, self.metadataPrefix, _from=partition._from,
+                    until=partition.until, setSpec=partition.setSpec,
+                    deleted=True, stream=self.stream)
+                for record in riter:
+                    header = record
+                    if record.tag != self.header_tag:
+                        header = record.find(self.header_tag)
+                    if header is None:
+                        continue
+                    if not self._owns(partition, header):
+                        with self._lock:
+                            self.duplicates += 1
+                        continue
+                    if not self.deleted and header.get('status') == 'deleted':
+                        continue
+                    if not self._put(records, stop, ('record', record)):
+                        return
+        except Exception as exc:
+            self._put(records, stop, ('error', exc))
+            return
+        self._put(records, stop, ('done', None))
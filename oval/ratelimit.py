@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+    ratelimit.py
+    ~~~~~~~~~~~~
+
+    Politeness towards repository servers: a token bucket per host limits
+    the rate of requests of all validations in the process, or of all
+    processes sharing an SQLite database. A host's rate is halved whenever
+    it answers 503 (or 429) and recovers slowly with every successful
+    request; a Retry-After header pauses all requests to the host.
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+import time
+import sqlite3
+import threading
+from urlparse import urlparse
+
+
+def host_key(url):
+    """Return the key of the bucket for url (host and port)."""
+    return urlparse(url).netloc.lower()
+
+
+def _refill(state, now, burst):
+    # Add the tokens earned since the last update
+    tokens, updated, rate = state
+    if now > updated:
+        tokens = min(burst, tokens + (now - updated) * rate)
+        updated = now
+    return tokens, updated, rate
+
+
+class HostLimiter(object):
+
+    """Token buckets by host, shared by all threads of the process. The
+    state of a bucket is a tuple (tokens, updated, rate): the tokens
+    available at time updated (negative for reserved requests; updated lies
+    in the future while the host is paused) and the current rate in
+    requests per second::
+
+        limiter = HostLimiter(rate=10, burst=20)
+        limiter.wait(url)
+        ...
+        limiter.feedback(url, 503, retry_after=30)
+
+    :param rate: Maximum (and initial) requests per second and host.
+    :param burst: Number of requests that may be sent at once.
+    :param min_rate: Lower bound for the rate after 503 responses.
+    :param decrease: Factor applied to the rate on 503 and 429 responses.
+    :param increase: Requests per second added to the rate after every
+                     successful request.
+    :param max_pause: Upper limit in seconds for pauses from Retry-After.
+    """
+
+    def __init__(self, rate=10, burst=20, min_rate=0.2, decrease=0.5,
+                 increase=0.1, max_pause=60):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.decrease = decrease
+        self.increase = increase
+        self.max_pause = max_pause
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _initial_state(self, now):
+        return (float(self.burst), now, float(self.rate))
+
+    def _update(self, key, function):
+        """Replace the state of the bucket for key by the first item of
+        function(state, now) and return the second.
+        """
+        with self._lock:
+            now = time.time()
+            state = self._buckets.get(key) or self._initial_state(now)
+            state, result = function(state, now)
+            self._buckets[key] = state
+        return result
+
+    def _reserve(self, state, now):
+        tokens, updated, rate = _refill(state, now, self.burst)
+        tokens -= 1
+        delay = max(0, updated - now) + max(0, -tokens) / rate
+        return (tokens, updated, rate), delay
+
+    def acquire(self, url):
+        """Reserve a request to the host of url. Return the number of
+        seconds to wait before sending it.
+        """
+        return self._update(host_key(url), self._reserve)
+
+    def wait(self, url):
+        """Wait until a request to the host of url may be sent. The pause
+        is a plain sleep: unlike retry.wait, it does not hand the slot of a
+        scheduled check to a substitute thread.
+        """
+        delay = self.acquire(url)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def feedback(self, url, code, retry_after=None):
+        """Adapt the rate for the host of url to the status code of a
+        response: slow down on 503 and 429, speed up again otherwise.
+
+        :param url: The URL of the request.
+        :param code: The HTTP status code of the response.
+        :param retry_after: The seconds from the Retry-After header or None.
+        """
+        def adapt(state, now):
+            tokens, updated, rate = _refill(state, now, self.burst)
+            if code in (429, 503):
+                rate = max(self.min_rate, rate * self.decrease)
+                tokens = min(tokens, 1)
+                if retry_after is not None:
+                    pause = min(retry_after, self.max_pause)
+                    updated = max(updated, now + pause)
+            else:
+                rate = min(self.rate, rate + self.increase)
+            return (tokens, updated, rate), None
+        self._update(host_key(url), adapt)
+
+    def current_rate(self, url):
+        """Return the current rate for the host of url."""
+        return self._update(host_key(url),
+                            lambda state, now: (state, state[2]))
+
+
+class SharedHostLimiter(HostLimiter):
+
+    """HostLimiter whose buckets are kept in an SQLite database, shared by
+    all processes using the same file. Takes the same keyword arguments as
+    HostLimiter.
+
+    :param path: The path to the SQLite database file.
+    """
+
+    def __init__(self, path, **kw):
+        super(SharedHostLimiter, self).__init__(**kw)
+        self.path = path
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS buckets ('
+                    'host TEXT PRIMARY KEY, tokens REAL, updated REAL, '
+                    'rate REAL)')
+        finally:
+            connection.close()
+
+    def _connect(self):
+        # One short-lived connection per operation (see cache.DiskCache)
+        connection = sqlite3.connect(self.path, timeout=30,
+                                     isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        return connection
+
+    def _update(self, key, function):
+        connection = self._connect()
+        try:
+            # Lock the database for writing before reading the state
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                row = connection.execute(
+                    'SELECT tokens, updated, rate FROM buckets '
+                    'WHERE host = ?', (key,)).fetchone()
+                state = tuple(row) if row else self._initial_state(now)
+                state, result = function(state, now)
+                connection.execute(
+                    'INSERT OR REPLACE INTO buckets '
+                    '(host, tokens, updated, rate) VALUES (?, ?, ?, ?)',
+                    (key,) + state)
+                connection.execute('COMMIT')
+            except:
+                connection.execute('ROLLBACK')
+                raise
+            return result
+        finally:
+            connection.close()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+    retry.py
+    ~~~~~~~~
+
+    Retrying of temporarily failed requests (503 Service Unavailable):
+    exponential backoff with jitter, an upper limit for the waits a server
+    may ask for with Retry-After, and a budget of waiting time shared by
+    all requests of a validation.
+
+    Waiting goes through wait(), so a worker pool can lend the waiting
+    thread's slot to other tasks (see set_wait_handler).
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+import time
+import random
+import threading
+from email.utils import parsedate_tz, mktime_tz
+
+
+_local = threading.local()
+
+
+def set_wait_handler(handler):
+    """Let handler(seconds) do the waiting for retries in the current
+    thread instead of time.sleep. None restores the default.
+
+    :param handler: Callable taking the number of seconds to wait.
+    """
+    _local.handler = handler
+
+
+def wait(seconds):
+    """Wait for seconds, using the current thread's wait handler if any."""
+    handler = getattr(_local, 'handler', None)
+    if handler is None:
+        time.sleep(seconds)
+    else:
+        handler(seconds)
+
+
+def parse_retry_after(value, now=None):
+    """Return the number of seconds a Retry-After header value (seconds or
+    HTTP date) asks to wait, or None if it cannot be parsed.
+
+    :param value: The value of the Retry-After header.
+    :param now: The current time (default: time.time()).
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    if now is None:
+        now = time.time()
+    return max(0, mktime_tz(date) - now)
+
+
+class RetryBudget(object):
+
+    """Total waiting time allowed for the retries of a validation. Safe to
+    share between threads.
+
+    :param seconds: The waiting time available.
+    """
+
+    def __init__(self, seconds):
+        self.remaining = seconds
+        self._lock = threading.Lock()
+
+    def take(self, seconds):
+        """Reserve seconds of waiting time. Return False (and reserve
+        nothing) if not enough time is left.
+        """
+        with self._lock:
+            if seconds > self.remaining:
+                return False
+            self.remaining -= seconds
+            return True
+
+
+class RetryPolicy(object):
+
+    """When and how long to wait before retrying a failed request.
+
+    The n-th retry (counting from 0) waits backoff * 2 ** n seconds, at
+    most max_backoff, reduced by a random fraction of up to jitter so that
+    clients do not come back at the same time. If the server sent a
+    Retry-After header, its value is used instead, but at most
+    max_retry_after seconds.
+
+    :param retries: Maximum number of retries of a request.
+    :param backoff: Wait before the first retry in seconds.
+    :param max_backoff: Upper limit of the exponential backoff in seconds.
+    :param max_retry_after: Upper limit for waits asked for by the server.
+    :param jitter: Fraction (0 to 1) of the wait that is randomized.
+    :param budget: Total waiting time in seconds for all requests of a
+                   validation (see RetryBudget).
+    :param statuses: HTTP status codes that are retried.
+    """
+
+    def __init__(self, retries=3, backoff=1.0, max_backoff=30,
+                 max_retry_after=60, jitter=0.5, budget=120,
+                 statuses=(503,)):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.jitter = jitter
+        self.budget = budget
+        self.statuses = statuses
+
+    def new_budget(self):
+        """Return a RetryBudget for a validation."""
+        return RetryBudget(self.budget)
+
+    def delay(self, attempt, retry_after=None):
+        """Return the seconds to wait before retry number attempt.
+
+        :param attempt: The number of retries done so far.
+        :param retry_after: The wait asked for by the server or None.
+        """
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        return delay * (1 - self.jitter * random.random())
+
+    def should_retry(self, error, attempt, budget=None):
+        """Return the seconds to wait before retrying a request that failed
+        with error, or None if it should not be retried.
+
+        :param error: The exception raised by the request.
+        :param attempt: The number of retries done so far.
+        :param budget: Optional RetryBudget to take the wait from.
+        """
+        if getattr(error, 'code', None) not in self.statuses:
+            return None
+        if attempt >= self.retries:
+            return None
+        headers = getattr(error, 'hdrs', None)
+        retry_after = None
+        if headers is not None:
+            retry_after = parse_retry_after(headers.get('Retry-After'))
+        delay = self.delay(attempt, retry_after)
+        if budget is not None and not budget.take(delay):
+            return None
+        return delay
+
+
+#: The policy used by fetch_data unless another one is given
+DEFAULT_POLICY = RetryPolicy()
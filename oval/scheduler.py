@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+    scheduler.py
+    ~~~~~~~~~~~~
+
+    Concurrent execution of validation checks with declared dependencies.
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+import sys
+import threading
+from time import sleep
+from functools import partial
+from Queue import Queue, Empty
+
+from ordereddict import OrderedDict
+
+from retry import set_wait_handler
+
+
+class CheckScheduler(object):
+
+    """Run tasks (validation checks or steps that fetch shared data) in a
+    bounded pool of threads. A task starts as soon as all tasks it requires
+    have finished, whether they succeeded or not; independent tasks run
+    concurrently. While a task waits at least min_wait seconds to retry a
+    request (see retry.wait), a substitute thread takes over its slot; the
+    task gets a slot back once the wait is over, so no more than max_workers
+    tasks ever run at the same time::
+
+        scheduler = CheckScheduler(max_workers=4)
+        scheduler.add('ListRecords', fetch_first_page)
+        scheduler.add('ListRecordsXML', validate, requires=['ListRecords'])
+        scheduler.run()
+
+    :param max_workers: Maximum number of tasks running at the same time.
+    :param min_wait: Shorter waits keep the slot of their task.
+    """
+
+    def __init__(self, max_workers=4, min_wait=1.0):
+        self.max_workers = max_workers
+        self.min_wait = min_wait
+        self.tasks = OrderedDict()
+        self.errors = OrderedDict()
+
+    def add(self, name, function, requires=()):
+        """Register a task.
+
+        :param name: Unique name of the task.
+        :param function: Callable without arguments.
+        :param requires: Names of the tasks that must finish first.
+        """
+        if name in self.tasks:
+            raise ValueError('Duplicate task: %s' % name)
+        self.tasks[name] = (function, tuple(requires))
+
+    def _check_dependencies(self):
+        for name, (_, requires) in self.tasks.items():
+            for required in requires:
+                if required not in self.tasks:
+                    raise ValueError('Task %s requires unknown task %s' %
+                                     (name, required))
+        # Detect cycles by repeatedly removing tasks without open
+        # requirements
+        open_tasks = dict((name, set(requires)) for name, (_, requires)
+                          in self.tasks.items())
+        while open_tasks:
+            free = [name for name, requires in open_tasks.items()
+                    if not requires]
+            if not free:
+                raise ValueError('Cyclic task dependencies: %s' %
+                                 ', '.join(sorted(open_tasks)))
+            for name in free:
+                del open_tasks[name]
+            for requires in open_tasks.values():
+                requires.difference_update(free)
+
+    def _work(self, todo, done, slots, substitutes, stop=None):
+        set_wait_handler(partial(self._wait, todo, done, slots, substitutes))
+        while stop is None or not stop.is_set():
+            if stop is None:
+                name = todo.get()
+            else:
+                try:
+                    name = todo.get(timeout=0.1)
+                except Empty:
+                    continue
+            if name is None:
+                if stop is not None:
+                    # Leave the shutdown signal to a regular worker
+                    todo.put(None)
+                break
+            function = self.tasks[name][0]
+            slots.acquire()
+            try:
+                function()
+                done.put((name, None))
+            except Exception:
+                done.put((name, sys.exc_info()))
+            finally:
+                slots.release()
+        if stop is not None:
+            substitutes.release()
+
+    def _wait(self, todo, done, slots, substitutes, seconds):
+        # Run other tasks in a substitute thread while this one is waiting;
+        # the substitute stops after its current task once the wait is over
+        # and this task only continues once it has a slot again
+        if seconds < self.min_wait or not substitutes.acquire(False):
+            sleep(seconds)
+            return
+        stop = threading.Event()
+        substitute = threading.Thread(target=self._work,
+                                      args=(todo, done, slots, substitutes,
+                                            stop))
+        substitute.daemon = True
+        slots.release()
+        try:
+            substitute.start()
+            sleep(seconds)
+        finally:
+            stop.set()
+            slots.acquire()
+
+    def run(self):
+        """Run all tasks and wait for them to finish. Exceptions raised by
+        tasks are collected in errors; the first one is raised again once
+        all tasks are done.
+        """
+        self._check_dependencies()
+        waiting = OrderedDict((name, set(requires)) for name, (_, requires)
+                              in self.tasks.items())
+        todo = Queue()
+        done = Queue()
+        # Slots of running tasks and of substitute threads
+        slots = threading.Semaphore(self.max_workers)
+        substitutes = threading.Semaphore(self.max_workers)
+        workers = [threading.Thread(target=self._work,
+                                    args=(todo, done, slots, substitutes))
+                   for _ in range(min(self.max_workers, len(waiting)) or 1)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        running = 0
+        try:
+            while waiting or running:
+                for name, requires in waiting.items():
+                    if not requires:
+                        del waiting[name]
+                        todo.put(name)
+                        running += 1
+                name, exc_info = done.get()
+                running -= 1
+                if exc_info is not None:
+                    self.errors[name] = exc_info
+                for requires in waiting.values():
+                    requires.discard(name)
+        finally:
+            for _ in workers:
+                todo.put(None)
+            for worker in workers:
+                worker.join()
+        if self.errors:
+            exc_type, exc_value, traceback = self.errors.values()[0]
+            raise exc_type, exc_value, traceback
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+    schemas.py
+    ~~~~~~~~~~
+
+    Compiled XML Schemas for validating OAI-PMH responses, cached per
+    process. The common schemas (OAI-PMH 2.0, oai_dc, simple DC, xml) are
+    bundled and resolved from a local XML catalog instead of the network.
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+import os
+import threading
+from StringIO import StringIO
+
+from lxml import etree
+
+from data import DATA_PATH
+
+
+SCHEMA_PATH = os.path.join(DATA_PATH, 'schemas')
+
+CATALOG_FILE = os.path.join(SCHEMA_PATH, 'catalog.xml')
+
+CATALOG_NS = '{urn:oasis:names:tc:entity:xmlns:xml:catalog}'
+
+XS = '{http://www.w3.org/2001/XMLSchema}'
+
+SCHEMA_TEMPLATE = """<?xml version = "1.0" encoding = "UTF-8"?>
+<xs:schema xmlns="http://dummy.libxml2.validator"
+targetNamespace="http://dummy.libxml2.validator"
+xmlns:xs="http://www.w3.org/2001/XMLSchema"
+xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+version="1.0"
+elementFormDefault="qualified"
+attributeFormDefault="unqualified">
+</xs:schema>"""
+
+# Compiled schemas by frozenset of (namespace, location) pairs
+SCHEMA_CACHE = {}
+_cache_lock = threading.Lock()
+
+
+def normalize_location(location):
+    """Map equivalent schema URLs to one form (http, no whitespace)."""
+    location = location.strip()
+    if location.startswith('https://'):
+        location = 'http://' + location[len('https://'):]
+    return location
+
+
+def load_catalog(path=CATALOG_FILE):
+    """Read an OASIS XML catalog. Return a dictionary mapping normalized
+    URLs to local file paths.
+
+    :param path: The path to the catalog file.
+    """
+    catalog = {}
+    base = os.path.dirname(path)
+    for entry in etree.parse(path).getroot():
+        if entry.tag == CATALOG_NS + 'uri':
+            name, uri = entry.get('name'), entry.get('uri')
+        elif entry.tag == CATALOG_NS + 'system':
+            name, uri = entry.get('systemId'), entry.get('uri')
+        else:
+            continue
+        catalog[normalize_location(name)] = os.path.join(base, uri)
+    return catalog
+
+CATALOG = load_catalog()
+
+
+class CatalogResolver(etree.Resolver):
+
+    """Resolve schema URLs listed in the catalog to the bundled files."""
+
+    def __init__(self, catalog=CATALOG):
+        super(CatalogResolver, self).__init__()
+        self.catalog = catalog
+
+    def resolve(self, url, public_id, context):
+        path = self.catalog.get(normalize_location(url or ''))
+        if path is not None:
+            return self.resolve_filename(path, context)
+
+
+def schema_locations(tree):
+    """Return the set of (namespace, location) pairs referenced by
+    schemaLocation attributes in tree.
+
+    :param tree: A parsed XML document.
+    """
+    ns_locs = set()
+    for value in tree.xpath('//@*[local-name()="schemaLocation"]'):
+        ns_locs_raw = value.split()
+        for i in range(0, len(ns_locs_raw) - 1, 2):
+            ns_locs.add((ns_locs_raw[i].strip(),
+                         normalize_location(ns_locs_raw[i + 1])))
+    return frozenset(ns_locs)
+
+
+class CompiledSchema(object):
+
+    """An XMLSchema together with a lock: lxml validators must not be used
+    by several threads at once.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self._lock = threading.Lock()
+
+    def assertValid(self, tree):
+        with self._lock:
+            self.schema.assertValid(tree)
+
+
+def compile_schema(ns_locs):
+    """Compile a schema importing all (namespace, location) pairs. Bundled
+    schemas are resolved via the catalog.
+
+    :param ns_locs: Iterable of (namespace, location) pairs.
+    """
+    parser = etree.XMLParser()
+    parser.resolvers.add(CatalogResolver())
+    schema_tree = etree.parse(StringIO(SCHEMA_TEMPLATE), parser)
+    for (ns, loc) in sorted(ns_locs):
+        xs_import = etree.SubElement(schema_tree.getroot(), XS + "import")
+        xs_import.attrib['namespace'] = ns
+        xs_import.attrib['schemaLocation'] = loc
+    return etree.XMLSchema(schema_tree)
+
+
+def get_schema(ns_locs):
+    """Return the cached CompiledSchema for a set of (namespace, location)
+    pairs, compiling it on first use. Compilation errors are not cached.
+
+    :param ns_locs: frozenset of (namespace, location) pairs.
+    """
+    compiled = SCHEMA_CACHE.get(ns_locs)
+    if compiled is None:
+        compiled = CompiledSchema(compile_schema(ns_locs))
+        with _cache_lock:
+            compiled = SCHEMA_CACHE.setdefault(ns_locs, compiled)
+    return compiled
@@ -23,12 +23,76 @@ $(function() {
     form.hide();
     loader.show();
   
-      $.ajax({type: "POST", url: '/_validate', data:{basic_url: url}, success: function(data) {
-      loader.hide();
-      form.show();
-      results.html(data);
-      results.fadeIn("fast");
-    }});
+    $.ajax({type: "POST", url: '/_validate', data:{basic_url: url},
+      success: function(data, textStatus, xhr) {
+        if (xhr.status == 202) {
+          prepare(data.categories);
+          poll(data.status_url, 0);
+        }
+        else
+          show(data);
+      },
+      error: showError
+    });
     return false;
   });
+
+  // Empty sections for the result categories, filled in while the checks
+  // report
+  function prepare(categories) {
+    results.html('<h2>Validation Results</h2>');
+    $.each(categories, function(i, category) {
+      var section = $('<div class="category">').attr('data-category', category);
+      section.append($('<h3>').text(category)).hide();
+      results.append(section);
+    });
+    results.fadeIn("fast");
+  }
+
+  function addResults(items) {
+    $.each(items, function(i, item) {
+      var section = $('div.category', results).filter(function() {
+        return $(this).attr('data-category') == item.category;
+      });
+      var old = $('div[data-check="' + item.check + '"]', section);
+      var result = $('<div>').attr('data-check', item.check).html(item.html);
+      if (old.length)
+        old.replaceWith(result);
+      else
+        section.append(result).show();
+    });
+  }
+
+  // Show the results (or error page) of a validation
+  function show(data) {
+    loader.hide();
+    form.show();
+    results.html(data);
+    results.fadeIn("fast");
+  }
+
+  function showError(xhr) {
+    var message = xhr.responseText;
+    if (xhr.status == 429)
+      message = 'The validator is busy. Please try again in ' +
+        xhr.getResponseHeader('Retry-After') + ' seconds.';
+    show($('<p class="error">').text(message));
+  }
+
+  // Ask for the job's state and new results until the validation is done
+  function poll(status_url, since) {
+    setTimeout(function() {
+      $.ajax({type: "GET", url: status_url, data: {since: since}, cache: false,
+        success: function(data, textStatus, xhr) {
+          if (xhr.status == 202) {
+            addResults(data.results);
+            poll(status_url, data.since);
+          }
+          else
+            show(data);
+        },
+        error: showError
+      });
+    }, 1000);
+  }
 });
\ No newline at end of file
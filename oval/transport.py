@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+    transport.py
+    ~~~~~~~~~~~~
+
+    Pooled HTTP transport with per-host keep-alive connections and a DNS
+    cache. Like urllib2, it honours the proxies configured in the
+    environment (http_proxy, https_proxy, no_proxy) and verifies the
+    certificates of HTTPS servers.
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+import ssl
+import time
+import socket
+import base64
+import httplib
+import threading
+from StringIO import StringIO
+from urllib import getproxies, proxy_bypass, unquote
+from urlparse import urlsplit, urljoin
+
+from urllib2 import URLError, HTTPError
+
+
+MAX_REDIRECTS = 5
+
+REDIRECT_CODES = (301, 302, 303, 307)
+
+# Certificates and host names are checked as by urllib2's default opener
+SSL_CONTEXT = ssl.create_default_context()
+
+
+class ResponseTooLarge(ValueError):
+
+    """The response body exceeds the configured maximum size."""
+
+
+class Proxy(object):
+
+    """A proxy server from the environment (see proxy_for).
+
+       :param host: The host name of the proxy.
+       :param port: The port of the proxy.
+       :param authorization: Optional value of the Proxy-Authorization
+                             header.
+    """
+
+    def __init__(self, host, port, authorization=None):
+        self.host = host
+        self.port = port
+        self.authorization = authorization
+
+    def __eq__(self, other):
+        return (isinstance(other, Proxy) and
+                (self.host, self.port, self.authorization) ==
+                (other.host, other.port, other.authorization))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.host, self.port, self.authorization))
+
+    def headers(self):
+        """Return the headers sent to the proxy."""
+        if self.authorization is None:
+            return {}
+        return {'Proxy-Authorization': self.authorization}
+
+
+def proxy_for(scheme, host):
+    """Return the Proxy for requests to host with scheme (http or https)
+    configured in the environment, as urllib2 would use it, or None.
+    """
+    url = getproxies().get(scheme)
+    if not url or proxy_bypass(host):
+        return None
+    if '://' not in url:
+        url = 'http://' + url
+    parts = urlsplit(url)
+    if not parts.hostname:
+        return None
+    authorization = None
+    if parts.username is not None:
+        credentials = '%s:%s' % (unquote(parts.username),
+                                 unquote(parts.password or ''))
+        authorization = 'Basic ' + base64.b64encode(credentials)
+    return Proxy(parts.hostname, parts.port or 80, authorization)
+
+
+class DNSCache(object):
+
+    """Cache for resolved host addresses.
+
+       :param ttl: Seconds a resolved address is reused.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._addresses = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """Return the getaddrinfo results for (host, port)."""
+        key = (host, port)
+        with self._lock:
+            entry = self._addresses.get(key)
+        if entry is not None and time.time() - entry[0] < self.ttl:
+            return entry[1]
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        with self._lock:
+            self._addresses[key] = (time.time(), addresses)
+        return addresses
+
+    def create_connection(self, address, timeout=None, source_address=None):
+        """Replacement for socket.create_connection using cached addresses."""
+        host, port = address
+        error = None
+        for family, socktype, proto, _, sockaddr in self.resolve(host, port):
+            sock = None
+            try:
+                sock = socket.socket(family, socktype, proto)
+                if timeout is not None:
+                    sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sockaddr)
+                # Requests are small; do not wait for ACKs before sending
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                return sock
+            except socket.error as exc:
+                error = exc
+                if sock is not None:
+                    sock.close()
+        # Addresses may have changed; resolve again next time
+        with self._lock:
+            self._addresses.pop((host, port), None)
+        if error is not None:
+            raise error
+        raise socket.error('getaddrinfo returns an empty list')
+
+
+class Response(object):
+
+    """A completely read HTTP response.
+
+       :param url: The final URL after redirects.
+       :param code: The HTTP status code.
+       :param msg: The HTTP reason phrase.
+       :param headers: The response headers (httplib.HTTPMessage).
+       :param body: The response body.
+    """
+
+    def __init__(self, url, code, msg, headers, body):
+        self.url = url
+        self.code = code
+        self.msg = msg
+        self.headers = headers
+        self._fp = StringIO(body)
+
+    def read(self, size=-1):
+        return self._fp.read(size)
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def close(self):
+        pass
+
+
+class StreamingResponse(Response):
+
+    """An HTTP response whose body is read from the connection on demand.
+    The connection goes back to the pool when the body has been read
+    completely and the response is closed.
+
+       :param pool: The ConnectionPool the connection belongs to.
+       :param pool_key: The (scheme, host, port, proxy) of the connection.
+       :param connection: The httplib connection.
+       :param response: The httplib response.
+       :param max_bytes: Optional maximum size of the body.
+    """
+
+    def __init__(self, url, pool, pool_key, connection, response,
+                 max_bytes=None):
+        self.url = url
+        self.code = response.status
+        self.msg = response.reason
+        self.headers = response.msg
+        self.bytes_read = 0
+        self.max_bytes = max_bytes
+        self._pool = pool
+        self._pool_key = pool_key
+        self._connection = connection
+        self._response = response
+
+    def read(self, size=-1):
+        if self._response is None:
+            return ''
+        if size is None or size < 0:
+            data = self._response.read()
+        else:
+            data = self._response.read(size)
+        self.bytes_read += len(data)
+        if self.max_bytes is not None and self.bytes_read > self.max_bytes:
+            self.close()
+            raise ResponseTooLarge('Response from %s exceeds %d bytes.' %
+                                   (self.url, self.max_bytes))
+        return data
+
+    def close(self):
+        response, self._response = self._response, None
+        if response is None:
+            return
+        if response.isclosed() and not response.will_close:
+            self._pool.release(self._pool_key, self._connection)
+        else:
+            self._connection.close()
+
+
+def read_body(response, max_bytes=None, url=''):
+    """Read a complete response body of at most max_bytes bytes."""
+    if max_bytes is None:
+        return response.read()
+    data = response.read(max_bytes + 1)
+    if len(data) > max_bytes:
+        raise ResponseTooLarge('Response from %s exceeds %d bytes.' %
+                               (url, max_bytes))
+    return data
+
+
+class ConnectionPool(object):
+
+    """Idle keep-alive connections per (scheme, host, port, proxy).
+
+       :param max_idle: Maximum number of idle connections kept per host.
+       :param idle_timeout: Seconds after which idle connections are
+                            discarded.
+       :param dns_cache: DNSCache used to open new connections.
+    """
+
+    def __init__(self, max_idle=4, idle_timeout=30, dns_cache=None):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.dns_cache = dns_cache or DNSCache()
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key, timeout=None):
+        """Return a tuple (connection, reused) for key (scheme, host, port,
+        proxy).
+        """
+        scheme, host, port, proxy = key
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                connection, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    connection.timeout = timeout
+                    if connection.sock is not None:
+                        connection.sock.settimeout(timeout)
+                    return connection, True
+                connection.close()
+        if proxy is not None and scheme == 'https':
+            # Tunnel through the proxy (CONNECT), then talk TLS to host
+            connection = httplib.HTTPSConnection(
+                proxy.host, proxy.port, timeout=timeout, context=SSL_CONTEXT)
+            connection.set_tunnel(host, port, proxy.headers())
+        elif proxy is not None:
+            connection = httplib.HTTPConnection(proxy.host, proxy.port,
+                                                timeout=timeout)
+        elif scheme == 'https':
+            connection = httplib.HTTPSConnection(host, port, timeout=timeout,
+                                                 context=SSL_CONTEXT)
+        else:
+            connection = httplib.HTTPConnection(host, port, timeout=timeout)
+        connection._create_connection = self.dns_cache.create_connection
+        return connection, False
+
+    def release(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append((connection, time.time()))
+                return
+        connection.close()
+
+    def clear(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for connection, _ in idle:
+                    connection.close()
+            self._idle.clear()
+
+    def request(self, method, url, body=None, headers=None, timeout=None,
+                max_bytes=None, stream=False):
+        """Send a single request and return the response as tuple (status,
+        reason, headers, body). If stream is set, body is a
+        StreamingResponse instead of the completely read body.
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError('unknown url type: %s' % url)
+        host = parts.hostname
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = dict(headers or {})
+        if body is not None:
+            headers.setdefault('Content-Type',
+                               'application/x-www-form-urlencoded')
+        proxy = proxy_for(parts.scheme, host)
+        if proxy is not None and parts.scheme == 'http':
+            # Plain HTTP proxies take the absolute URL
+            path = '%s://%s%s' % (parts.scheme, parts.netloc.rsplit('@')[-1],
+                                  path)
+            headers.update(proxy.headers())
+        key = (parts.scheme, host, port, proxy)
+        while True:
+            connection, reused = self.acquire(key, timeout)
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                if stream:
+                    return (response.status, response.reason, response.msg,
+                            StreamingResponse(url, self, key, connection,
+                                              response, max_bytes))
+                data = read_body(response, max_bytes, url)
+            except ResponseTooLarge:
+                connection.close()
+                raise
+            except (socket.error, httplib.HTTPException) as exc:
+                connection.close()
+                if reused and not isinstance(exc, socket.timeout):
+                    # The server closed the idle connection; try a new one
+                    continue
+                if isinstance(exc, socket.timeout):
+                    raise
+                raise URLError(exc)
+            break
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(key, connection)
+        return response.status, response.reason, response.msg, data
+
+
+POOL = ConnectionPool()
+
+
+def urlopen(url, data=None, headers=None, timeout=None, max_bytes=None,
+            stream=False):
+    """Open url through the connection pool, following redirects like
+    urllib2.urlopen. Send a POST request if data is given. Raise
+    urllib2.HTTPError for error responses.
+
+    :param url: The URL to request.
+    :param data: Optional urlencoded POST data.
+    :param headers: Optional dictionary of request headers.
+    :param timeout: The timeout in seconds for the request.
+    :param max_bytes: Optional maximum size of the response body; larger
+                      responses raise ResponseTooLarge.
+    :param stream: Return a StreamingResponse that reads the body on
+                   demand. It must be closed after use.
+    """
+    method = 'GET' if data is None else 'POST'
+    for _ in range(MAX_REDIRECTS + 1):
+        code, msg, hdrs, body = POOL.request(method, url, data, headers,
+                                             timeout, max_bytes, stream)
+        if stream and not 200 <= code < 300:
+            stream_body = body
+            try:
+                body = stream_body.read()
+            finally:
+                stream_body.close()
+        location = hdrs.get('Location')
+        if code in REDIRECT_CODES and location:
+            url = urljoin(url, location)
+            if code != 307:
+                method, data = 'GET', None
+            continue
+        if not 200 <= code < 300:
+            raise HTTPError(url, code, msg, hdrs, StringIO(body))
+        if stream:
+            return body
+        return Response(url, code, msg, hdrs, body)
+    raise HTTPError(url, code, 'Too many redirects', hdrs, StringIO(body))
@@ -10,11 +10,14 @@
 """
 
 import random
-import urllib2
-from urllib import urlencode, urlopen
+import time
+import threading
+from urllib import urlencode
+from urllib2 import HTTPError
 import re
 import argparse
 from urlparse import urlparse
+from multiprocessing.pool import ThreadPool
 from datetime import datetime
 from dateutil import parser as dateparser
 
@@ -24,19 +27,25 @@ from lxml.etree import DocumentInvalid, XMLSchemaParseError
 
 from harvester import configure_record_iterator, configure_request, \
     get_protocol_version, check_HTTP_methods, \
-    get_repository_information, get_granularity
-
-from data import ISO_639_3_CODES, ISO_639_2B_CODES
-from data import ISO_639_2T_CODES, ISO_639_1_CODES
-from functools import reduce
+    get_repository_information, get_granularity, ResponseStore, \
+    enable_disk_cache
+from transport import urlopen
+from scheduler import CheckScheduler
+from retry import DEFAULT_POLICY
+from metrics import ValidationMetrics
+from schemas import get_schema, schema_locations
+from analyzer import RecordAnalyzer, RecordCheck, RecordExtractor
+from checkpoint import CheckpointStore, ResumableHarvest
+from partition import PartitionedHarvest, sized_date_partitions
+
+from data import iso_639_variants
+from functools import partial
 
 OAI_NAMESPACE = "http://www.openarchives.org/OAI/%s/"
 
 DC_NAMESPACE = "http://purl.org/dc/elements/1.1/"
 DC = '{%s}' % DC_NAMESPACE
 
-XS = '{http://www.w3.org/2001/XMLSchema}'
-
 LOOKUP_URL = "http://129.70.43.31/lookup?"
 
 # Minimal Dublin Core elements according to DRIVER and DINI
@@ -47,6 +56,13 @@ MINIMAL_DC_SET = set([
                      'type',
                      'creator'])
 
+# Ways of drawing the record sample (see Validator)
+SAMPLING_METHODS = ('first', 'stratified')
+
+# A UTF-8 lead byte followed by a continuation byte, both decoded as
+# Latin-1: every doubly encoded string contains such a pair
+DOUBLE_UTF8_CANDIDATE = re.compile(u'[\xc2-\xf4][\x80-\xbf]')
+
 # Protocol Version Scheme
 VERSION_PATTERN = re.compile(r'<protocolVersion>(.*?)</protocolVersion>')
 
@@ -58,23 +74,15 @@ DC_DATE_FULL = re.compile(
     r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}([+-]\d{2}:\d{2}|Z)$')
 
 
-SCHEMA_TEMPLATE = """<?xml version = "1.0" encoding = "UTF-8"?>
-<xs:schema xmlns="http://dummy.libxml2.validator"
-targetNamespace="http://dummy.libxml2.validator"
-xmlns:xs="http://www.w3.org/2001/XMLSchema"
-xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
-version="1.0"
-elementFormDefault="qualified"
-attributeFormDefault="unqualified">
-</xs:schema>"""
-
-
 def is_double_encoded(string):
     """Check if a unicode string is doubly encoded in UTF8. Warning: this
     is a hacky heuristic.
 
     :param string: The string whose encoding is to be verified.
     """
+    # Most strings are ruled out by the prefilter without decoding them
+    if not DOUBLE_UTF8_CANDIDATE.search(string):
+        return False
     try:
         cleaned = string.encode('raw_unicode_escape').decode('utf8')
     except UnicodeDecodeError:
@@ -115,6 +123,506 @@ def draw_sample(iterator, size):
     return items
 
 
+class Results(dict):
+
+    """The results dictionary of a Validator. Writes are serialized so that
+    checks running in parallel threads can report safely, and logged so
+    that a validation in progress can be followed (see updates).
+    """
+
+    def __init__(self, *args, **kw):
+        super(Results, self).__init__(*args, **kw)
+        self._lock = threading.RLock()
+        self.log = []
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super(Results, self).__setitem__(key, value)
+            self.log.append(key)
+
+    def updates(self, start=0):
+        """Return a list of the (key, result) pairs written after the first
+        start writes, and the number of writes so far.
+
+        :param start: Number of writes already seen by the caller.
+        """
+        with self._lock:
+            return ([(key, self[key]) for key in self.log[start:]],
+                    len(self.log))
+
+    def snapshot(self):
+        """Return a plain copy of the current results."""
+        with self._lock:
+            return dict(self)
+
+
+class RecordSample(object):
+
+    """Records drawn from a single ListRecords/ListIdentifiers harvest. The
+    harvest includes deleted records and is only continued as far as the
+    largest requested sample requires, so all checks share the same records
+    and pages are downloaded once. Drawing is serialized between threads.
+
+    The records are kept as RecordInfo objects (see analyzer.py) rather
+    than elements, which would keep their whole page documents alive.
+
+       :param RecordIterator: A RecordIterator class (see
+                              configure_record_iterator).
+       :param verb: The OAI-PMH verb.
+       :param metadataPrefix: The OAI-PMH metadataPrefix.
+       :param protocol_version: The OAI-PMH version of the repository.
+    """
+
+    def __init__(self, RecordIterator, verb='ListRecords',
+                 metadataPrefix='oai_dc', protocol_version='2.0'):
+        self.RecordIterator = RecordIterator
+        self.verb = verb
+        self.metadataPrefix = metadataPrefix
+        self.extractor = RecordExtractor(protocol_version)
+        # All records and non-deleted records, in harvesting order
+        self.records = []
+        self.active_records = []
+        self._riter = None
+        self._exhausted = False
+        self._error = None
+        self._lock = threading.RLock()
+
+    def _extend(self):
+        if self._riter is None:
+            self._riter = self.RecordIterator(self.verb, self.metadataPrefix,
+                                              deleted=True)
+        try:
+            record = self._riter.next()
+        except StopIteration:
+            self._exhausted = True
+            self._riter = None
+            return
+        info = self.extractor.extract(record)
+        self.records.append(info)
+        if not info.deleted:
+            self.active_records.append(info)
+
+    def draw(self, size, deleted=False):
+        """Return the first size records of the harvest as RecordInfo
+        objects.
+
+           :param size: Desired sample size.
+           :param deleted: Flag specifying whether deleted records should be
+                           included.
+        """
+        if deleted:
+            items = self.records
+        else:
+            items = self.active_records
+        with self._lock:
+            while len(items) < size and not self._exhausted:
+                if self._error is not None:
+                    raise self._error
+                try:
+                    self._extend()
+                except Exception as exc:
+                    self._error = exc
+                    raise
+            return items[:size]
+
+
+def _allot(size, weights, available):
+    """Divide size among strata in proportion to their weights (largest
+    remainder method), giving no stratum more than it has available.
+    Return the list of shares.
+    """
+    shares = [0] * len(weights)
+    remaining = size
+    open_strata = [i for i in range(len(weights)) if available[i] > 0]
+    while remaining > 0 and open_strata:
+        total = float(sum(weights[i] for i in open_strata))
+        quotas = dict((i, remaining * weights[i] / total if total
+                       else remaining / float(len(open_strata)))
+                      for i in open_strata)
+        rounded = dict((i, int(quota)) for i, quota in quotas.items())
+        missing = remaining - sum(rounded.values())
+        for i in sorted(open_strata, key=lambda i: rounded[i] - quotas[i])[:missing]:
+            rounded[i] += 1
+        allotted = 0
+        for i in open_strata:
+            share = min(rounded[i], available[i] - shares[i])
+            shares[i] += share
+            allotted += share
+        if allotted == 0:
+            break
+        remaining -= allotted
+        open_strata = [i for i in open_strata if shares[i] < available[i]]
+    return shares
+
+
+class StratifiedSample(object):
+
+    """Records drawn from date windows (strata) over the repository's
+    history, from its earliestDatestamp until now. The windows are sized
+    to hold similar numbers of records (see sized_date_partitions), and
+    only the first page of every window is fetched. The records of a
+    sample are allotted to the windows in proportion to their
+    completeListSize and picked at random from these pages. Sizing the
+    windows takes at most strata ListIdentifiers requests, so a sample
+    costs up to twice as many requests as there are strata, and covers old
+    and new records alike.
+    Within a window, records from its first page are preferred; more
+    strata make the windows narrower. Duplicates are dropped.
+
+    If the strata cannot be fetched or yield too few records (e.g. because
+    the server ignores from and until), the sample is filled up from the
+    start of the list. As in RecordSample, the records are kept as
+    RecordInfo objects, and only reserve of them per window, so the pages
+    are released once they are extracted.
+
+       :param request_oai: A request function (see configure_request).
+       :param fallback: The RecordSample used to fill up samples.
+       :param earliest: The earliestDatestamp of the repository.
+       :param granularity: The granularity of the repository ('day' or
+                           'full').
+       :param verb: The OAI-PMH verb.
+       :param metadataPrefix: The OAI-PMH metadataPrefix.
+       :param strata: Number of date windows.
+       :param protocol_version: The OAI-PMH version of the repository.
+       :param reserve: Records kept per window; a window never contributes
+                       more to a sample.
+    """
+
+    def __init__(self, request_oai, fallback, earliest, granularity='day',
+                 verb='ListRecords', metadataPrefix='oai_dc', strata=10,
+                 protocol_version='2.0', reserve=50):
+        self.request_oai = request_oai
+        self.fallback = fallback
+        self.earliest = earliest
+        self.granularity = granularity
+        self.verb = verb
+        self.metadataPrefix = metadataPrefix
+        self.strata = strata
+        self.protocol_version = protocol_version
+        self.reserve = reserve
+        self.extractor = RecordExtractor(protocol_version)
+        self.oai = '{%s}' % (OAI_NAMESPACE % protocol_version)
+        if verb == 'ListIdentifiers':
+            self.element = self.oai + 'header'
+        else:
+            self.element = self.oai + 'record'
+        # Shuffled records and completeListSize of every window
+        self._pages = None
+        self._error = None
+        self._random = random.Random()
+        self._lock = threading.RLock()
+
+    def _fetch(self, partition):
+        tree = self.request_oai(verb=self.verb,
+                                metadataPrefix=self.metadataPrefix,
+                                _from=partition._from, until=partition.until)
+        error = tree.find(self.oai + 'error')
+        if error is not None:
+            if error.get('code') == 'noRecordsMatch':
+                return [], 0
+            raise Exception('%s: %s' % (error.get('code'), error.text))
+        elements = tree.findall('.//' + self.element)
+        size = len(elements)
+        token = tree.find('.//' + self.oai + 'resumptionToken')
+        if token is not None and token.get('completeListSize', '').isdigit():
+            size = max(size, int(token.get('completeListSize')))
+        self._random.shuffle(elements)
+        return [self.extractor.extract(record)
+                for record in elements[:self.reserve]], size
+
+    def _collect(self):
+        partitions = sized_date_partitions(
+            self.request_oai, self.earliest, self.strata, self.granularity,
+            self.metadataPrefix, protocol_version=self.protocol_version,
+            max_probes=self.strata)
+        pool = ThreadPool(len(partitions))
+        try:
+            pages = pool.map(self._fetch, partitions)
+        finally:
+            pool.close()
+        self._pages = []
+        seen = set()
+        for records, size in pages:
+            unique = []
+            for record in records:
+                if record.identifier not in seen:
+                    seen.add(record.identifier)
+                    unique.append(record)
+            self._pages.append((unique, size))
+
+    def draw(self, size, deleted=False):
+        """Return a sample of size records (see RecordSample.draw).
+
+           :param size: Desired sample size.
+           :param deleted: Flag specifying whether deleted records should be
+                           included.
+        """
+        with self._lock:
+            if self._pages is None and self._error is None:
+                try:
+                    self._collect()
+                except Exception as exc:
+                    self._error = exc
+            if self._error is not None:
+                return self.fallback.draw(size, deleted)
+            strata = [[record for record in records
+                       if deleted or not record.deleted]
+                      for records, weight in self._pages]
+            shares = _allot(size, [weight for records, weight in self._pages],
+                            [len(records) for records in strata])
+            sample = []
+            for records, share in zip(strata, shares):
+                sample.extend(records[:share])
+        if len(sample) < size:
+            identifiers = set(record.identifier for record in sample)
+            for record in self.fallback.draw(size, deleted):
+                if len(sample) == size:
+                    break
+                if record.identifier not in identifiers:
+                    sample.append(record)
+        return sample
+
+
+class MinimalDCCheck(RecordCheck):
+
+    """Check for the minimal set of Dublin Core elements."""
+
+    key = 'MinimalDC'
+    unverified_message = 'Minimal DC elements could not be checked: %s'
+
+    def __init__(self, minimal_set=MINIMAL_DC_SET):
+        super(MinimalDCCheck, self).__init__()
+        self.minimal_set = minimal_set
+        self.missing = None
+
+    def inspect(self, record):
+        intersect = self.minimal_set - set(record.dc)
+        if intersect != set():
+            self.missing = (record.identifier, intersect)
+            self.done = True
+
+    def result(self):
+        if self.missing is not None:
+            oai_id, intersect = self.missing
+            message = ("Records should at least contain the DC "
+                       "elements: %s. Found a record (%s) missing the "
+                       "following DC element(s): %s.")
+            return ('warning', message % (", ".join(self.minimal_set),
+                                          oai_id,
+                                          ", ".join(intersect)))
+        return ('ok', 'Minimal DC elements (%s) are '
+                'present.' % ', '.join(self.minimal_set))
+
+
+class DateISOCheck(RecordCheck):
+
+    """Check if dc:date conforms to ISO 8601 (matches YYYY-MM-DD)."""
+
+    key = 'ISO8601'
+    unverified_message = 'dc:date ISO 8601 conformance could not be checked: %s'
+
+    def __init__(self):
+        super(DateISOCheck, self).__init__()
+        # Counts rather than lists, so that full scans use constant memory
+        self.no_date = 0
+        self.wrong_date = 0
+
+    def inspect(self, record):
+        dc_dates = record.texts('date')
+        if dc_dates == []:
+            self.no_date += 1
+            return
+        for date in dc_dates:
+            if not (DC_DATE_YEAR.match(date) or
+                    DC_DATE_MONTH.match(date) or
+                    DC_DATE_DAY.match(date) or
+                    DC_DATE_FULL.match(date)):
+                self.wrong_date += 1
+
+    def result(self):
+        return ('ok', 'dc:date elements conform to ISO 8601.')
+
+
+class LanguageISOCheck(RecordCheck):
+
+    """Check if dc:language conforms to ISO 639-3/-2B/-2T/-1."""
+
+    key = 'ISO639'
+    unverified_message = ('dc:language conformance to ISO 639 could not be '
+                          'checked: %s')
+    no_records = 'no records.'
+
+    def __init__(self):
+        super(LanguageISOCheck, self).__init__()
+        self.supported_isos = set()
+        self.found_language = False
+        self.invalid_language = None
+
+    def inspect(self, record):
+        for language in record.texts('language'):
+            self.found_language = True
+            variants = iso_639_variants(language)
+            if variants:
+                # Report the most specific variant, as before
+                self.supported_isos.add(variants[0])
+            else:
+                self.invalid_language = language
+                self.done = True
+                return
+
+    def result(self):
+        if self.invalid_language is not None:
+            message = ('dc:language should conform to ISO 639, '
+                       'found "%s"' % self.invalid_language)
+            return ('recommendation', message)
+        if not self.found_language:
+            return self.unverified('no dc:language element found')
+        message = 'dc:language elements conform to ISO %s.' % ", ".join(
+            self.supported_isos)
+        return ('ok', message)
+
+
+class IdentifierURLCheck(RecordCheck):
+
+    """Check if dc:identifier contains an absolute URL."""
+
+    key = 'DCIdentifierURL'
+    unverified_message = 'Could not check URL in dc:identifier: %s'
+
+    def __init__(self):
+        super(IdentifierURLCheck, self).__init__()
+        self.found_abs_urls = set()
+        self.warning = None
+
+    def inspect(self, record):
+        identifiers = record.dc.get('identifier', [])
+        if identifiers == []:
+            self.warning = ("Found at least one record missing dc:identifier: %s"
+                            % record.identifier)
+            self.done = True
+            return
+        abs_url = False
+        for identifier in identifiers:
+            if identifier is None:
+                continue
+            if urlparse(identifier).scheme == 'http':
+                abs_url = True
+                # Two distinct URLs are enough to tell them apart
+                if len(self.found_abs_urls) < 2:
+                    self.found_abs_urls.add(identifier)
+        if abs_url == False:
+            self.warning = ("Found at least one record missing an absolute URL "
+                            "in dc:identifier: %s" % record.identifier)
+            self.done = True
+
+    def result(self):
+        if self.warning is not None:
+            return ('warning', self.warning)
+        if self.count > 1 and len(self.found_abs_urls) == 1:
+            message = ("All records have the same URL in dc:identifier: %s"
+                       % list(self.found_abs_urls)[0])
+            return ('warning', message)
+        return ('ok', "Tested records contain absolute URLs in dc:identifier.")
+
+
+class DoubleUTF8Check(RecordCheck):
+
+    """Check if content has been encoded doubly, in any DC element. The
+    check counts over all records and is never done early, so a full scan
+    with it reads every record.
+
+    :param max_examples: Number of affected record identifiers reported.
+    :param max_elements: Number of DC elements reported with their counts.
+    """
+
+    key = 'DoubleUTF8'
+
+    def __init__(self, max_examples=3, max_elements=3):
+        super(DoubleUTF8Check, self).__init__()
+        self.max_examples = max_examples
+        self.max_elements = max_elements
+        # Affected records, in total and by DC element
+        self.found = 0
+        self.elements = {}
+        self.examples = []
+
+    def inspect(self, record):
+        affected = set()
+        for name, texts in record.dc.iteritems():
+            for text in texts:
+                if text is not None and is_double_encoded(text):
+                    affected.add(name)
+                    break
+        if not affected:
+            return
+        self.found += 1
+        for name in affected:
+            self.elements[name] = self.elements.get(name, 0) + 1
+        if (len(self.examples) < self.max_examples and
+                record.identifier is not None):
+            self.examples.append(record.identifier)
+
+    def result(self):
+        if self.found:
+            counts = sorted(self.elements.items(),
+                            key=lambda item: (-item[1], item[0]))
+            elements = ', '.join('dc:%s: %d' % count
+                                 for count in counts[:self.max_elements])
+            if len(counts) > self.max_elements:
+                elements += ', %d more elements' % (
+                    len(counts) - self.max_elements)
+            message = ("Possibly detected double-encoded UTF-8 characters in "
+                       "%d of %d records (%s), e.g. in %s." % (
+                           self.found, self.count, elements,
+                           ', '.join(self.examples) or 'unidentified records'))
+            return ('warning', message)
+
+
+class HandleCheck(RecordCheck):
+
+    """DSpace-specific. Check if the default handle was changed.
+
+    :param timeout: Timeout in seconds for resolving a sample handle.
+    """
+
+    key = 'Handle'
+
+    def __init__(self, timeout=None):
+        super(HandleCheck, self).__init__()
+        self.timeout = timeout
+        # A handle chosen uniformly from all seen (reservoir sampling)
+        self.sample_handle = None
+        self.handles = 0
+
+    def inspect(self, record):
+        for texts in record.dc.values():
+            for text in texts:
+                if text is not None and "http://hdl.handle.net/" in text:
+                    self.handles += 1
+                    if "123456789" in text:
+                        # The placeholder prefix is reported in any case
+                        self.sample_handle = text
+                        self.done = True
+                        return
+                    if random.randrange(self.handles) == 0:
+                        self.sample_handle = text
+
+    def result(self):
+        if self.sample_handle is None:
+            return
+        sample_handle = self.sample_handle
+        if "123456789" in sample_handle:
+            message = "Found an invalid handle using the placeholder prefix: %s" % sample_handle
+            return ('warning', message)
+        try:
+            resp = urlopen(sample_handle, timeout=self.timeout).read()
+            if "<p>-- cannot be found.</p>" in resp:
+                message = "Found an invalid handle: %s" % sample_handle
+                return ('warning', message)
+        except:
+            return
+
+
 class Validator(object):
 
     """OAI-PMH Validator
@@ -137,17 +645,32 @@ class Validator(object):
 
     :param base_url: The OAI-PMH endpoint of the validated repository.
     :param timeout: Optional timeout in seconds for all requests to the server.
+    :param results: Optional Results object to report to (default: a new one).
+    :param sampling: How the record sample is drawn: 'first' (the first
+                     records of the list) or 'stratified' (see
+                     StratifiedSample).
     """
 
-    def __init__(self, base_url, timeout=10):
+    def __init__(self, base_url, timeout=10, results=None, sampling='first'):
         super(Validator, self).__init__()
+        if sampling not in SAMPLING_METHODS:
+            raise ValueError('Unknown sampling method: %s' % sampling)
+        self.sampling = sampling
 
         self.base_url = normalize_base_url(base_url)
         self.timeout = timeout
-        self.results = {}
+        self.results = results if results is not None else Results()
+        # Timings, downloaded bytes, cache use and retries
+        self.metrics = ValidationMetrics()
+        # Waiting time for retries of unavailable (503) responses
+        self.retry_budget = DEFAULT_POLICY.new_budget()
+        # All OAI-PMH responses of this validation, fetched and parsed once
+        self.responses = ResponseStore(self.base_url, timeout=self.timeout,
+                                       budget=self.retry_budget,
+                                       metrics=self.metrics)
 
         # HTTP-Method
-        supported_methods = check_HTTP_methods(self.base_url)
+        supported_methods = check_HTTP_methods(self.base_url, self.responses)
         if len(supported_methods) == 2:
             message = 'Server supports both GET and POST requests.'
             self.results['HTTPMethod'] = ('ok', message)
@@ -162,9 +685,10 @@ class Validator(object):
                        'Falling back to GET.')
             self.results['HTTPMethod'] = ('warning', message)
             self.method = 'GET'
+        self.responses.method = self.method
 
         self.protocol_version = get_protocol_version(
-            self.base_url, self.method)
+            self.base_url, self.method, self.responses)
         if self.protocol_version is None:
             message = 'Could not determine OAI-PMH protocol version; assuming 2.0'
             self.results['ProtocolVersion'] = ('warning', message)
@@ -182,20 +706,59 @@ class Validator(object):
 
         # Preconfigure RecordIterator class for this repo
         self.RecordIterator = configure_record_iterator(self.base_url,
-                                                        self.protocol_version, self.method, self.timeout)
+                                                        self.protocol_version, self.method, self.timeout,
+                                                        self.responses, self.retry_budget,
+                                                        self.metrics)
+        # Record samples shared by the record-level checks
+        self.samples = {}
+        self._samples_lock = threading.Lock()
         self.oai_namespace = OAI_NAMESPACE % self.protocol_version
         self.oai = "{%s}" % self.oai_namespace
 
         # General Repository Information
         self.repository_name, self.admin_email = get_repository_information(
             self.base_url,
-            self.method)
-        self.granularity = get_granularity(self.base_url, self.method)
+            self.method,
+            self.responses)
+        self.granularity = get_granularity(self.base_url, self.method,
+                                           self.responses)
         if self.granularity is None:
             # Fall back to day granularity in case it could not be determined
             self.granularity = 'day'
-        self.request_oai = configure_request(
-            self.base_url, self.method, timeout=self.timeout)
+        # Shared, parsed responses; requests that are not worth keeping
+        # (e.g. follow-up pages) go through _request_oai
+        self.request_oai = self.responses
+        self._request_oai = configure_request(
+            self.base_url, self.method, timeout=self.timeout,
+            budget=self.retry_budget, metrics=self.metrics)
+        self.metrics.record_check('Setup', time.time() - self.metrics.started)
+
+    def sample_records(self, size=50, deleted=False, verb='ListRecords',
+                       metadataPrefix='oai_dc'):
+        """Return a sample of the repository's records as RecordInfo
+        objects (see analyzer.py). The sample is harvested once per verb and
+        metadataPrefix and shared by all record-level checks.
+
+        :param size: Desired sample size.
+        :param deleted: Flag specifying whether deleted records should be
+                        included.
+        :param verb: The OAI-PMH verb.
+        :param metadataPrefix: The OAI-PMH metadataPrefix.
+        """
+        key = (verb, metadataPrefix)
+        with self._samples_lock:
+            if key not in self.samples:
+                sample = RecordSample(self.RecordIterator, verb,
+                                      metadataPrefix, self.protocol_version)
+                if self.sampling == 'stratified':
+                    identify = self.responses.identify() or {}
+                    sample = StratifiedSample(
+                        self._request_oai, sample,
+                        identify.get('earliestDatestamp'), self.granularity,
+                        verb, metadataPrefix,
+                        protocol_version=self.protocol_version)
+                self.samples[key] = sample
+        return self.samples[key].draw(size, deleted)
 
     def indexed_in_BASE(self):
         """Check if the repository is indexed in BASE. This method calls an external
@@ -204,7 +767,7 @@ class Validator(object):
         # Remove '?' from end of base_url
         params = {'basic_url': self.base_url[:-1]}
         data = urlencode(params)
-        result = urllib2.urlopen(LOOKUP_URL + data)
+        result = urlopen(LOOKUP_URL + data)
         result_tree = etree.parse(result)
         indexed = result_tree.getroot()
         timestamp = indexed.attrib['timestamp']
@@ -222,7 +785,10 @@ class Validator(object):
         Some servers redirect requests to new endpoints.
         """
         try:
-            response = urlopen(self.base_url)
+            response = urlopen(self.base_url, timeout=self.timeout)
+        except HTTPError as exc:
+            # Error responses still tell where the request ended up
+            response = exc
         except Exception as exc:
             message = "Could not compare basic URLs: %s" % unicode(exc)
             self.results['BaseURLMatch'] = ('unverified', message)
@@ -257,23 +823,7 @@ class Validator(object):
             self.results['%sXML' % verb] = ('unverified', message)
             return
         try:
-            xml_string = etree.tounicode(tree)
-            schema_locs = set(re.findall(
-                r'schemaLocation="(.*?)"', xml_string, re.DOTALL))
-            schema_tree = etree.XML(SCHEMA_TEMPLATE)
-            for s in set(schema_locs):
-                ns_locs_raw = s.split()
-                try:
-                    ns_locs = [(ns_locs_raw[i], ns_locs_raw[
-                                i + 1]) for i in range(0, len(ns_locs_raw), 2)]
-                except IndexError:
-                    ns_locs = []
-                for (ns, loc) in ns_locs:
-                    xs_import = etree.Element(XS + "import")
-                    xs_import.attrib['namespace'] = ns.strip()
-                    xs_import.attrib['schemaLocation'] = loc.strip()
-                    schema_tree.append(xs_import)
-            schema = etree.XMLSchema(schema_tree)
+            schema = get_schema(schema_locations(tree))
             schema.assertValid(tree)
             self.results['%sXML' % verb] = (
                 'ok', '%s response well-formed and valid.' % verb)
@@ -334,8 +884,8 @@ class Validator(object):
            :param sample_size: How many records should be inspected?
         """
         try:
-            riter = self.RecordIterator(verb, metadataPrefix)
-            records = draw_sample(riter, sample_size)
+            records = self.sample_records(sample_size, verb=verb,
+                                          metadataPrefix=metadataPrefix)
         except Exception as exc:
             message = "Incremental harvesting (%s granularity) of %s could not be checked: %s" % (
                 granularity, verb, unicode(exc))
@@ -348,16 +898,13 @@ class Validator(object):
             self.results['Incremental%s%s' % (verb,
                                               granularity)] = ('unverified', message)
             return
-        reference_record = random.sample(records, 1)[0]
-        reference_datestamp_elem = reference_record.find(
-            './/' + self.oai + 'datestamp')
-        if reference_datestamp_elem is None:
+        reference_datestamp = random.sample(records, 1)[0].datestamp
+        if reference_datestamp is None:
             message = "Incremental harvesting (%s granularity) of %s could not be checked: No datestamp." % (
                 granularity, verb)
             self.results['Incremental%s%s' % (verb,
                                               granularity)] = ('unverified', message)
             return
-        reference_datestamp = reference_datestamp_elem.text
         if not (DC_DATE_DAY.match(reference_datestamp) or DC_DATE_FULL.match(reference_datestamp)):
             message = ("Incremental harvesting (%s granularity) of %s could not be checked: "
                        "Incorrect format for datestamp: %s." % (granularity, verb, reference_datestamp))
@@ -418,118 +965,21 @@ class Validator(object):
         :param minimal_set: The set of minimal DC elements that should be present.
         :param sample_size: How many records should be inspected?
         """
-        try:
-            riter = self.RecordIterator(verb='ListRecords',
-                                        metadataPrefix='oai_dc', deleted=False)
-            records = draw_sample(riter, sample_size)
-        except Exception as exc:
-            message = 'Minimal DC elements could not be checked: %s' % unicode(
-                exc)
-            self.results['MinimalDC'] = ('unverified', message)
-            return
-        if len(records) == 0:
-            message = "Minimal DC elements could not be checked: No records."
-            self.results['MinimalDC'] = ('unverified', message)
-            return
-        for record in records:
-            oai_id = record.find('.//' + self.oai + 'identifier').text
-            dc_elements = record.findall('.//' + DC + '*')
-            # Remove the namespace from dc:tags
-            dc_tags = set([dc.tag.replace(DC, '') for dc in dc_elements])
-            intersect = minimal_set - dc_tags
-            if intersect != set():
-                message = ("Records should at least contain the DC "
-                           "elements: %s. Found a record (%s) missing the "
-                           "following DC element(s): %s.")
-                self.results['MinimalDC'] = ('warning', message % (
-                                             ", ".join(minimal_set),
-                                             oai_id,
-                                             ", ".join(intersect)))
-                return
-        self.results['MinimalDC'] = ('ok', 'Minimal DC elements (%s) are '
-                                     'present.' % ', '.join(minimal_set))
+        self.check_records([MinimalDCCheck(minimal_set)], sample_size)
 
     def dc_date_ISO(self, sample_size=50):
         """Check if dc:date conforms to ISO 8601 (matches YYYY-MM-DD).
 
         :param sample_size: How many records should be inspected?
         """
-        try:
-            riter = self.RecordIterator(verb='ListRecords',
-                                        metadataPrefix='oai_dc', deleted=False)
-            records = draw_sample(riter, sample_size)
-        except Exception as exc:
-            message = 'dc:date ISO 8601 conformance could not be checked: %s' % unicode(
-                exc)
-            self.results['ISO8601'] = ('unverified', message)
-            return
-        if len(records) == 0:
-            message = "dc:date ISO 8601 conformance could not be checked: No records."
-            self.results['ISO8601'] = ('unverified',
-                                       message)
-            return
-        no_date = []
-        wrong_date = []
-
-        for record in records:
-            dc_dates = record.findall('.//' + DC + 'date')
-            dc_dates = filter(lambda d: d.text is not None, dc_dates)
-            if dc_dates == []:
-                no_date.append(record)
-                continue
-            for dc_date in dc_dates:
-                date = dc_date.text
-                if not (DC_DATE_YEAR.match(date) or
-                        DC_DATE_MONTH.match(date) or
-                        DC_DATE_DAY.match(date) or
-                        DC_DATE_FULL.match(date)):
-                    wrong_date.append(record)
-        self.results['ISO8601'] = ('ok', 'dc:date elements conform to ISO 8601.')
+        self.check_records([DateISOCheck()], sample_size)
 
     def dc_language_ISO(self, sample_size=50):
         """Check if dc:language conforms to ISO 639-3/-2B/-2T/-1.
 
         :param sample_size: How many records should be inspected?
         """
-        try:
-            riter = self.RecordIterator(
-                verb='ListRecords', metadataPrefix='oai_dc')
-            records = draw_sample(riter, sample_size)
-        except Exception as exc:
-            message = 'dc:language conformance to ISO 639 could not be checked: %s' % unicode(
-                exc)
-            self.results['ISO639'] = ('unverified', message)
-            return
-        if len(records) == 0:
-            message = 'dc:language conformance to ISO 639 could not be checked: no records.'
-            self.results['ISO639'] = ('unverified', message)
-            return
-        language_elements = reduce(lambda x, y: x + y, [r.findall('.//' + DC + 'language')
-                                                        for r in records])
-        languages = [e.text for e in language_elements if e.text is not None]
-        if languages == []:
-            message = ('dc:language conformance to ISO 639 could not be checked: '
-                       'no dc:language element found')
-            self.results['ISO639'] = ('unverified', message)
-            return
-        supported_isos = set()
-        for language in languages:
-            if language in ISO_639_3_CODES:
-                supported_isos.add('639-3')
-            elif language in ISO_639_2B_CODES:
-                supported_isos.add('639-2B')
-            elif language in ISO_639_2T_CODES:
-                supported_isos.add('639-2T')
-            elif language in ISO_639_1_CODES:
-                supported_isos.add('639-1')
-            else:
-                message = ('dc:language should conform to ISO 639, '
-                           'found "%s"' % language)
-                self.results['ISO639'] = ('recommendation', message)
-                return
-        message = 'dc:language elements conform to ISO %s.' % ", ".join(
-            supported_isos)
-        self.results['ISO639'] = ('ok', message)
+        self.check_records([LanguageISOCheck()], sample_size)
 
     def check_resumption_token(self, verb, metadataPrefix='oai_dc'):
         """Check resumption requests.
@@ -558,8 +1008,9 @@ class Validator(object):
             self.results['ResumptionToken'] = ('error', message)
             return
         try:
-            tree = self.request_oai(verb=verb, resumptionToken=token_text)
-            records = tree.findall('.//' + self.oai + 'record')
+            resumed_tree = self._request_oai(verb=verb,
+                                             resumptionToken=token_text)
+            records = resumed_tree.findall('.//' + self.oai + 'record')
             if not records:
                 message = 'Request for resumptionToken "%s" returned no records!' % token_text
                 self.results['ResumptionToken'] = ('error', message)
@@ -595,9 +1046,11 @@ class Validator(object):
                            'invalid date format: %s' % expiration_date)
                 self.results['ResumptionTokenExp'] = ('error', message)
 
-        # Check completeListSize
-        riter = self.RecordIterator(verb=verb, metadataPrefix=metadataPrefix)
-        number_of_records = len(riter.record_list)
+        # Check completeListSize against the non-deleted records of the
+        # first batch
+        headers = tree.findall('.//' + self.oai + 'header')
+        number_of_records = len([h for h in headers
+                                 if h.attrib.get('status') != 'deleted'])
         attribs = resumption_token.attrib
         list_size = attribs.get('completeListSize')
         if list_size is None:
@@ -651,92 +1104,231 @@ class Validator(object):
 
         :param sample_size: How many records should be inspected?
         """
+        self.check_records([IdentifierURLCheck()], sample_size)
+
+    def check_double_utf8(self, sample_size=50):
+        """Check if the DC elements' content has been encoded doubly.
+
+        :param sample_size: How many records should be inspected?
+        """
+        self.check_records([DoubleUTF8Check()], sample_size)
+
+    def check_handle(self, sample_size=50):
+        """DSpace-specific. Check if the default handle was changed.
+
+        :param sample_size: How many records should be inspected?
+        """
+        self.check_records([HandleCheck(self.timeout)], sample_size)
+
+    def record_checks(self):
+        """Return new instances of all record-level checks."""
+        return [MinimalDCCheck(), DateISOCheck(), LanguageISOCheck(),
+                IdentifierURLCheck(), DoubleUTF8Check(),
+                HandleCheck(self.timeout)]
+
+    def check_records(self, checks=None, sample_size=50):
+        """Evaluate record-level checks on the shared record sample in a
+        single pass over the records.
+
+        :param checks: List of RecordCheck instances (default: all, see
+                       record_checks).
+        :param sample_size: How many records should be inspected?
+        """
+        if checks is None:
+            checks = self.record_checks()
         try:
-            riter = self.RecordIterator(
-                verb='ListRecords', metadataPrefix='oai_dc')
-            records = draw_sample(riter, sample_size)
+            records = self.sample_records(sample_size)
         except Exception as exc:
-            message = "Could not check URL in dc:identifier: %s" % unicode(exc)
-            self.results['DCIdentifierURL'] = ('unverified', message)
+            self._report(checks, lambda check: check.unverified(unicode(exc)))
             return
         if len(records) == 0:
-            message = "Could not check URL in dc:identifier: No records."
-            self.results['DCIdentifierURL'] = ('unverified', message)
+            self._report(checks, lambda check: check.unverified(
+                check.no_records))
             return
-            # message = ("Could not check for absolute URLs in dc:identifiers: "
-            #            "No dc:identifiers found.")
-            # self.results.append(('DCIdentifierURL', 'unverified', message))
-        found_abs_urls = set()
-        for record in records:
-            abs_url = False
-            oai_id = record.find('.//' + self.oai + 'identifier').text
-            identifiers = record.findall('.//' + DC + 'identifier')
-            if identifiers == []:
-                message = ("Found at least one record missing dc:identifier: %s"
-                           % oai_id)
-                self.results['DCIdentifierURL'] = ('warning', message)
-                return
-            for identifier_element in identifiers:
-                identifier = identifier_element.text
-                if identifier is None:
-                    continue
-                if urlparse(identifier).scheme == 'http':
-                    abs_url = True
-                    found_abs_urls.add(identifier)
-            if abs_url == False:
-                message = ("Found at least one record missing an absolute URL "
-                           "in dc:identifier: %s" % oai_id)
-                self.results['DCIdentifierURL'] = ('warning', message)
-                return
-        if len(records) > 1 and len(found_abs_urls) == 1:
-            message = ("All records have the same URL in dc:identifier: %s"
-                       % list(found_abs_urls)[0])
-            self.results['DCIdentifierURL'] = ('warning', message)
-            return
-        message = "Tested records contain absolute URLs in dc:identifier."
-        self.results['DCIdentifierURL'] = ('ok', message)
-
-    def check_double_utf8(self):
-        """Check if content has been encoded doubly."""
+        analyzer = RecordAnalyzer(checks, self.protocol_version)
+        analyzer.run(records)
+        self._report(checks, lambda check: check.result())
+
+    def scan_records(self, checks=None, metadataPrefix='oai_dc',
+                     checkpoints=None, workers=1):
+        """Evaluate record-level checks on all records of the repository.
+        The pages are parsed while they are downloaded and every record is
+        dropped once the checks have seen it, so memory use does not grow
+        with the size of the repository. Some checks (e.g. DateISOCheck)
+        count over all records and are never done early, so with the
+        default checks every record is read. Return the number of records
+        analyzed.
+
+        If the harvest fails, checks that have not found a problem by then
+        are reported as unverified. With checkpoints, the progress and the
+        checks are saved after every page, and a later scan of the same
+        repository continues where the failed one stopped. Otherwise, with
+        several workers, the datestamp range is split into windows of
+        similar size that are harvested concurrently (see partition.py).
+
+        :param checks: List of RecordCheck instances (default: all, see
+                       record_checks).
+        :param metadataPrefix: The OAI-PMH metadataPrefix.
+        :param checkpoints: Optional checkpoint.CheckpointStore.
+        :param workers: Number of date windows harvested at the same time.
+        """
+        if checks is None:
+            checks = self.record_checks()
+        analyzer = RecordAnalyzer(checks, self.protocol_version)
+        harvest = error = None
         try:
-            tree = self.request_oai(
-                verb='ListRecords', metadataPrefix='oai_dc')
-        except Exception:
-            return
-        descriptions = tree.findall('.//' + DC + 'description')
-        description_texts = [
-            d.text for d in descriptions if d.text is not None]
-
-        for text in description_texts:
-            if is_double_encoded(text):
-                message = "Possibly detected double-encoded UTF-8 characters."
-                self.results['DoubleUTF8'] = ('warning', message)
-                return
+            if checkpoints is None and workers > 1:
+                analyzer.run(self._partitioned_harvest(metadataPrefix,
+                                                       workers))
+            elif checkpoints is None:
+                records = self.RecordIterator('ListRecords', metadataPrefix,
+                                              stream=True)
+                analyzer.run(records)
+            else:
+                harvest = ResumableHarvest(
+                    self.base_url, self.RecordIterator, checkpoints,
+                    metadataPrefix=metadataPrefix, stream=True,
+                    protocol_version=self.protocol_version)
+                harvest.run(_analyze, analyzer)
+        except Exception as exc:
+            error = exc
+        if harvest is not None and harvest.checkpoint is not None:
+            # The analyzer of an interrupted scan may have been restored
+            analyzer = harvest.checkpoint.state
+            checks = analyzer.checks
+        if error is not None:
+            reason = unicode(error)
+            if analyzer.count:
+                reason = 'harvest failed after %d records: %s' % (
+                    analyzer.count, reason)
+            self._report(checks, lambda check: check.result() if check.done
+                         else check.unverified(reason))
+            return analyzer.count
+        if analyzer.count == 0:
+            self._report(checks, lambda check: check.unverified(
+                check.no_records))
+        else:
+            self._report(checks, lambda check: check.result())
+        return analyzer.count
+
+    def _partitioned_harvest(self, metadataPrefix, workers):
+        identify = self.responses.identify() or {}
+        # More windows than workers, so that workers finishing early
+        # take over the remaining ones
+        partitions = sized_date_partitions(
+            self._request_oai, identify.get('earliestDatestamp'), workers * 4,
+            self.granularity, metadataPrefix,
+            protocol_version=self.protocol_version)
+        return PartitionedHarvest(self.RecordIterator, partitions,
+                                  metadataPrefix=metadataPrefix,
+                                  workers=workers,
+                                  protocol_version=self.protocol_version)
+
+    def _report(self, checks, get_result):
+        for check in checks:
+            result = get_result(check)
+            if result is not None:
+                self.results[check.key] = result
+
+
+def _analyze(analyzer, record):
+    # Feed for ResumableHarvest: stop once all checks are done
+    analyzer.feed(record)
+    return analyzer.done
+
+
+def prefetch(validator, verb, metadataPrefix='oai_dc', sample_size=None):
+    """Fetch the first page of verb (or a record sample of sample_size
+    records) into the validator's shared stores. Failures are left to be
+    reported by the checks that need the data.
+    """
+    try:
+        if sample_size is None:
+            validator.responses.tree(verb=verb, metadataPrefix=metadataPrefix)
+        else:
+            validator.sample_records(sample_size, verb=verb,
+                                     metadataPrefix=metadataPrefix)
+    except Exception:
+        pass
 
-    def check_handle(self):
-        """DSpace-specific. Check if the default handle was changed."""
-        try:
-            tree = self.request_oai(
-                verb='ListRecords', metadataPrefix='oai_dc')
-        except Exception:
-            return
-        text_iterator = tree.itertext()
-        handles = [t for t in text_iterator if "http://hdl.handle.net/" in t]
-        if handles == []:
-            return
-        sample_handle = random.sample(handles, 1)[0]
-        if "123456789" in sample_handle:
-            message = "Found an invalid handle using the placeholder prefix: %s" % sample_handle
-            self.results['Handle'] = ('warning', message)
-            return
-        try:
-            resp = urllib2.urlopen(sample_handle).read()
-            if "<p>-- cannot be found.</p>" in resp:
-                message = "Found an invalid handle: %s" % sample_handle
-                self.results['Handle'] = ('warning', message)
-        except:
-            return
-        return
+
+def schedule_checks(val, max_workers=4, list_identifiers=False,
+                    full_scan=False, checkpoints=None, harvest_workers=1):
+    """Return a CheckScheduler with the standard checks for validator.
+    Checks only depend on the data they share: the first ListRecords page
+    and the record sample; everything else runs concurrently.
+
+    :param val: The Validator instance.
+    :param max_workers: Maximum number of checks running at the same time.
+    :param list_identifiers: Also check the ListIdentifiers batch size.
+    :param full_scan: Run the record-level checks on all records instead
+                      of the sample (see Validator.scan_records).
+    :param checkpoints: Optional checkpoint.CheckpointStore making the full
+                        scan resumable.
+    :param harvest_workers: Number of date windows harvested at the same
+                            time by the full scan.
+    """
+    scheduler = CheckScheduler(max_workers)
+
+    def add(name, function, requires=()):
+        scheduler.add(name, val.metrics.timed(name, function), requires)
+    # Shared data
+    add('ListRecords', partial(prefetch, val, 'ListRecords'))
+    add('RecordSample', partial(prefetch, val, 'ListRecords', sample_size=50),
+        requires=['ListRecords'])
+    # Identify (fetched on instantiation)
+    add('BaseURLMatch', val.check_identify_base_url)
+    add('IdentifyXML', partial(val.validate_XML, 'Identify'))
+    add('DeletingStrategy', val.check_deleting_strategy)
+    # First ListRecords page
+    page = ['ListRecords']
+    add('ListRecordsXML', partial(val.validate_XML, 'ListRecords'),
+        requires=page)
+    add('ResumptionToken', partial(val.check_resumption_token, 'ListRecords'),
+        requires=page)
+    add('ListRecordsBatch', partial(val.reasonable_batch_size, 'ListRecords'),
+        requires=page)
+    if list_identifiers:
+        add('ListIdentifiersBatch',
+            partial(val.reasonable_batch_size, 'ListIdentifiers'))
+    # Record sample
+    sample = ['RecordSample']
+    if full_scan:
+        add('RecordChecks', partial(val.scan_records,
+                                    checkpoints=checkpoints,
+                                    workers=harvest_workers))
+    else:
+        add('RecordChecks', val.check_records, requires=sample)
+    granularities = []
+    if val.granularity == 'day':
+        granularities = ['day']
+    elif val.granularity == 'full':
+        granularities = ['day', 'full']
+    for granularity in granularities:
+        add('IncrementalListRecords%s' % granularity,
+            partial(val.incremental_harvesting, 'ListRecords', granularity),
+            requires=sample)
+    return scheduler
+
+
+def run_checks(val, max_workers=4, list_identifiers=False, full_scan=False,
+               checkpoints=None, harvest_workers=1):
+    """Run the standard checks (see schedule_checks) and record the
+    duration of the whole validation in val.metrics.
+
+    :param val: The Validator instance.
+    :param max_workers: Maximum number of checks running at the same time.
+    :param list_identifiers: Also check the ListIdentifiers batch size.
+    :param full_scan: Check all records instead of a sample.
+    :param checkpoints: Optional checkpoint.CheckpointStore for the full
+                        scan.
+    :param harvest_workers: Concurrent harvests of the full scan.
+    """
+    try:
+        schedule_checks(val, max_workers, list_identifiers, full_scan,
+                        checkpoints, harvest_workers).run()
+    finally:
+        val.metrics.record_validation()
 
 
 def main():
@@ -745,35 +1337,37 @@ def main():
     parser = argparse.ArgumentParser(description='OVAL -- OAI-PHM Validator')
     parser.add_argument('base_url', type=str,
                         help='the basic URL of the OAI-PMH interface')
+    parser.add_argument('--disk-cache', metavar='PATH',
+                        help='keep responses in an SQLite database at PATH')
+    parser.add_argument('--full-scan', action='store_true',
+                        help='check all records instead of a sample')
+    parser.add_argument('--checkpoints', metavar='PATH',
+                        help='save the progress of the full scan in an '
+                        'SQLite database at PATH and resume from it')
+    parser.add_argument('--harvest-workers', type=int, default=1,
+                        help='harvest the full scan in this many date '
+                        'windows at once (not with --checkpoints)')
+    parser.add_argument('--sampling', choices=SAMPLING_METHODS,
+                        default='first',
+                        help='draw the record sample from the start of the '
+                        'list or from date windows over the whole history '
+                        '(default: first)')
 
     args = parser.parse_args()
 
     base_url = args.base_url
+    if args.disk_cache:
+        enable_disk_cache(args.disk_cache)
 
-    val = Validator(base_url)
+    val = Validator(base_url, sampling=args.sampling)
     print "Repository: %s" % val.repository_name
 
     # Run checks
-    val.check_identify_base_url()
-    val.validate_XML('Identify')
-    val.validate_XML('ListRecords')
-    val.check_resumption_expiration_date('ListRecords')
-    val.check_resumption_list_size('ListRecords')
-    val.reasonable_batch_size('ListRecords')
-    val.reasonable_batch_size('ListIdentifiers')
-    val.dc_language_ISO()
-    val.dc_date_ISO()
-    val.minimal_dc_elements()
-
-    if val.granularity == 'day':
-        val.incremental_harvesting('ListRecords', 'day')
-    elif val.granularity == 'full':
-        val.incremental_harvesting('ListRecords', 'day')
-        val.incremental_harvesting('ListRecords', 'full')
-    val.dc_identifier_abs()
-    val.check_deleting_strategy()
-    val.check_double_utf8()
-    val.check_handle()
+    checkpoints = None
+    if args.checkpoints:
+        checkpoints = CheckpointStore(args.checkpoints)
+    run_checks(val, list_identifiers=True, full_scan=args.full_scan,
+               checkpoints=checkpoints, harvest_workers=args.harvest_workers)
     #val.indexed_in_BASE()
 
     pprint(val.results)
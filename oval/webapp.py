@@ -2,25 +2,65 @@
 
 import sys
 import os
+import time
+import json
 
 # Add local directoty to import path
 this_dir, this_filename = os.path.split(__file__)
 sys.path.insert(0, os.path.abspath(this_dir))
 
 from urllib2 import HTTPError, URLError
-from flask import Flask, request, render_template, get_template_attribute
+from flask import Flask, request, render_template, get_template_attribute, \
+    make_response, jsonify, redirect, url_for
 
 from lxml.etree import XMLSyntaxError
 from ordereddict import OrderedDict
 from lepl.apps.rfc3696 import HttpUrl
 
-from validator import Validator
+from validator import Validator, Results, run_checks, normalize_base_url
+from harvester import enable_disk_cache, enable_rate_limit, identify_fingerprint
+from transport import urlopen
+from cache import LRUCache
+from metrics import REGISTRY
+from jobs import Job, JobRunner, JobStore, QueueFull
 
 
 __version__ = '0.1.0'
 
 # configuration
 
+# Optional on-disk response cache shared by all worker processes
+DISK_CACHE_PATH = os.environ.get('OVAL_DISK_CACHE')
+
+# Optional database for per-host request rate limits shared with other
+# processes (e.g. bulk validations)
+RATE_LIMIT_PATH = os.environ.get('OVAL_RATE_LIMIT')
+
+# Number of checks of one validation running concurrently
+CHECK_WORKERS = 4
+
+# Validations running concurrently in the background
+JOB_WORKERS = 4
+
+# Validations waiting for a worker before new ones are rejected (429)
+JOB_QUEUE_SIZE = 20
+
+# Seconds finished validations are kept for polling
+JOB_TTL = 3600
+
+# Seconds between reloads of the page of a pending validation
+JOB_POLL_INTERVAL = 2
+
+# Seconds the results of a validation are reused as long as the
+# repository's Identify response does not change
+RESULTS_TTL = 24 * 60 * 60
+
+# Upper bound for the memory used by cached results in bytes
+RESULTS_CACHE_SIZE = 16 * 1024 * 1024
+
+# Timeout in seconds for the Identify request checking cached results
+IDENTIFY_TIMEOUT = 10
+
 RESULT_CATEGORIES = OrderedDict(
     [('Server communication', ['HTTPMethod', 'ProtocolVersion', 'BaseURLMatch']),
      ('XML Validation', [
@@ -38,36 +78,90 @@ RESULT_CATEGORIES = OrderedDict(
                        'DoubleUTF8',
                        'Handle'])])
 
+# Category of each check
+CHECK_CATEGORIES = dict((check, category)
+                        for category, checks in RESULT_CATEGORIES.items()
+                        for check in checks)
+
 
 # application
 app = Flask(__name__)
 app.config.from_object(__name__)
 app.config['DEBUG'] = True
 
+if app.config['DISK_CACHE_PATH']:
+    enable_disk_cache(app.config['DISK_CACHE_PATH'])
+
+if app.config['RATE_LIMIT_PATH']:
+    enable_rate_limit(app.config['RATE_LIMIT_PATH'])
+
 url_is_valid = HttpUrl()
 
+# Reports of finished validations by normalized base URL
+REPORTS = LRUCache(max_bytes=app.config['RESULTS_CACHE_SIZE'],
+                   ttl=app.config['RESULTS_TTL'])
+
+
+class Report(object):
+
+    """What is shown of a finished validation: the repository information,
+    the results and the fingerprint of the Identify response they were
+    obtained with.
+    """
 
-def validate_repository(basic_url):
-    val = Validator(basic_url, timeout=40)
-    val.check_identify_base_url()
-    val.validate_XML('Identify')
-    val.validate_XML('ListRecords')
-    val.check_resumption_token('ListRecords')
-    val.reasonable_batch_size('ListRecords')
-    val.dc_language_ISO()
-    val.dc_date_ISO()
-    val.minimal_dc_elements()
-
-    if val.granularity == 'day':
-        val.incremental_harvesting('ListRecords', 'day')
-    elif val.granularity == 'full':
-        val.incremental_harvesting('ListRecords', 'day')
-        val.incremental_harvesting('ListRecords', 'full')
-    val.dc_identifier_abs()
-    val.check_deleting_strategy()
-    val.check_double_utf8()
-    val.check_handle()
-    return val
+    def __init__(self, base_url, repository_name, admin_email, results,
+                 fingerprint=None):
+        self.base_url = base_url
+        self.repository_name = repository_name
+        self.admin_email = admin_email
+        self.results = results
+        self.fingerprint = fingerprint
+        self.validated = time.time()
+
+    def size(self):
+        """Return the approximate memory used by the report in bytes (the
+        length of its fields serialized as JSON).
+        """
+        return len(json.dumps([self.base_url, self.repository_name,
+                               self.admin_email, self.results,
+                               self.fingerprint]))
+
+
+def validate_repository(basic_url, results=None):
+    val = Validator(basic_url, timeout=40, results=results)
+    run_checks(val, max_workers=app.config['CHECK_WORKERS'])
+    try:
+        fingerprint = identify_fingerprint(val.responses.raw(verb='Identify'))
+    except Exception:
+        fingerprint = None
+    report = Report(val.base_url, val.repository_name, val.admin_email,
+                    val.results.snapshot(), fingerprint)
+    if fingerprint is not None:
+        REPORTS.set(val.base_url, report, size=report.size())
+    return report
+
+
+def cached_report(basic_url):
+    """Return the cached Report for basic_url if the repository's current
+    Identify response has the same fingerprint, otherwise None.
+    """
+    base_url = normalize_base_url(basic_url)
+    report = REPORTS.get(base_url)
+    if report is None:
+        return None
+    try:
+        response = urlopen(base_url + 'verb=Identify',
+                           timeout=app.config['IDENTIFY_TIMEOUT']).read()
+    except Exception:
+        return None
+    if identify_fingerprint(response) != report.fingerprint:
+        REPORTS.delete(base_url)
+        return None
+    return report
+
+jobs = JobRunner(validate_repository, workers=app.config['JOB_WORKERS'],
+                 max_queued=app.config['JOB_QUEUE_SIZE'],
+                 store=JobStore(ttl=app.config['JOB_TTL']))
 
 
 def categorize_results(results):
@@ -90,63 +184,145 @@ def index():
     return render_template('index.html')
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Export the validation metrics of this process for Prometheus."""
+    response = make_response(REGISTRY.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return response
+
+
+def error_message(exc):
+    """Return the message shown for an exception that ended a validation."""
+    if isinstance(exc, HTTPError):
+        return '%d %s' % (exc.code, exc.msg)
+    if isinstance(exc, (ValueError, URLError)):
+        return exc.args[0]
+    if isinstance(exc, XMLSyntaxError):
+        return 'Invalid OAI-PMH interface (Identify): %s' % exc.args[0]
+    return 'Validation failed: %s' % exc
+
+
+def render_report(report, basic_url=None):
+    """Render the results snippet of a Report. If basic_url is given, the
+    results are presented as cached ones with a link to validate again.
+    """
+    categorized_results = categorize_results(report.results)
+    func = get_template_attribute('_results.html', 'render_results')
+    validated = rerun_url = None
+    if basic_url is not None:
+        validated = time.strftime('%Y-%m-%d %H:%M:%S',
+                                  time.localtime(report.validated))
+        rerun_url = url_for('validate_full', basic_url=basic_url, force=1)
+    return func(report.repository_name, report.admin_email,
+                categorized_results, validated, rerun_url)
+
+
+def submit_validation(basic_url):
+    """Queue a validation job. Return the job or a 429 response if the
+    queue is full.
+    """
+    try:
+        return jobs.submit(basic_url, Results())
+    except QueueFull as e:
+        response = make_response(e.args[0], 429)
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+
+
 @app.route('/_validate', methods=['POST'])
 def validate_snippet():
-    """Respond to direct /_validate POST requests (AJAX)."""
-    error = None
+    """Respond to direct /_validate POST requests (AJAX) by queueing a
+    validation job. The job's status URL is returned for polling.
+    """
     basic_url = request.values.get('basic_url', None)
     if not basic_url:
         return render_template('index.html')
     basic_url = "".join(basic_url.split())
-    try:
-        validator = validate_repository(basic_url)
-    except HTTPError as e:
-        error = '%d %s' % (e.code, e.msg)
-    except (ValueError, URLError) as e:
-        error = e.args[0]
-    except XMLSyntaxError as e:
-        error = 'Invalid OAI-PMH interface (Identify): %s' % e.args[0]
-    if error is not None:
-        return render_template('index.html', error=error, previous_url=basic_url)
-
-    admin_email = validator.admin_email
-    repository_name = validator.repository_name
-    results = validator.results
-    categorized_results = categorize_results(results)
+    if not request.values.get('force'):
+        report = cached_report(basic_url)
+        if report is not None:
+            return render_report(report, basic_url)
+    job = submit_validation(basic_url)
+    if not isinstance(job, Job):
+        return job
+    response = jsonify(job=job.id, state=job.state,
+                       status_url=url_for('job_status', job_id=job.id),
+                       categories=list(RESULT_CATEGORIES))
+    response.status_code = 202
+    return response
 
-    func = get_template_attribute('_results.html', 'render_results')
-    return func(repository_name, admin_email, categorized_results)
+
+@app.route('/_jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Respond to polling of validation jobs (AJAX). While the validation
+    is pending, answer 202 with the job state and the results reported
+    after the first `since` ones (rendered, with their categories) as well
+    as the `since` value for the next poll. Once it is done, answer with
+    the results snippet.
+    """
+    job = jobs.store.get(job_id)
+    if job is None:
+        return make_response('Unknown validation job.', 404)
+    if not job.done:
+        since = request.args.get('since', 0, type=int)
+        updates, since = job.args[1].updates(since)
+        func = get_template_attribute('_results.html', 'render_result')
+        results = [dict(check=check, category=CHECK_CATEGORIES[check],
+                        html=func(level, message))
+                   for check, (level, message) in updates
+                   if check in CHECK_CATEGORIES]
+        response = jsonify(job=job.id, state=job.state, since=since,
+                           results=results)
+        response.status_code = 202
+        return response
+    if job.error is not None:
+        return render_template('index.html', error=error_message(job.error),
+                               previous_url=job.args[0])
+    return render_report(job.result)
 
 
 @app.route('/validate', methods=['GET'])
 def validate_full():
-    """Respond to direct /validate GET requests."""
-    error = None
+    """Respond to direct /validate GET requests. A new validation is queued
+    and the client redirected to the job's page, which reloads itself until
+    the results are there.
+    """
+    job_id = request.values.get('job', None)
+    if job_id is not None:
+        job = jobs.store.get(job_id)
+        if job is None:
+            return render_template('index.html',
+                                   error='Unknown validation job.')
+        basic_url = job.args[0]
+        if not job.done:
+            func = get_template_attribute('_results.html',
+                                          'render_categories')
+            results = func(categorize_results(job.args[1].snapshot()))
+            return render_template('index.html', previous_url=basic_url,
+                                   pending=True, results=results,
+                                   refresh=app.config['JOB_POLL_INTERVAL'])
+        if job.error is not None:
+            return render_template('index.html',
+                                   error=error_message(job.error),
+                                   previous_url=basic_url)
+        return render_template('index.html', results=render_report(job.result),
+                               previous_url=basic_url)
+
     basic_url = request.values.get('basic_url', None)
     if not basic_url:
         return render_template('index.html')
     basic_url = "".join(basic_url.split())
-    try:
-        validator = validate_repository(basic_url)
-    except HTTPError as e:
-        error = '%d %s' % (e.code, e.msg)
-    except (ValueError, URLError) as e:
-        error = e.args[0]
-    except XMLSyntaxError as e:
-        error = 'Invalid OAI-PMH interface (Identify): %s' % e.args[0]
-    if error is not None:
-        return render_template('index.html', error=error, previous_url=basic_url)
-
-    admin_email = validator.admin_email
-    repository_name = validator.repository_name
-    results = validator.results
-    categorized_results = categorize_results(results)
-
-    func = get_template_attribute('_results.html', 'render_results')
-    categorized_results = func(
-        repository_name, admin_email, categorized_results)
-    return render_template('index.html', results=categorized_results,
-                           previous_url=basic_url)
+    if not request.values.get('force'):
+        report = cached_report(basic_url)
+        if report is not None:
+            return render_template('index.html',
+                                   results=render_report(report, basic_url),
+                                   previous_url=basic_url)
+    job = submit_validation(basic_url)
+    if not isinstance(job, Job):
+        return job
+    return redirect(url_for('validate_full', job=job.id))
 
 
 if __name__ == '__main__':
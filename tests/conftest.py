@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+    conftest.py
+    ~~~~~~~~~~~
+
+    Fixtures for the tests: a mock OAI-PMH repository (see mockserver.py)
+    served on a local port.
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+import os
+import sys
+
+import pytest
+
+# The modules import each other as top-level modules (see webapp.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'oval'))
+
+import harvester
+from mockserver import MockRepository, MockServer
+
+
+def active_records(records):
+    """Return the number of records the mock repository does not mark as
+    deleted (every 13th one).
+    """
+    return sum(1 for index in range(records) if index % 13)
+
+
+@pytest.fixture(autouse=True)
+def local_requests(monkeypatch):
+    # No rate limit for the local server, no responses from other tests
+    monkeypatch.setattr(harvester, 'LIMITER', None)
+    harvester.CACHE.clear()
+
+
+@pytest.fixture
+def repository():
+    return MockRepository(records=600, page_size=100)
+
+
+@pytest.fixture
+def server(repository):
+    with MockServer(repository) as server:
+        yield server
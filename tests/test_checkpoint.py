@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+    test_checkpoint.py
+    ~~~~~~~~~~~~~~~~~~
+
+    Tests for resumable harvests (see checkpoint.py).
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+import time
+
+import pytest
+
+from harvester import configure_record_iterator
+from checkpoint import CheckpointStore, ResumableHarvest
+from mockserver import MockRepository, MockServer
+
+from conftest import active_records
+
+
+class Crash(Exception):
+    pass
+
+
+def crash_after(limit):
+    """Return a feed counting records in its state and crashing once it
+    has seen limit records in this run.
+    """
+    seen = []
+
+    def feed(state, record):
+        seen.append(record)
+        if len(seen) > limit:
+            raise Crash()
+        state['records'] += 1
+    return feed
+
+
+def count(state, record):
+    state['records'] += 1
+
+
+def harvest(server, store):
+    RecordIterator = configure_record_iterator(server.url, '2.0', 'POST', 10)
+    return ResumableHarvest(server.url, RecordIterator, store)
+
+
+def test_resume_after_crash(server, repository, tmpdir):
+    store = CheckpointStore(str(tmpdir.join('checkpoints.db')))
+    with pytest.raises(Crash):
+        harvest(server, store).run(crash_after(250), {'records': 0})
+    checkpoint = harvest(server, store).run(count, {'records': 0})
+    assert checkpoint.pages > 0
+    assert checkpoint.count == active_records(repository.records)
+    # The state is the one saved with the last complete page
+    assert checkpoint.state['records'] == checkpoint.count
+    assert store.load(harvest(server, store).key) is None
+
+
+def test_fall_back_after_expired_token(tmpdir):
+    repository = MockRepository(records=600, page_size=100, token_expiry=1)
+    store = CheckpointStore(str(tmpdir.join('checkpoints.db')))
+    with MockServer(repository) as server:
+        with pytest.raises(Crash):
+            harvest(server, store).run(crash_after(250), {'records': 0})
+        time.sleep(1.5)
+        checkpoint = harvest(server, store).run(count, {'records': 0})
+    assert checkpoint.fallbacks == 1
+    assert checkpoint.count == active_records(repository.records)
+    assert checkpoint.state['records'] == checkpoint.count
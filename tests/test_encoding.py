@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+    test_encoding.py
+    ~~~~~~~~~~~~~~~~
+
+    Tests for the detection of doubly encoded UTF-8.
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+import random
+
+from analyzer import RecordInfo
+from validator import DoubleUTF8Check, is_double_encoded
+
+
+def decodes_differently(string):
+    # is_double_encoded without the prefilter
+    try:
+        cleaned = string.encode('raw_unicode_escape').decode('utf8')
+    except UnicodeDecodeError:
+        return False
+    if '\\u' in cleaned:
+        return False
+    return cleaned != string
+
+
+def test_is_double_encoded():
+    assert is_double_encoded(u'M\xc3\xbcller')
+    assert is_double_encoded(u'Caf\xc3\xa9 \xe2\x80\x93 Bar')
+    assert not is_double_encoded(u'Müller')
+    assert not is_double_encoded(u'plain ASCII')
+    assert not is_double_encoded('plain ASCII')
+    assert not is_double_encoded(u'')
+    # Characters beyond Latin-1 rule out double encoding
+    assert not is_double_encoded(u'M\xc3\xbcller –')
+
+
+def test_prefilter_keeps_results():
+    generator = random.Random(0)
+    alphabet = (u'ab \xc2\xc3\xe2\xf0\xf4\xf5\x80\x99\xa4\xa9\xbc\xbf\xe4'
+                u'€–')
+    for i in range(20000):
+        string = u''.join(generator.choice(alphabet)
+                          for j in range(generator.randint(0, 8)))
+        assert is_double_encoded(string) == decodes_differently(string)
+
+
+def test_check_counts_records_and_elements():
+    check = DoubleUTF8Check(max_examples=2, max_elements=2)
+    for i in range(10):
+        dc = {'title': [u'ok'], 'description': [None]}
+        if i % 2 == 0:
+            dc['title'].append(u'M\xc3\xbcller')
+        if i % 5 == 0:
+            dc['creator'] = [u'J\xc3\xbcrgen']
+            dc['subject'] = [u'\xc3\xa9t\xc3\xa9']
+        check.count += 1
+        check.inspect(RecordInfo('oai:test:%d' % i, dc=dc))
+    assert not check.done
+    assert check.found == 6
+    assert check.elements == {'title': 5, 'creator': 2, 'subject': 2}
+    assert check.examples == ['oai:test:0', 'oai:test:2']
+    level, message = check.result()
+    assert level == 'warning'
+    assert '6 of 10 records' in message
+    assert 'dc:title: 5, dc:creator: 2, 1 more elements' in message
+
+
+def test_check_without_findings():
+    check = DoubleUTF8Check()
+    check.count += 1
+    check.inspect(RecordInfo('oai:test:1', dc={'title': [u'Müller']}))
+    assert check.result() is None
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+    test_partition.py
+    ~~~~~~~~~~~~~~~~~
+
+    Tests for parallel harvests (see partition.py).
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+from datetime import datetime
+
+from harvester import configure_record_iterator, configure_request, OAI
+from partition import Partition, PartitionedHarvest, date_partitions, \
+    set_partitions, sized_date_partitions
+from mockserver import MockRepository, MockServer, SET_SPECS
+from validator import Validator
+
+from conftest import active_records
+
+IDENTIFIER = OAI % '2.0' + 'identifier'
+
+
+def identifiers(records):
+    return [record.findtext('.//' + IDENTIFIER) for record in records]
+
+
+def record_iterator(server):
+    return configure_record_iterator(server.url, '2.0', 'POST', 10)
+
+
+def sequential(server):
+    return identifiers(record_iterator(server)('ListRecords', 'oai_dc'))
+
+
+def test_contains():
+    partition = Partition('2011-01-02', '2011-01-03')
+    assert partition.contains('2011-01-02T00:00:00Z')
+    assert partition.contains('2011-01-03T23:59:59Z')
+    assert not partition.contains('2011-01-01T23:59:59Z')
+    assert not partition.contains('2011-01-04T00:00:00Z')
+    assert partition.contains(None)
+    assert Partition(None, '2011-01-03').contains('1999-01-01')
+
+
+def test_date_partitions_are_disjoint():
+    partitions = date_partitions('2011-01-01', 5, 'day',
+                                 latest=datetime(2011, 1, 28))
+    assert len(partitions) == 5
+    days = ['2011-01-%02d' % day for day in range(1, 29)]
+    for day in days:
+        assert sum(partition.contains(day) for partition in partitions) == 1
+
+
+def test_sized_windows(server):
+    request_oai = configure_request(server.url, 'POST', 10)
+    partitions = sized_date_partitions(request_oai, '2011-01-01T00:00:00Z',
+                                       8, 'full')
+    harvest = PartitionedHarvest(record_iterator(server), partitions,
+                                 workers=4)
+    found = identifiers(harvest)
+    assert len(found) == len(set(found))
+    assert set(found) == set(sequential(server))
+    assert harvest.duplicates == 0
+
+
+def test_sets(server):
+    harvest = PartitionedHarvest(record_iterator(server),
+                                 set_partitions(SET_SPECS), workers=3)
+    found = identifiers(harvest)
+    assert len(found) == len(set(found))
+    assert set(found) == set(sequential(server))
+
+
+def test_windows_ignored_by_server():
+    # Every window returns the whole list
+    repository = MockRepository(records=600, page_size=100,
+                                date_filter=False)
+    with MockServer(repository) as server:
+        all_records = set(sequential(server))
+        # The 600 records of the mock repository span 25 days
+        partitions = date_partitions('2011-01-01', 4, 'day',
+                                     latest=datetime(2011, 1, 25))
+        harvest = PartitionedHarvest(record_iterator(server), partitions,
+                                     workers=4)
+        found = identifiers(harvest)
+        assert len(found) == len(set(found))
+        assert set(found) == all_records
+        assert harvest.duplicates > 0
+
+        request_oai = configure_request(server.url, 'POST', 10)
+        partitions = sized_date_partitions(
+            request_oai, '2011-01-01T00:00:00Z', 8, 'full')
+        assert len(partitions) == 1
+        found = identifiers(PartitionedHarvest(record_iterator(server),
+                                               partitions, workers=4))
+        assert set(found) == all_records
+
+        validator = Validator(server.url)
+        assert validator.scan_records(workers=3) == active_records(
+            repository.records)
+
+
+def test_scan_records_with_workers(server, repository):
+    validator = Validator(server.url)
+    assert validator.scan_records(workers=3) == active_records(
+        repository.records)
+    assert validator.results['MinimalDC'][0] == 'ok'
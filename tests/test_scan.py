@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+    test_scan.py
+    ~~~~~~~~~~~~
+
+    Tests for full scans of all records (Validator.scan_records) and the
+    early stop of RecordAnalyzer.
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+from analyzer import RecordAnalyzer, RecordCheck, RecordInfo
+from validator import Validator, HandleCheck
+
+from conftest import active_records
+
+
+class CountingCheck(RecordCheck):
+
+    """Done after a given number of records."""
+
+    key = 'Counting'
+
+    def __init__(self, limit):
+        super(CountingCheck, self).__init__()
+        self.limit = limit
+
+    def inspect(self, record):
+        self.done = self.count >= self.limit
+
+    def result(self):
+        return ('ok', '%d records' % self.count)
+
+
+def test_scan_records_reads_every_record(server, repository):
+    validator = Validator(server.url)
+    assert validator.scan_records() == active_records(repository.records)
+    assert validator.results['MinimalDC'][0] == 'ok'
+    assert validator.results['ISO8601'][0] == 'ok'
+
+
+def test_scan_records_stops_once_checks_are_done(server):
+    validator = Validator(server.url)
+    assert validator.scan_records([CountingCheck(150)]) == 150
+    assert validator.results['Counting'] == ('ok', '150 records')
+
+
+def test_analyzer_takes_record_info():
+    check = CountingCheck(2)
+    analyzer = RecordAnalyzer([check])
+    records = [RecordInfo('oai:test:%d' % i) for i in range(10)]
+    assert analyzer.run(records) == 2
+    assert analyzer.done
+
+
+def test_handle_check_done_at_placeholder_prefix():
+    check = HandleCheck()
+    check.inspect(RecordInfo('oai:test:1', dc={
+        'identifier': ['http://hdl.handle.net/2069/1']}))
+    assert not check.done
+    check.inspect(RecordInfo('oai:test:2', dc={
+        'identifier': ['http://hdl.handle.net/123456789/2']}))
+    assert check.done
+    assert check.result()[0] == 'warning'
+    assert '123456789' in check.result()[1]
+
+
+def test_scan_records_records_streamed_pages(server, repository):
+    validator = Validator(server.url)
+    before = validator.metrics.summary()
+    repository.reset_counts()
+    validator.scan_records()
+    after = validator.metrics.summary()
+    pages = repository.requests['ListRecords']
+    assert pages == 6
+    assert after['pages'] - before['pages'] == pages
+    assert (after['requests']['network'] -
+            before['requests']['network']) == pages
+    assert after['bytes'] - before['bytes'] > 100 * pages
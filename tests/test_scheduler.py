@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+    test_scheduler.py
+    ~~~~~~~~~~~~~~~~~
+
+    Tests for the concurrent execution of checks (CheckScheduler) and the
+    substitute threads that take over while a check waits.
+
+
+    :copyright: Copyright 2011 Mathias Loesch.
+"""
+
+import threading
+import time
+
+from retry import wait
+from scheduler import CheckScheduler
+
+
+class Tracker(object):
+
+    """Record the largest number of tasks running (not waiting) at once."""
+
+    def __init__(self):
+        self.running = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def enter(self):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+
+    def leave(self):
+        with self.lock:
+            self.running -= 1
+
+    def task(self, seconds):
+        def run():
+            self.enter()
+            time.sleep(0.05)
+            self.leave()
+            wait(seconds)
+            self.enter()
+            time.sleep(0.05)
+            self.leave()
+        return run
+
+
+def run_tasks(seconds, count=12, max_workers=3):
+    tracker = Tracker()
+    scheduler = CheckScheduler(max_workers=max_workers, min_wait=0.2)
+    for i in range(count):
+        scheduler.add('task%d' % i, tracker.task(seconds))
+    started = time.time()
+    scheduler.run()
+    return tracker, time.time() - started
+
+
+def test_long_waits_never_exceed_max_workers():
+    tracker, elapsed = run_tasks(0.3)
+    assert tracker.peak <= 3
+    # Substitutes run other tasks during the waits: 12 tasks taking 0.4
+    # seconds each would need 1.6 seconds on 3 workers without them
+    assert elapsed < 1.3
+
+
+def test_short_waits_start_no_substitutes():
+    peaks = []
+
+    def count_threads():
+        peaks.append(threading.active_count())
+        wait(0.01)
+        peaks.append(threading.active_count())
+    threads = threading.active_count()
+    scheduler = CheckScheduler(max_workers=2, min_wait=0.2)
+    for i in range(6):
+        scheduler.add('task%d' % i, count_threads)
+    scheduler.run()
+    assert max(peaks) <= threads + 2